@@ -11,13 +11,42 @@ class AgentExecuteInput(BaseModel):
     """ Schema for the input JSON payload to the /v1/agent/execute endpoint. """
     task: str = Field(description="The user's prompt/task for the agentic framework.")
     thread_id: str | None = Field(None, description="The existing thread ID for the task.")
+    documents: List[str] | None = Field(None, description="Documents for the summarizing agent to summarize as the "
+                                                          "task asks.")
+
+class DocumentInput(BaseModel):
+    """ Schema for the input JSON payload to the /v1/documents endpoint. """
+    text: str = Field(description="The text of the document to index.")
+    doc_id: str | None = Field(None, description="The ID of the document, whose previous version is replaced. A new "
+                                                 "ID is generated if omitted.")
+
+class DocumentOutput(BaseModel):
+    """ Schema for the response of the /v1/documents endpoints. """
+    doc_id: str = Field(description="The ID of the document.")
+    chunks: int = Field(description="The number of chunks the document was indexed (or deleted) as.")
 
 class AgentExecuteOutput(BaseModel):
     """ Schema for the immediate response from the API. """
     task_id: str = Field(description="The unique ID generated for this task.")
+    thread_id: str = Field(description="The thread ID to pass along with a follow-up prompt to continue the conversation.")
     status: str = Field("QUEUED", description="The status of the task.")
     message: str = Field(description="Confirmation message and worker monitoring instructions.")
 
+class AgentExecuteBatchOutput(BaseModel):
+    """ Schema for the immediate response of the /v1/agent/execute_batch endpoint. """
+    batch_id: str = Field(description="The unique ID generated for this batch.")
+    task_ids: List[str] = Field(description="The ID of every task, in the order of the submitted prompts.")
+    status: str = Field("QUEUED", description="The status of the tasks.")
+    message: str = Field(description="Confirmation message and batch monitoring instructions.")
+
+class BatchStatusOutput(BaseModel):
+    """ Schema for checking the aggregated status of the tasks of a batch. """
+    batch_id: str = Field(description="The unique ID of this batch.")
+    total: int = Field(description="The number of tasks in the batch.")
+    counts: Dict[str, int] = Field(description="The number of tasks per status.")
+    finished: int = Field(description="The number of tasks that reached a terminal status.")
+    done: bool = Field(description="Whether every task of the batch reached a terminal status.")
+
 class TaskStatusOutput(BaseModel):
     """ Schema for checking the status of a task sent to an agent. """
     task_id: str = Field(description="The unique ID of this task.")
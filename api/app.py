@@ -1,17 +1,65 @@
 import uuid
 import os
-from fastapi import FastAPI, status, HTTPException
+import json
+import asyncio
+import threading
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Request, Response, Header, status, HTTPException
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
-from .api_models import AgentExecuteInput, AgentExecuteOutput, TaskStatusOutput
-from worker.tasks import execute_agent_framework
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from pydantic import ValidationError
+from .api_models import (AgentExecuteInput, AgentExecuteOutput, AgentExecuteBatchOutput, BatchStatusOutput,
+                         TaskStatusOutput, DocumentInput, DocumentOutput)
+# tasks are enqueued by name, the API never imports the worker's graph and its LLM clients
+from worker.client import execute_signature
+from worker.batch import submit_batch
 from core import MongoDBLogger
+from core.status_cache import TaskStatusCache
+from core.metrics import MetricsRecorder
+from core.task_events import TaskEventSubscriber, TERMINAL_STATUSES
+from core.token_stream import TokenStreamReader
+from core.request_coalescer import (RequestCoalescer, IdempotencyConflict, FANOUT, coalesce_key,
+                                    request_fingerprint)
+from core.admission import AdmissionController, AdmissionRejected
 from typing import *
 
 try:
-    mongo_logger = MongoDBLogger()
+    # the status endpoints read the Redis status records kept by the workers before falling back to MongoDB
+    mongo_logger = MongoDBLogger(status_cache=TaskStatusCache())
 except ValueError:
-    raise RuntimeError("MongoDB connection required for API status endpoint.")
-app = FastAPI(title="Toy Agentic Framework API")
+    raise RuntimeError("MongoDB and Redis connections required for API status endpoint.")
+try:
+    metrics_recorder = MetricsRecorder()
+except ValueError:
+    raise RuntimeError("Redis connection required for API metrics endpoint.")
+# one Redis subscription shared by every client waiting on a task
+task_events = TaskEventSubscriber()
+token_streams = TokenStreamReader()
+# finds the requests which repeat a task already submitted (by idempotency key) or still in flight (by prompt)
+coalescer = RequestCoalescer()
+# refuses the requests which would enqueue tasks past the queue depth, tasks in flight or client quota of their route
+admission = AdmissionController()
+# the index of the documents the agents retrieve passages from, shared with the workers through its directory. It is
+# built on the first request to the /v1/documents/ endpoints, so that NumPy is only imported if they are used.
+_document_index = None
+_document_index_lock = threading.Lock()
+
+# upper bound on the `wait` of a long-poll, so that proxies in front of the API do not time the request out
+MAX_STATUS_WAIT_SECONDS: float = float(os.getenv("MAX_STATUS_WAIT_SECONDS", "30"))
+# interval between the keep-alive comments of an idle event stream
+SSE_KEEPALIVE_SECONDS: float = 15.0
+# upper bound on the number of prompts of a single /v1/agent/execute_batch/ request
+MAX_BATCH_TASKS: int = int(os.getenv("MAX_BATCH_TASKS", "10000"))
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await task_events.start()
+    yield
+    await task_events.stop()
+    await token_streams.close()
+
+app = FastAPI(title="Toy Agentic Framework API", lifespan=lifespan)
 
 allowed_origins_string: str = os.getenv("ALLOWED_CORS_ORIGINS", "http://localhost")
 origins: List[str] = allowed_origins_string.split(",")
@@ -29,41 +77,225 @@ app.add_middleware(
     status_code=status.HTTP_202_ACCEPTED,
     summary="Enqueue a user prompt for agent execution."
 )
-async def execute_task(task_input: AgentExecuteInput):
+async def execute_task(task_input: AgentExecuteInput, request: Request,
+                       idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"),
+                       client_id: Optional[str] = Header(None, alias="X-Client-ID")):
     """
-
+    Enqueues the prompt, unless the request repeats a task which was already submitted:
+    * a retry carrying the `Idempotency-Key` of an earlier request is answered with the task of that request,
+    * with coalescing enabled, a new thread whose prompt (and documents) is already being executed joins the task
+      executing it (see `core.request_coalescer.RequestCoalescer`).
+    With admission control enabled, a request over a limit is refused with a 429 and a `Retry-After` header (see
+    `core.admission.AdmissionController`).
     :param task_input:
+    :param request:
+    :param idempotency_key: Optional key the client sends along with every retry of the same request.
+    :param client_id:       Optional ID of the client its quota is kept per, defaulting to its address.
     :return:
     """
     # generate a unique task ID
     # TODO: Consider in the future, but perhaps it is better to have MongoDB generate the unique ID.
     new_task_id = str(uuid.uuid4())
+    # the Redis and MongoDB round trips below are blocking
+    return await run_in_threadpool(_submit_task, new_task_id, task_input, idempotency_key,
+                                   _client_key(request, client_id))
 
-    # dispatch the task to Celery
-    execute_agent_framework.apply_async(
-        args=[new_task_id, task_input.task],
-        task_id=new_task_id # let the Celery worker's task ID match the task ID we pass to the LangGraph app
-    )
+def _client_key(request: Request, client_id: Optional[str]) -> str:
+    """ The client a request's quota is kept per: its `X-Client-ID`, else its address as forwarded by nginx. """
+    if client_id:
+        return f"id:{client_id}"
+    address = request.headers.get("X-Real-IP") or (request.client.host if request.client else "unknown")
+    return f"ip:{address}"
+
+def _admit(route: str, client: str, task_ids: Sequence[str] = (), cost: Optional[int] = None) -> None:
+    """ Admits a request to a route, or refuses it with a 429 telling the client when to retry. """
+    try:
+        admission.admit(route, client, task_ids, cost)
+    except AdmissionRejected as e:
+        metrics_recorder.inc("agent_admission_rejections_total", {"route": route, "reason": e.reason})
+        raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS, detail=str(e),
+                            headers={"Retry-After": str(e.retry_after)})
+
+def _submit_task(task_id: str, task_input: AgentExecuteInput, idempotency_key: Optional[str],
+                 client: str) -> AgentExecuteOutput:
+    # a task without a thread ID starts a new thread, whose ID is the task ID
+    thread_id = task_input.thread_id or task_id
+    fingerprint = request_fingerprint(task_input.model_dump())
+    if idempotency_key:
+        try:
+            previous = coalescer.reserve(idempotency_key, fingerprint, {"task_id": task_id, "thread_id": thread_id})
+        except IdempotencyConflict as e:
+            raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=str(e))
+        if previous is not None:
+            metrics_recorder.inc("agent_coalesced_requests_total", {"reason": "idempotency_key"})
+            return AgentExecuteOutput(
+                **previous,
+                status="QUEUED",
+                message=f"Task already submitted with this idempotency key. Task ID: {previous['task_id']}."
+            )
+
+    # whether the task is registered as executing its prompt for the duplicates to join
+    leader = False
+    try:
+        # a retry of an idempotent request was answered above without being charged again
+        _admit("execute", client, [task_id])
+        # a continued thread depends on its own previous turns, so only the new threads are coalesced
+        key = coalesce_key(task_input.task, task_input.documents) \
+            if coalescer.enabled and task_input.thread_id is None else None
+        pre_logged = False
+        if key is not None:
+            if coalescer.mode == FANOUT:
+                # the task's document must exist before it joins another task, which may end it right away
+                mongo_logger.log_task_queued(task_id, task_input.task, thread_id=thread_id)
+                pre_logged = True
+            leader_task_id = coalescer.join(key, task_id)
+            if leader_task_id is not None:
+                metrics_recorder.inc("agent_coalesced_requests_total", {"reason": "duplicate"})
+                # the task it joined already holds a slot in flight
+                admission.release(task_id)
+                if coalescer.mode == FANOUT:
+                    mongo_logger.log_task_coalesced(task_id, leader_task_id)
+                else:
+                    task_id = thread_id = leader_task_id
+                    if idempotency_key:
+                        coalescer.retarget(idempotency_key, fingerprint, {"task_id": task_id, "thread_id": thread_id})
+                return AgentExecuteOutput(
+                    task_id=task_id,
+                    thread_id=thread_id,
+                    status="QUEUED",
+                    message=f"Task received, the same prompt is already being executed by task {leader_task_id}. "
+                            f"Task ID: {task_id}. Check logs or a status endpoint for results."
+                )
+            leader = True
+
+        # dispatch the task to Celery
+        execute_signature(task_id, task_input.task, pre_logged=pre_logged, thread_id=task_input.thread_id,
+                          documents=task_input.documents, coalesce_key=key).apply_async()
+    except Exception as e:
+        if idempotency_key:
+            # let the client retry the request
+            coalescer.release(idempotency_key)
+        admission.release(task_id)
+        if leader:
+            _abandon_coalesced(key, task_id, pre_logged, e)
+        raise
 
     # return an immediate response
     return AgentExecuteOutput(
-        task_id=new_task_id,
+        task_id=task_id,
+        thread_id=thread_id,
+        status="QUEUED",
+        message=f"Task received and queued. Task ID: {task_id}. Check logs or a status endpoint for results."
+    )
+
+def _abandon_coalesced(key: str, task_id: str, pre_logged: bool, error: Exception) -> None:
+    """
+    Unregisters a coalesced task which could not be enqueued, so that the next duplicate of its prompt is executed
+    rather than joining it, and fails its document and those of the tasks which already joined it, as
+    `worker.tasks._fan_out` would once it ran.
+    """
+    try:
+        followers = coalescer.finish(key, task_id)
+    except Exception as e:
+        # the prompt is freed when its window expires
+        print(f"Failed to unregister the coalesced task {task_id}. Error: \n{e}")
+        return
+    if not pre_logged:
+        return
+    error_state = {"response": f"ERROR: the task could not be enqueued: {error}",
+                   "task_classification": {"task": "error", "choice_summary": "enqueue failed"}}
+    for failed_task_id in [task_id, *followers]:
+        try:
+            mongo_logger.log_task_end(failed_task_id, error_state, final_status="Failed")
+        except Exception as e:
+            print(f"Failed to end the task {failed_task_id} which could not be enqueued. Error: \n{e}")
+
+def _parse_batch_line(line_number: int, line: bytes) -> Optional[str]:
+    """ Parses one line of a JSONL batch into its prompt, or None for a blank line. """
+    if not line.strip():
+        return None
+    try:
+        return AgentExecuteInput.model_validate_json(line).task
+    except ValidationError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Invalid task on line {line_number}: {e}")
+
+@app.post(
+    "/v1/agent/execute_batch/",
+    response_model=AgentExecuteBatchOutput,
+    status_code=status.HTTP_202_ACCEPTED,
+    summary="Enqueue a JSONL stream of user prompts for agent execution."
+)
+async def execute_batch(request: Request, client_id: Optional[str] = Header(None, alias="X-Client-ID")):
+    """
+    Enqueues every prompt of a JSONL request body (one `AgentExecuteInput` object per line, e.g. `{"task": "..."}`).
+    The body is read as a stream and the whole batch is validated before anything is enqueued, so an invalid line
+    rejects the batch as a whole. The tasks are then inserted and enqueued in chunks (see `worker.batch.submit_batch`).
+    With admission control enabled, the batch is admitted or refused as a whole, each of its tasks counting as one
+    request of the client's quota.
+    :param request:
+    :param client_id:   Optional ID of the client its quota is kept per, defaulting to its address.
+    :return:
+    """
+    prompts: List[str] = []
+    buffer, line_number = b"", 0
+    async for chunk in request.stream():
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            line_number += 1
+            if (prompt := _parse_batch_line(line_number, line)) is not None:
+                prompts.append(prompt)
+        if len(prompts) > MAX_BATCH_TASKS:
+            raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                                detail=f"A batch holds at most {MAX_BATCH_TASKS} tasks.")
+    if (prompt := _parse_batch_line(line_number + 1, buffer)) is not None:
+        prompts.append(prompt)
+    if not prompts:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="The batch holds no task.")
+    if len(prompts) > MAX_BATCH_TASKS:
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                            detail=f"A batch holds at most {MAX_BATCH_TASKS} tasks.")
+
+    batch_id, task_ids = await run_in_threadpool(_submit_batch, prompts, _client_key(request, client_id))
+    return AgentExecuteBatchOutput(
+        batch_id=batch_id,
+        task_ids=task_ids,
         status="QUEUED",
-        message=f"Task received and queued. Task ID: {new_task_id}. Check logs or a status endpoint for results."
+        message=f"{len(task_ids)} tasks received and queued. Check /v1/agent/batch/{batch_id} for their progress."
     )
 
+def _submit_batch(prompts: List[str], client: str) -> Tuple[str, List[str]]:
+    """ Admits a batch as a whole, then enqueues it and registers its tasks as in flight. """
+    _admit("execute_batch", client, cost=len(prompts))
+    batch_id, task_ids = submit_batch(mongo_logger, prompts)
+    # the task IDs are generated chunk by chunk as the batch is enqueued
+    admission.track(task_ids)
+    return batch_id, task_ids
+
 @app.get(
-    "/v1/agent/status/",
-    response_model=TaskStatusOutput
+    "/v1/agent/batch/{batch_id}",
+    response_model=BatchStatusOutput
 )
-def get_task_status(task_id: str):
+async def get_batch_status(batch_id: str):
     """
-    Checks the status of an agent execution task and returns the final result if completed.
-    :param task_id:
+    Returns the number of tasks of a batch per status, aggregated by MongoDB rather than read task by task.
+    :param batch_id:
     :return:
     """
-    task_data = mongo_logger.get_task_by_id(task_id)
+    counts = await run_in_threadpool(mongo_logger.get_batch_status, batch_id)
+    if not counts:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Batch ID '{batch_id}' not found.")
+    total = sum(counts.values())
+    finished = sum(count for task_status, count in counts.items() if task_status in TERMINAL_STATUSES)
+    return BatchStatusOutput(batch_id=batch_id, total=total, counts=counts, finished=finished, done=finished == total)
 
+def _status_output(task_id: str, task_data: Optional[Dict[str, Any]]) -> TaskStatusOutput:
+    """
+    Builds the status response of a task from its MongoDB document or from the payload of one of its task events.
+    :param task_id:
+    :param task_data:
+    :return:
+    """
     if task_data is None:
         # FIXME:
         #   Originally we would raise an exception, but it could be that the front-end queries so quickly that the
@@ -77,7 +309,7 @@ def get_task_status(task_id: str):
 
     status = task_data.get("status", "Unknown")
 
-    if status in ['Completed', 'Error']:
+    if status in TERMINAL_STATUSES:
         # TODO:
         #   Consider what else should be sent back to the user. Remember to also update `TaskStatusOutput` in
         #   'api_models.py'
@@ -97,6 +329,192 @@ def get_task_status(task_id: str):
 
     return response_data
 
+def _conditional_status(task_id: str, task_data: Optional[Dict[str, Any]], response: Response,
+                        if_none_match: Optional[str]) -> Union[TaskStatusOutput, Response]:
+    """
+    Builds the status response of a task along with its ETag header, or a bodiless 304 if the client already holds
+    the same version of the status.
+    """
+    etag = task_data.get("etag") if task_data is not None else None
+    if etag is not None:
+        if if_none_match == etag:
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+        response.headers["ETag"] = etag
+    return _status_output(task_id, task_data)
+
+@app.get(
+    "/v1/agent/status/",
+    response_model=TaskStatusOutput,
+    responses={status.HTTP_304_NOT_MODIFIED: {"description": "The status did not change since the given ETag."}},
+)
+async def get_task_status(task_id: str, response: Response, wait: float = 0,
+                          if_none_match: Optional[str] = Header(None)):
+    """
+    Checks the status of an agent execution task and returns the final result if completed. The status is read from
+    the workers' Redis status records, falling back to MongoDB. Every response carries an ETag; sending it back in
+    `If-None-Match` answers 304 Not Modified while the status is unchanged, without reading the final response again.
+    :param task_id:
+    :param response:
+    :param wait:            Long-poll. If the task has not finished, wait up to this many seconds (capped at
+                            MAX_STATUS_WAIT_SECONDS) for its status to change before responding.
+    :param if_none_match:   The ETag of the status the client already holds.
+    :return:
+    """
+    if wait <= 0:
+        task_data = await run_in_threadpool(mongo_logger.get_task_status, task_id, if_none_match)
+        return _conditional_status(task_id, task_data, response, if_none_match)
+
+    # subscribe before reading the current status so that a change in between is not missed
+    queue = task_events.subscribe(task_id)
+    try:
+        task_data = await run_in_threadpool(mongo_logger.get_task_status, task_id, if_none_match)
+        current = _status_output(task_id, task_data)
+        # respond right away if the task finished, or if the client's version of the status is already outdated
+        stale = if_none_match is not None and task_data is not None and task_data.get("etag") != if_none_match
+        if current.status in TERMINAL_STATUSES or stale:
+            return _conditional_status(task_id, task_data, response, if_none_match)
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + min(wait, MAX_STATUS_WAIT_SECONDS)
+        while (remaining := deadline - loop.time()) > 0:
+            try:
+                event = await asyncio.wait_for(queue.get(), timeout=remaining)
+            except asyncio.TimeoutError:
+                break
+            # STEP events do not change the status, keep waiting for the next START/END
+            if event.get("status") and event["status"] != current.status:
+                return _conditional_status(task_id, event, response, if_none_match)
+        return _conditional_status(task_id, task_data, response, if_none_match)
+    finally:
+        task_events.unsubscribe(task_id, queue)
+
+@app.get("/v1/agent/events/{task_id}")
+async def stream_task_events(task_id: str, request: Request):
+    """
+    Streams the events of a task as server-sent events. The stream opens with a 'status' event holding the current
+    status of the task, followed by a 'start', 'step' or 'end' event every time the worker reaches that point. The
+    stream closes after the 'end' event, whose data has the same fields as the response of `/v1/agent/status/`.
+    :param task_id:
+    :param request:
+    :return:
+    """
+    queue = task_events.subscribe(task_id)
+
+    def sse(event: str, data: Dict[str, Any]) -> str:
+        return f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+
+    async def event_stream() -> AsyncIterator[str]:
+        try:
+            current = _status_output(task_id, await run_in_threadpool(mongo_logger.get_task_status, task_id))
+            yield sse("status", current.model_dump())
+            if current.status in TERMINAL_STATUSES:
+                return
+            while not await request.is_disconnected():
+                try:
+                    event = await asyncio.wait_for(queue.get(), timeout=SSE_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                    continue
+                if event["event"] == "END":
+                    yield sse("end", _status_output(task_id, event).model_dump())
+                    return
+                yield sse(event["event"].lower(), event)
+        finally:
+            task_events.unsubscribe(task_id, queue)
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        # ask nginx not to buffer the stream
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@app.get("/v1/agent/stream/{task_id}")
+async def stream_task_tokens(task_id: str, request: Request):
+    """
+    Streams the tokens of a task's response as server-sent events while the worker generates them (requires the
+    worker to run with STREAM_TOKENS enabled). Each 'token' event holds the generating node and a piece of text, and the
+    stream closes with an 'end' event holding the final status. Every event carries its Redis Stream entry ID, so a
+    client reconnecting with the standard `Last-Event-ID` header resumes where it left off. The full response is also
+    persisted as usual and available from `/v1/agent/status/`.
+    :param task_id:
+    :param request:
+    :return:
+    """
+    last_id = request.headers.get("last-event-id", "0")
+
+    async def token_stream() -> AsyncIterator[str]:
+        nonlocal last_id
+        while not await request.is_disconnected():
+            entries = await token_streams.read(task_id, last_id, block_ms=int(SSE_KEEPALIVE_SECONDS * 1e3))
+            if not entries:
+                # a task which finished without streaming (e.g. the worker does not stream) never gets an 'end' entry
+                if not await token_streams.exists(task_id):
+                    task_data = await run_in_threadpool(mongo_logger.get_task_status, task_id)
+                    current = _status_output(task_id, task_data)
+                    if current.status in TERMINAL_STATUSES:
+                        yield f"event: end\ndata: {json.dumps({'status': current.status})}\n\n"
+                        return
+                yield ": keep-alive\n\n"
+                continue
+            for entry_id, fields in entries:
+                last_id = entry_id
+                event = fields.pop("type", "token")
+                yield f"id: {entry_id}\nevent: {event}\ndata: {json.dumps(fields)}\n\n"
+                if event == "end":
+                    return
+
+    return StreamingResponse(
+        token_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+def _require_document_index():
+    global _document_index
+    if _document_index is None and os.getenv("DOCUMENT_INDEX", "").lower() in ("1", "true"):
+        with _document_index_lock:
+            if _document_index is None:
+                from core.document_index import load_document_index
+                _document_index = load_document_index()
+    if _document_index is None:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                            detail="The document index is disabled, set DOCUMENT_INDEX=true to enable it.")
+    return _document_index
+
+@app.post(
+    "/v1/documents/",
+    response_model=DocumentOutput,
+    status_code=status.HTTP_201_CREATED,
+    summary="Index a document, whose relevant passages are then given to the agents."
+)
+def add_document(document: DocumentInput):
+    """ Chunks, embeds and appends the document to the index, replacing its previous version if the ID is reused. """
+    index = _require_document_index()
+    doc_id = document.doc_id or str(uuid.uuid4())
+    return DocumentOutput(doc_id=doc_id, chunks=index.add(doc_id, document.text))
+
+@app.delete(
+    "/v1/documents/{doc_id}",
+    response_model=DocumentOutput,
+    summary="Remove a document from the index."
+)
+def delete_document(doc_id: str):
+    """ Marks the chunks of the document as deleted, without rebuilding the index. """
+    chunks = _require_document_index().delete(doc_id)
+    if not chunks:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Document {doc_id} is not indexed.")
+    return DocumentOutput(doc_id=doc_id, chunks=chunks)
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def get_metrics():
+    """ Exports the per-node and per-task histograms recorded by the workers in the Prometheus text format. """
+    # the gauges are sampled as they are scraped
+    for queue, depth in admission.queue_depths().items():
+        metrics_recorder.set_gauge("agent_queue_depth", {"queue": queue}, depth)
+    if admission.tracks_in_flight:
+        metrics_recorder.set_gauge("agent_tasks_in_flight", {}, admission.in_flight())
+    return PlainTextResponse(metrics_recorder.render(), media_type="text/plain; version=0.0.4")
+
 @app.get("/health/")
 def health_check():
     """ Simple health check endpoint to check if the API is running. """
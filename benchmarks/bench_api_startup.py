@@ -0,0 +1,74 @@
+"""
+Checks the import time and memory of the API process against a budget, and that the API does not import the worker's
+heavy dependencies (the graph and its LLM, search and image libraries).
+
+`api.app` is imported in a fresh interpreter, so the numbers include every module it pulls in but no request. The
+connections to MongoDB and Redis are lazy, so no server needs to be running. The import is repeated --runs times and the
+median is compared to the budget; the process exits with status 1 if a budget is exceeded or a heavy module was
+imported, so that it can gate a CI job.
+
+Usage:
+    python -m benchmarks.bench_api_startup --max-seconds 1.5 --max-rss-mb 150
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+from typing import *
+
+# modules which only the workers need
+HEAVY_MODULES: Tuple[str, ...] = ("core.agent_graph", "langchain_openai", "langgraph", "langchain_google_community",
+                                  "langchain_core", "PIL", "numpy", "worker.tasks", "worker.runtime")
+
+# imports the API in the child interpreter and reports what it cost
+_PROBE = """
+import json, resource, sys, time
+start = time.perf_counter()
+import api.app
+elapsed = time.perf_counter() - start
+heavy = [name for name in json.loads(sys.argv[1]) if name in sys.modules]
+# ru_maxrss is in kilobytes on Linux
+print(json.dumps({"seconds": elapsed, "rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+                  "modules": len(sys.modules), "heavy": heavy}))
+"""
+
+def _probe() -> Dict[str, Any]:
+    """ Imports the API in a fresh interpreter, returning its import time, peak RSS and heavy imports. """
+    env = {**os.environ}
+    # the clients only need syntactically valid settings since no request is ever sent
+    env.setdefault("MONGO_URI", "mongodb://localhost:27017")
+    env.setdefault("REDIS_URL", "redis://localhost:6379/0")
+    output = subprocess.run([sys.executable, "-c", _PROBE, json.dumps(HEAVY_MODULES)], env=env, check=True,
+                            capture_output=True, text=True).stdout
+    # the last line is the report, anything before it was printed by the modules themselves
+    return json.loads(output.strip().splitlines()[-1])
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5, help="Fresh imports of the API.")
+    parser.add_argument("--max-seconds", type=float, default=1.5, help="Budget of the median import time.")
+    parser.add_argument("--max-rss-mb", type=float, default=150, help="Budget of the median peak RSS, in MB.")
+    args = parser.parse_args()
+
+    probes = [_probe() for _ in range(args.runs)]
+    seconds = statistics.median(probe["seconds"] for probe in probes)
+    rss_mb = statistics.median(probe["rss_mb"] for probe in probes)
+    heavy = sorted({name for probe in probes for name in probe["heavy"]})
+    print(f"api.app imports {probes[0]['modules']} modules in {seconds * 1e3:.0f} ms (median of {args.runs}), "
+          f"peak RSS {rss_mb:.1f} MB.")
+
+    failures = []
+    if seconds > args.max_seconds:
+        failures.append(f"the import took {seconds:.2f} s, over the budget of {args.max_seconds:.2f} s")
+    if rss_mb > args.max_rss_mb:
+        failures.append(f"the peak RSS was {rss_mb:.1f} MB, over the budget of {args.max_rss_mb:.1f} MB")
+    if heavy:
+        failures.append(f"the API imported {', '.join(heavy)}, which only the workers need")
+    if failures:
+        raise SystemExit("FAILED: " + "; ".join(failures) + ".")
+    print("OK: within budget.")
+
+if __name__ == '__main__':
+    main()
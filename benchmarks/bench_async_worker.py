@@ -0,0 +1,126 @@
+"""
+Measures the throughput of one worker process in the 'sync' and 'async' execution modes (see `WORKER_EXECUTION`) when
+the graphs are I/O-bound, i.e. when almost all of a task's time is spent waiting on the LLM.
+
+The LLM is a fake which sleeps for --llm-latency seconds per call (`time.sleep` when invoked synchronously,
+`asyncio.sleep` when awaited) and the search backend is the stub one with its own latency, so no network access is
+needed. Both modes run the same tasks through `WorkerRuntime.run_graph`, the way a Celery pool thread does:
+* 'sync':   one task at a time, which is what a prefork child (one per core) does,
+* 'async':  --concurrency tasks submitted at once from pool threads, all of whose graphs share the process's loop.
+
+Since a single process is measured, its throughput is the throughput per core. The CPU time (of every thread of the
+process) shows how little of each task is spent on the CPU either way.
+
+Usage:
+    python -m benchmarks.bench_async_worker --tasks 64 --concurrency 32 --llm-latency 0.2
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+# the clients below only need syntactically valid settings since no request is ever sent
+os.environ.setdefault("MONGO_URI", "mongodb://localhost:27017")
+os.environ.setdefault("OPENAI_API_KEY", "sk-benchmark")
+os.environ.setdefault("SEARCH_BACKEND", "stub")
+
+from langchain_core.messages import AIMessage
+from langgraph.checkpoint.memory import InMemorySaver
+from core import build_graph
+from core.agent_graph import AGENTS
+from core.search_service import SearchService, StubSearchBackend
+from worker.runtime import WorkerRuntime
+from typing import *
+
+class _SlowFakeLLM:
+    """ Stands in for `ChatOpenAI`: every call takes `latency` seconds and the router cycles through the agents. """
+    model_name = "gpt-4.1"
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.calls = 0
+
+    def _message(self, prompt: Any) -> AIMessage:
+        self.calls += 1
+        return AIMessage(content=f"A response to: {str(prompt).strip()[:40]}",
+                         usage_metadata={"input_tokens": 200, "output_tokens": 100, "total_tokens": 300})
+
+    def invoke(self, prompt: Any, *args, **kwargs) -> AIMessage:
+        time.sleep(self.latency)
+        return self._message(prompt)
+
+    async def ainvoke(self, prompt: Any, *args, **kwargs) -> AIMessage:
+        await asyncio.sleep(self.latency)
+        return self._message(prompt)
+
+    def with_structured_output(self, schema: Any, include_raw: bool = False, **kwargs) -> Any:
+        llm = self
+
+        class _Structured:
+            def _output(self, message: AIMessage) -> Dict[str, Any]:
+                route = AGENTS[llm.calls % len(AGENTS)]
+                return {"raw": message, "parsed": {"task": route, "choice_summary": "benchmark"}, "parsing_error": None}
+
+            def invoke(self, prompt: Any, *args, **kwargs) -> Dict[str, Any]:
+                return self._output(llm.invoke(prompt))
+
+            async def ainvoke(self, prompt: Any, *args, **kwargs) -> Dict[str, Any]:
+                return self._output(await llm.ainvoke(prompt))
+
+        return _Structured()
+
+class _NullLogger:
+    """ The nodes only log their steps, which the benchmark does not need to persist. """
+    def log_step(self, task_id: str, node_name: str, updates: Dict[str, Any]) -> None:
+        pass
+
+def _runtime(execution: str, concurrency: int, llm_latency: float, search_latency: float) -> WorkerRuntime:
+    runtime = WorkerRuntime(use_llm=False, execution=execution, concurrency=concurrency)
+    runtime.llm = _SlowFakeLLM(llm_latency)
+    runtime.checkpointer = InMemorySaver()
+    runtime.search = SearchService(StubSearchBackend(latency=search_latency), max_workers=4)
+    runtime.app = build_graph(_NullLogger(), runtime.llm, checkpointer=runtime.checkpointer, search=runtime.search,
+                              use_async=execution == "async")
+    return runtime
+
+def _run(runtime: WorkerRuntime, tasks: int, in_flight: int) -> Dict[str, float]:
+    """ Runs the tasks from `in_flight` threads, the way a Celery threads pool of that size would. """
+    def task(i: int) -> None:
+        task_id = str(uuid.uuid4())
+        runtime.run_graph({"prompt_content": f"Prompt number {i} of the benchmark.", "task_id": task_id},
+                          {"configurable": {"thread_id": task_id}})
+        runtime.checkpointer.delete_thread(task_id)
+
+    wall, cpu = time.perf_counter(), time.process_time()
+    with ThreadPoolExecutor(max_workers=in_flight) as pool:
+        list(pool.map(task, range(tasks)))
+    wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+    return {"tasks": tasks, "in_flight": in_flight, "wall_s": round(wall, 3), "cpu_s": round(cpu, 3),
+            "tasks_per_second": round(tasks / wall, 2), "cpu_ms_per_task": round(cpu / tasks * 1e3, 2)}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tasks", type=int, default=64, help="Number of tasks per mode.")
+    parser.add_argument("--concurrency", type=int, default=32, help="Graphs in flight in the 'async' mode.")
+    parser.add_argument("--llm-latency", type=float, default=0.2, help="Seconds the fake LLM takes per call.")
+    parser.add_argument("--search-latency", type=float, default=0.1, help="Seconds the stub search takes per query.")
+    args = parser.parse_args()
+
+    results = {}
+    for execution, in_flight in (("sync", 1), ("async", args.concurrency)):
+        runtime = _runtime(execution, args.concurrency, args.llm_latency, args.search_latency)
+        with contextlib.redirect_stdout(io.StringIO()):
+            # warm up the graph (and the loop in the 'async' mode) so that only the tasks are measured
+            _run(runtime, 1, 1)
+            results[execution] = _run(runtime, args.tasks, in_flight)
+        runtime.close()
+    results["async_speedup"] = round(results["async"]["tasks_per_second"] / results["sync"]["tasks_per_second"], 1)
+    print(json.dumps(results, indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,166 @@
+"""
+Measures the latency and throughput of the agent offline, replaying the prompts of a JSONL file through either the
+compiled graph (`--target graph`, i.e. `WorkerRuntime.run_graph`) or the whole Celery task (`--target task`, i.e.
+`execute_agent_framework` with its logging, caching and thread cleanup).
+
+Every external service is replaced by an in-process stand-in (see `benchmarks.fakes`): the LLM is a deterministic fake
+with a configurable time to first token and token rate, the search backend is the stub one, MongoDB is a dictionary
+and Celery runs the tasks eagerly, in the calling thread. So nothing needs to be running and two runs with the same
+settings make the same calls with the same simulated latencies, which makes the numbers comparable across commits.
+
+The tasks are run from --concurrency threads, the way a Celery threads pool of that size would. The report gives the
+p50/p95/p99 of the end-to-end latency and of every node, and the tasks per second. --json writes it as JSON, along with
+the settings it was measured with, for regression tracking.
+
+Usage:
+    python -m benchmarks.bench_graph requests.jsonl --target task --concurrency 8 --json bench.json
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+# the clients below only need syntactically valid settings since no request is ever sent, and the Celery app needs a
+# broker URL although the eager tasks never reach it
+os.environ.setdefault("MONGO_URI", "mongodb://localhost:27017")
+os.environ.setdefault("OPENAI_API_KEY", "sk-benchmark")
+os.environ.setdefault("SEARCH_BACKEND", "stub")
+os.environ.setdefault("REDIS_URL", "redis://localhost:6379/0")
+
+from langgraph.checkpoint.memory import InMemorySaver
+import worker.runtime
+import worker.tasks  # registers `execute_agent_framework` with the Celery app
+from benchmarks.fakes import FakeChatModel, InMemoryLogger, InMemoryMetrics
+from benchmarks.report import percentiles
+from core import build_graph
+from core.search_service import SearchService, StubSearchBackend
+from scripts.submit_batch import iter_prompts
+from worker.client import celery_app, execute_signature
+from worker.runtime import WorkerRuntime
+from typing import *
+
+def _runtime(args: argparse.Namespace) -> WorkerRuntime:
+    """ A worker runtime whose logger, metrics, LLM, checkpointer and search are the in-process stand-ins. """
+    # without Redis, the runtime builds none of its Redis-backed components (events, status records, caches, ...)
+    os.environ.pop("REDIS_URL", None)
+    runtime = WorkerRuntime(use_llm=False, execution=args.execution, concurrency=args.concurrency)
+    runtime.logger.close()
+    runtime.logger = InMemoryLogger()
+    runtime.metrics = InMemoryMetrics()
+    runtime.llm = FakeChatModel(ttft=args.llm_ttft, tokens_per_second=args.tokens_per_second,
+                                completion_tokens=args.completion_tokens)
+    runtime.checkpointer = InMemorySaver()
+    runtime.search.close()
+    runtime.search = SearchService(StubSearchBackend(latency=args.search_latency), max_workers=4)
+    runtime.app = build_graph(runtime.logger, runtime.llm, checkpointer=runtime.checkpointer, metrics=runtime.metrics,
+                              classifier=runtime.classifier, response_cache=runtime.response_cache,
+                              search=runtime.search, page_fetcher=runtime.page_fetcher, speculation=runtime.speculation,
+                              summarizer=runtime.summarizer, retriever=runtime.document_index,
+                              use_async=args.execution == "async")
+    # the tasks find it through `get_runtime`
+    worker.runtime._runtime = runtime
+    return runtime
+
+def _run_task(runtime: WorkerRuntime, target: str, prompt: str) -> Tuple[float, str]:
+    """ Runs one prompt to completion, returning its latency and route ('error' if it failed). """
+    task_id = str(uuid.uuid4())
+    start = time.perf_counter()
+    try:
+        if target == "task":
+            execute_signature(task_id, prompt).apply_async()
+            route = runtime.logger.get_task_by_id(task_id)["task"]
+        else:
+            state = {"prompt_content": prompt, "task_id": task_id, "documents": [], "retrieved_passages": None,
+                     "search_results": None, "search_query": None, "search_queries": None, "page_contents": None}
+            try:
+                result = runtime.run_graph(state, {"configurable": {"thread_id": task_id}})
+                route = result['task_classification']['task']
+            finally:
+                runtime.release_thread(task_id)
+    except Exception:
+        route = "error"
+    return time.perf_counter() - start, route
+
+def _run(runtime: WorkerRuntime, target: str, prompts: List[str], concurrency: int) -> Dict[str, Any]:
+    """ Runs the prompts from `concurrency` threads and summarizes their latencies. """
+    wall, cpu = time.perf_counter(), time.process_time()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        outcomes = list(pool.map(lambda prompt: _run_task(runtime, target, prompt), prompts))
+    wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+
+    routes: Dict[str, int] = {}
+    for _, route in outcomes:
+        routes[route] = routes.get(route, 0) + 1
+    nodes = runtime.metrics.values("agent_node_duration_seconds", "node")
+    llm = runtime.metrics.values("agent_llm_latency_seconds", "node")
+    return {
+        "tasks": len(prompts),
+        "failed": routes.get("error", 0),
+        "wall_s": round(wall, 3),
+        "cpu_ms_per_task": round(cpu / len(prompts) * 1e3, 2),
+        "tasks_per_second": round(len(prompts) / wall, 2),
+        "end_to_end": percentiles([latency for latency, route in outcomes if route != "error"]),
+        "nodes": {node: percentiles(values) for node, values in sorted(nodes.items())},
+        "llm": {node: percentiles(values) for node, values in sorted(llm.items())},
+        "routes": dict(sorted(routes.items())),
+    }
+
+def _print_report(report: Dict[str, Any]) -> None:
+    print(f"{report['tasks']} tasks ({report['failed']} failed) in {report['wall_s']} s: "
+          f"{report['tasks_per_second']} tasks/s, {report['cpu_ms_per_task']} ms of CPU per task.")
+    print(f"Routes: {', '.join(f'{route} {count}' for route, count in report['routes'].items())}")
+    print(f"{'':<24}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    rows = [("end to end", report["end_to_end"])] + [(f"node {node}", stats)
+                                                     for node, stats in report["nodes"].items()]
+    for name, stats in rows:
+        if stats["count"]:
+            print(f"{name:<24}{stats['count']:>8}{stats['p50_ms']:>10}{stats['p95_ms']:>10}{stats['p99_ms']:>10}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("path", nargs="?", default="requests.jsonl", help="JSONL file of prompts.")
+    parser.add_argument("--field", default=None, help="Field of each record holding the prompt.")
+    parser.add_argument("--target", choices=("graph", "task"), default="task",
+                        help="Run the compiled graph only, or the whole Celery task.")
+    parser.add_argument("--execution", choices=("sync", "async"), default="sync", help="See $WORKER_EXECUTION.")
+    parser.add_argument("--concurrency", type=int, default=8, help="Tasks in flight at once.")
+    parser.add_argument("--repeat", type=int, default=1, help="Times every prompt is replayed.")
+    parser.add_argument("--llm-ttft", type=float, default=0.3, help="Seconds before the fake LLM's first token.")
+    parser.add_argument("--tokens-per-second", type=float, default=80.0,
+                        help="Token rate of the fake LLM, 0 for instant completions.")
+    parser.add_argument("--completion-tokens", type=int, default=150, help="Mean completion length of the fake LLM.")
+    parser.add_argument("--search-latency", type=float, default=0.1, help="Seconds the stub search takes per query.")
+    parser.add_argument("--json", default=None, help="File to write the report to as JSON, '-' for stdout.")
+    args = parser.parse_args()
+
+    prompts = list(iter_prompts(args.path, args.field)) * args.repeat
+    if not prompts:
+        raise SystemExit(f"{args.path} holds no prompt.")
+    # Celery runs the tasks in the calling thread instead of sending them to the broker, and raises their errors
+    celery_app.conf.task_always_eager = True
+    celery_app.conf.task_eager_propagates = True
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        runtime = _runtime(args)
+        try:
+            # warm up the graph (and the loop in the 'async' mode) so that only the replay is measured
+            _run(runtime, args.target, prompts[:1], 1)
+            runtime.metrics.samples.clear()
+            report = _run(runtime, args.target, prompts, args.concurrency)
+        finally:
+            runtime.close()
+    report["config"] = {name: value for name, value in vars(args).items() if name != "json"}
+
+    _print_report(report)
+    if args.json == "-":
+        print(json.dumps(report, indent=2))
+    elif args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == '__main__':
+    main()
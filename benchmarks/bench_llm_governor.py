@@ -0,0 +1,127 @@
+"""
+Exercises the LLM governor (see `core.llm_governor`) against the fake OpenAI API of `benchmarks.fake_openai_server`,
+started in-process: --requests prompts are sent through the registry's client of --model from --concurrency threads,
+either governed (the cluster's budget in Redis, the governor's retries and, with --hedge-percentile, hedging) or not
+(`--baseline`, the client's own retries only), and the report gives the latency percentiles of the successful calls,
+the failed calls, and the responses of the fake API by status, i.e. how many 429s the budget saved.
+
+Running it from several machines at once against one fake API (--no-server and $OPENAI_BASE_URL) shows the budget
+holding across processes, since it is kept in Redis.
+
+Usage:
+    python -m benchmarks.bench_llm_governor --requests 300 --concurrency 32 --server-rpm 120 --rpm 110
+    python -m benchmarks.bench_llm_governor --requests 300 --server-slow-fraction 0.05 --hedge-percentile 90
+"""
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+import httpx
+from benchmarks import fake_openai_server
+from benchmarks.fakes import InMemoryMetrics
+from benchmarks.report import percentiles
+from core.llm_governor import LLMGovernor
+from core.model_registry import ModelRegistry
+from typing import *
+
+def _call(llm: Any, i: int) -> Tuple[float, Optional[str]]:
+    """ Makes one call, returning its latency and the name of its error, if it failed. """
+    start = time.perf_counter()
+    try:
+        llm.invoke(f"Prompt {i}: write a few words about the number {i}.")
+        return time.perf_counter() - start, None
+    except Exception as e:
+        return time.perf_counter() - start, type(e).__name__
+
+def _counts(metrics: InMemoryMetrics, name: str, label: str) -> Dict[str, int]:
+    """ A counter's totals by the value of one of its labels. """
+    counts: Dict[str, int] = {}
+    for labels, count in metrics.counters.get(name, {}).items():
+        value = dict(labels).get(label)
+        counts[value] = counts.get(value, 0) + int(count)
+    return counts
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=200, help="Calls to make.")
+    parser.add_argument("--concurrency", type=int, default=16, help="Calls in flight at once.")
+    parser.add_argument("--model", default="gpt-4.1-mini")
+    parser.add_argument("--baseline", action="store_true", help="Call without the governor.")
+    parser.add_argument("--rpm", type=float, default=0.0, help="Requests per minute of the governor's budget.")
+    parser.add_argument("--tpm", type=float, default=0.0, help="Tokens per minute of the governor's budget.")
+    parser.add_argument("--max-retries", type=int, default=2, help="Retries of a failed call.")
+    parser.add_argument("--max-wait", type=float, default=60.0, help="Longest wait for the budget.")
+    parser.add_argument("--hedge-percentile", type=float, default=0.0, help="Latency percentile to hedge after.")
+    parser.add_argument("--hedge-min-delay", type=float, default=0.5, help="Shortest delay before hedging.")
+    parser.add_argument("--no-server", action="store_true", help="Use the API at $OPENAI_BASE_URL instead.")
+    parser.add_argument("--json", default=None, help="File to write the report to as JSON, '-' for stdout.")
+    # the settings of the in-process fake API, prefixed to tell them from the governor's
+    server_args = argparse.ArgumentParser(add_help=False)
+    fake_openai_server.add_arguments(server_args)
+    for action in server_args._actions:
+        name = action.option_strings[0].lstrip("-")
+        parser.add_argument(f"--server-{name}", dest=f"server_{action.dest}", type=action.type, default=action.default,
+                            help=f"Of the fake API: {action.help or name}")
+    args = parser.parse_args()
+
+    server = None
+    if not args.no_server:
+        server_config = argparse.Namespace(**{name[len("server_"):]: value for name, value in vars(args).items()
+                                              if name.startswith("server_")})
+        server = fake_openai_server.serve(server_config)
+        os.environ["OPENAI_BASE_URL"] = f"http://{server_config.host}:{server_config.port}/v1"
+    os.environ.setdefault("OPENAI_API_KEY", "sk-benchmark")
+
+    metrics = InMemoryMetrics()
+    governor = None if args.baseline else LLMGovernor(
+        limits={args.model: (args.rpm, args.tpm)}, max_wait=args.max_wait, max_retries=args.max_retries,
+        hedge_percentile=args.hedge_percentile, hedge_min_delay=args.hedge_min_delay, metrics=metrics)
+    registry = ModelRegistry(model=args.model, max_connections=args.concurrency * 2, max_retries=args.max_retries,
+                             governor=governor)
+    llm = registry.llm()
+    try:
+        wall = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            outcomes = list(pool.map(lambda i: _call(llm, i), range(args.requests)))
+        wall = time.perf_counter() - wall
+        stats = httpx.get(f"{os.environ['OPENAI_BASE_URL'].rstrip('/')}/stats").json() if server else {}
+    finally:
+        registry.close()
+        if server is not None:
+            server.shutdown()
+
+    errors: Dict[str, int] = {}
+    for _, error in outcomes:
+        if error is not None:
+            errors[error] = errors.get(error, 0) + 1
+    report = {
+        "requests": args.requests,
+        "failed": sum(errors.values()),
+        "errors": errors,
+        "wall_s": round(wall, 3),
+        "calls_per_second": round(args.requests / wall, 2),
+        "latency": percentiles([latency for latency, error in outcomes if error is None]),
+        "budget_wait": percentiles(metrics.values("agent_llm_budget_wait_seconds", "model").get(args.model, [])),
+        "server_responses": stats,
+        "retries": _counts(metrics, "agent_llm_retries_total", "reason"),
+        "hedges": _counts(metrics, "agent_llm_hedges_total", "winner"),
+        "config": {name: value for name, value in vars(args).items() if name != "json"},
+    }
+
+    latency = report["latency"]
+    print(f"{args.requests} calls ({report['failed']} failed{': ' + str(errors) if errors else ''}) in "
+          f"{report['wall_s']} s: {report['calls_per_second']} calls/s.")
+    print(f"Latency: p50 {latency['p50_ms']} ms, p95 {latency['p95_ms']} ms, p99 {latency['p99_ms']} ms; "
+          f"budget wait p95 {report['budget_wait']['p95_ms']} ms.")
+    if stats:
+        print(f"Fake API responses by status: {stats}")
+    print(f"Retries: {report['retries'] or 'none'}; hedges: {report['hedges'] or 'none'}.")
+    if args.json == "-":
+        print(json.dumps(report, indent=2, default=str))
+    elif args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, default=str)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+"""
+Measures the page fetching stage of the content route against a local HTTP stand-in, so no network access is needed.
+
+The stand-in serves HTML pages (with an ETag) after a fixed delay. The benchmark compares fetching the pages of one
+task one after the other with `PageFetcher.fetch_many`, which fetches them concurrently, and then fetches them again
+to show the on-disk cache: first while the entries are fresh (no request at all), then once they are stale (a 304
+revalidation per page).
+
+Usage:
+    python -m benchmarks.bench_page_fetcher --pages 8 --delay 0.2
+"""
+import argparse
+import contextlib
+import hashlib
+import io
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from core.page_fetcher import PageCache, PageFetcher
+from typing import *
+
+_PAGE = """<html><head><title>Page {n}</title><style>body {{ color: red; }}</style></head>
+<body><nav>Home | About | Contact</nav>
+<article><h1>Page {n}</h1>{paragraphs}</article>
+<footer>Copyright</footer><script>console.log("tracking");</script></body></html>"""
+
+class _StandInHandler(BaseHTTPRequestHandler):
+    """ Serves /page/<n> after `delay` seconds, answering 304 to a matching If-None-Match. """
+    delay = 0.2
+    requests = 0
+    not_modified = 0
+
+    def do_GET(self):
+        type(self).requests += 1
+        time.sleep(self.delay)
+        body = _PAGE.format(n=self.path, paragraphs="".join(f"<p>Paragraph {i} of {self.path}.</p>"
+                                                            for i in range(200))).encode()
+        etag = '"' + hashlib.sha256(body).hexdigest()[:16] + '"'
+        if self.headers.get("If-None-Match") == etag:
+            type(self).not_modified += 1
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class _StandInServer(ThreadingHTTPServer):
+    # the default backlog of 5 drops connections when every page is requested at once
+    request_queue_size = 128
+
+def _timed(label: str, fetch: Callable[[], Dict[str, str]], pages: int) -> float:
+    start = time.perf_counter()
+    texts = fetch()
+    elapsed = time.perf_counter() - start
+    print(f"{label:>22}: {elapsed * 1e3:8.1f} ms for {len(texts)}/{pages} pages")
+    return elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pages", type=int, default=8, help="Number of search result pages per task.")
+    parser.add_argument("--delay", type=float, default=0.2, help="Seconds the stand-in takes to serve a page.")
+    parser.add_argument("--max-tokens", type=int, default=800, help="Token budget per page.")
+    args = parser.parse_args()
+
+    _StandInHandler.delay = args.delay
+    server = _StandInServer(("127.0.0.1", 0), _StandInHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    # every page on its own host name would defeat the per-host limit, so they share the stand-in's host
+    urls = [f"http://127.0.0.1:{server.server_port}/page/{i}" for i in range(args.pages)]
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        cache = PageCache(cache_dir, fresh_for=3600)
+        fetcher = PageFetcher(max_per_host=args.pages, timeout=args.delay * 10, max_tokens=args.max_tokens,
+                              cache=cache)
+        serial_fetcher = PageFetcher(max_per_host=args.pages, timeout=args.delay * 10, max_tokens=args.max_tokens)
+        with contextlib.redirect_stdout(io.StringIO()):
+            # warm up the event loops and connection pools so that only the fetches are measured
+            serial_fetcher.fetch_many(urls[:1])
+        _StandInHandler.requests = 0
+
+        serial = _timed("serial", lambda: {u: t for u in urls for t in serial_fetcher.fetch_many([u]).values()},
+                        args.pages)
+        concurrent = _timed("concurrent (cold)", lambda: fetcher.fetch_many(urls), args.pages)
+        _timed("concurrent (fresh)", lambda: fetcher.fetch_many(urls), args.pages)
+        cache.fresh_for = 0
+        _timed("concurrent (304)", lambda: fetcher.fetch_many(urls), args.pages)
+        sample = fetcher.fetch_many(urls[:1])
+        fetcher.close()
+        serial_fetcher.close()
+    server.shutdown()
+
+    print(f"Requests served: {_StandInHandler.requests} ({_StandInHandler.not_modified} not modified)")
+    print(f"Concurrent fetching is {serial / concurrent:.1f}x faster than serial fetching.")
+    text = next(iter(sample.values()), "")
+    print(f"Extracted {len(text)} characters per page, starting with: {text[:60]!r}")
+
+if __name__ == '__main__':
+    main()
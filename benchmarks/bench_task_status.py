@@ -0,0 +1,113 @@
+"""
+Measures the latency of a task status lookup on a large TaskLogs collection, with and without the logger's indexes and
+status projection.
+
+The collection is filled with synthetic task documents shaped like real ones (a trajectory, search results and a final
+response), then random task IDs are looked up in three ways:
+* 'full scan':   `find_one` on a collection without any index, returning the whole document (the old behaviour),
+* 'indexed':     the same lookup once `MongoDBLogger.ensure_indexes` created the unique index on `task_id`,
+* 'projected':   `MongoDBLogger.get_task_status`, i.e. the indexed lookup returning only the status fields.
+
+Run it against a local mongod (the benchmark uses its own database, which is dropped at the end unless --keep is given):
+    python -m benchmarks.bench_task_status --mongo-uri mongodb://localhost:27017 --documents 1000000
+
+or, without a database, against mongomock, which scans in Python regardless of indexes and so is only meaningful for
+the projection and at a smaller size:
+    python -m benchmarks.bench_task_status --mongomock --documents 20000
+"""
+import argparse
+import os
+import random
+import statistics
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from core import mongodb_logger
+from core.mongodb_logger import MongoDBLogger
+from typing import *
+
+STATUSES = ["Completed"] * 90 + ["Failed"] * 5 + ["In Progress"] * 3 + ["Queued"] * 2
+
+def _document(task_id: str, created_at: datetime) -> Dict[str, Any]:
+    """ A synthetic task document of roughly the size of a real content task. """
+    return {
+        "task_id": task_id,
+        "prompt": "Write a short blog post about learning mechanical engineering at university. " * 3,
+        "status": random.choice(STATUSES),
+        "current_event": "END",
+        "created_at": created_at,
+        "trajectory": [{"node": node, "timestamp": created_at, "duration_ms": 120.5, "prompt_tokens": 512,
+                        "completion_tokens": 256, "cost_usd": 0.003, "model": "gpt-4.1"}
+                       for node in ("task_classification", "content", "content_post_web_search")],
+        "search_results": [{"title": f"Result {i}", "link": f"https://example.com/{task_id}/{i}",
+                            "snippet": "A snippet of the search result. " * 5} for i in range(4)],
+        "final_response": "The generated response. " * 80,
+        "task": "content",
+        "task_choice_summary": "The user asked for a blog post.",
+    }
+
+def _populate(logger: MongoDBLogger, documents: int, batch_size: int = 10_000) -> List[str]:
+    task_ids = []
+    start = datetime.now(timezone.utc) - timedelta(days=30)
+    for offset in range(0, documents, batch_size):
+        batch = []
+        for i in range(offset, min(offset + batch_size, documents)):
+            task_id = str(uuid.uuid4())
+            task_ids.append(task_id)
+            batch.append(_document(task_id, start + timedelta(seconds=i)))
+        logger.collection.insert_many(batch, ordered=False)
+        print(f"\rInserted {offset + len(batch)}/{documents} documents", end="", flush=True)
+    print()
+    return task_ids
+
+def _measure(label: str, lookup: Callable[[str], Any], task_ids: List[str], lookups: int) -> float:
+    samples = []
+    for task_id in random.sample(task_ids, min(lookups, len(task_ids))):
+        start = time.perf_counter()
+        document = lookup(task_id)
+        samples.append(time.perf_counter() - start)
+        assert document is not None
+    samples.sort()
+    p50 = statistics.median(samples) * 1e3
+    p99 = samples[max(0, int(len(samples) * 0.99) - 1)] * 1e3
+    print(f"{label:>10}: p50 {p50:9.3f} ms | p99 {p99:9.3f} ms | over {len(samples)} lookups")
+    return p50
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mongo-uri", default=os.getenv("MONGO_URI", "mongodb://localhost:27017"))
+    parser.add_argument("--mongomock", action="store_true", help="Use mongomock instead of a MongoDB server.")
+    parser.add_argument("--documents", type=int, default=1_000_000, help="Number of task documents to insert.")
+    parser.add_argument("--lookups", type=int, default=200, help="Number of status lookups per mode.")
+    parser.add_argument("--scan-lookups", type=int, default=20,
+                        help="Number of lookups without an index, each of which scans the whole collection.")
+    parser.add_argument("--keep", action="store_true", help="Keep the benchmark database afterwards.")
+    args = parser.parse_args()
+
+    if args.mongomock:
+        import mongomock
+        mongodb_logger.MongoClient = mongomock.MongoClient
+    os.environ["MONGO_URI"] = args.mongo_uri
+    os.environ["MONGO_DATABASE_NAME"] = "ToyAgenticFrameworkBenchmark"
+    random.seed(0)
+
+    logger = MongoDBLogger()
+    logger.collection.drop()
+    try:
+        task_ids = _populate(logger, args.documents)
+        print(f"Status lookups on {args.documents} documents:")
+        scan = _measure("full scan", logger.get_task_by_id, task_ids, args.scan_lookups)
+        start = time.perf_counter()
+        logger.ensure_indexes()
+        print(f"Created the indexes in {time.perf_counter() - start:.1f} s.")
+        indexed = _measure("indexed", logger.get_task_by_id, task_ids, args.lookups)
+        projected = _measure("projected", logger.get_task_status, task_ids, args.lookups)
+        print(f"The index makes a lookup {scan / indexed:.0f}x faster, the projection a further "
+              f"{indexed / projected:.1f}x.")
+    finally:
+        if not args.keep:
+            logger.client.drop_database(logger.database_name)
+        logger.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+"""
+Measures the per-task overhead of the worker before and after the per-process runtime.
+
+'cold' reproduces the old behaviour of `execute_agent_framework`, i.e. a new MongoDBLogger (and MongoClient), a new
+ChatOpenAI client and a freshly compiled graph on every task. 'warm' builds those once and reuses them, which is what a
+worker process now does after `worker_process_init`. In both cases the graph is run without an LLM and the logger's
+writes are no-ops, so the numbers isolate the setup cost from network I/O.
+
+Usage:
+    python -m benchmarks.bench_worker_runtime --tasks 200
+"""
+import argparse
+import contextlib
+import io
+import os
+import statistics
+import time
+import uuid
+
+# the clients below only need syntactically valid settings since no request is ever sent
+os.environ.setdefault("MONGO_URI", "mongodb://localhost:27017")
+os.environ.setdefault("OPENAI_API_KEY", "sk-benchmark")
+
+from langchain_openai import ChatOpenAI
+from langgraph.checkpoint.memory import InMemorySaver
+from core import build_graph, MongoDBLogger
+from worker import runtime as worker_runtime
+from typing import *
+
+class _NullWriteLogger(MongoDBLogger):
+    """ MongoDBLogger which still opens a MongoClient on construction but never writes to the database. """
+    def log_task_start(self, task_id: str, prompt_content: str) -> None:
+        pass
+
+    def log_task_end(self, task_id: str, final_state: Dict[str, Any], final_status: Optional[str] = "Completed") -> None:
+        pass
+
+    def log_step(self, task_id: str, node_name: str, updates: Dict[str, Any]) -> None:
+        pass
+
+def _run_cold(prompt: str) -> float:
+    """ Runs one task the way the worker did before, returning the elapsed seconds. """
+    start = time.perf_counter()
+    task_id = str(uuid.uuid4())
+    logger = _NullWriteLogger()
+    _ = ChatOpenAI(model=worker_runtime.GPT_MODEL)
+    app = build_graph(logger, None)
+    app.invoke({"prompt_content": prompt, "task_id": task_id}, {"configurable": {"thread_id": task_id}})
+    elapsed = time.perf_counter() - start
+    logger.close()
+    return elapsed
+
+def _run_warm(runtime: worker_runtime.WorkerRuntime, prompt: str) -> float:
+    """ Runs one task against an already built runtime, returning the elapsed seconds. """
+    start = time.perf_counter()
+    task_id = str(uuid.uuid4())
+    runtime.app.invoke({"prompt_content": prompt, "task_id": task_id}, {"configurable": {"thread_id": task_id}})
+    runtime.release_thread(task_id)
+    return time.perf_counter() - start
+
+def _summarize(label: str, samples: List[float]) -> float:
+    mean_ms = statistics.mean(samples) * 1e3
+    p50_ms = statistics.median(samples) * 1e3
+    p99_ms = sorted(samples)[max(0, int(len(samples) * 0.99) - 1)] * 1e3
+    print(f"{label:>5}: mean {mean_ms:8.3f} ms | p50 {p50_ms:8.3f} ms | p99 {p99_ms:8.3f} ms")
+    return mean_ms
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tasks", type=int, default=200, help="Number of tasks to run per mode.")
+    args = parser.parse_args()
+
+    prompt = "Write a short blog post about learning mechanical engineering at university."
+
+    # the graph nodes print their progress; keep the benchmark output readable
+    with contextlib.redirect_stdout(io.StringIO()):
+        runtime = worker_runtime.WorkerRuntime(use_llm=True)
+        # swap in the non-writing logger, an in-memory checkpointer and an LLM-free graph
+        runtime.logger.close()
+        runtime.logger = _NullWriteLogger()
+        runtime.checkpointer = InMemorySaver()
+        runtime.app = build_graph(runtime.logger, None, checkpointer=runtime.checkpointer)
+        cold = [_run_cold(prompt) for _ in range(args.tasks)]
+        warm = [_run_warm(runtime, prompt) for _ in range(args.tasks)]
+        runtime.close()
+
+    print(f"Per-task latency over {args.tasks} tasks (no LLM, no database writes):")
+    cold_mean = _summarize("cold", cold)
+    warm_mean = _summarize("warm", warm)
+    print(f"Per-task setup overhead removed: {cold_mean - warm_mean:.3f} ms ({cold_mean / warm_mean:.1f}x faster)")
+
+if __name__ == '__main__':
+    main()
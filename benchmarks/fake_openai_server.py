@@ -0,0 +1,216 @@
+"""
+A local stand-in for the OpenAI chat completions API, to exercise the LLM governor (see `core.llm_governor`) without
+spending tokens: the clients are pointed at it with $OPENAI_BASE_URL, e.g. 'http://localhost:8900/v1'.
+
+It answers `POST /v1/chat/completions`, streamed or not, after --latency seconds plus --completion-tokens tokens at
+--tokens-per-second, and --slow-fraction of the requests take --slow-latency seconds more, to give the latencies the
+long tail which hedging cuts. Like the real API, it enforces a requests and a tokens per minute limit (--rpm and --tpm,
+over a sliding minute, or over --window seconds to speed up tests) by answering 429 with a `Retry-After` header, and
+--error-rate of the requests fail with a 500.
+Structured output requests (a `json_schema` response format, or a forced tool call) are answered with an object of
+placeholder values shaped after the schema. `GET /stats` returns the number of requests it answered, by status.
+
+Usage:
+    python -m benchmarks.fake_openai_server --port 8900 --rpm 120 --slow-fraction 0.05 --slow-latency 5
+"""
+import argparse
+import json
+import math
+import random
+import threading
+import time
+import uuid
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import *
+
+def _placeholder(schema: Dict[str, Any], definitions: Dict[str, Any]) -> Any:
+    """ A value valid against a (simple) JSON schema: the first enum value, an empty list, a placeholder string, ... """
+    if "$ref" in schema:
+        schema = definitions.get(schema["$ref"].rsplit("/", 1)[-1], {})
+    if "enum" in schema:
+        return schema["enum"][0]
+    if "anyOf" in schema:
+        return _placeholder(schema["anyOf"][0], definitions)
+    kind = schema.get("type", "object")
+    if kind == "object":
+        return {name: _placeholder(prop, definitions) for name, prop in schema.get("properties", {}).items()}
+    return {"array": [], "string": "fake", "integer": 0, "number": 0.0, "boolean": False, "null": None}.get(kind)
+
+class FakeOpenAI:
+    """ The settings and the rate limit windows of the server, shared by its request handlers. """
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.lock = threading.Lock()
+        self.requests: Deque[float] = deque()
+        self.tokens: Deque[Tuple[float, int]] = deque()
+        self.stats: Dict[str, int] = {}
+
+    def count(self, status: int) -> None:
+        with self.lock:
+            self.stats[str(status)] = self.stats.get(str(status), 0) + 1
+
+    def admit(self, tokens: int) -> Optional[float]:
+        """ Takes a request from the limits, or returns the seconds until they would admit it. """
+        window = self.args.window
+        with self.lock:
+            now = time.monotonic()
+            while self.requests and self.requests[0] <= now - window:
+                self.requests.popleft()
+            while self.tokens and self.tokens[0][0] <= now - window:
+                self.tokens.popleft()
+            if self.args.rpm and len(self.requests) >= self.args.rpm:
+                return self.requests[0] + window - now
+            if self.args.tpm and sum(used for _, used in self.tokens) + tokens > self.args.tpm:
+                return (self.tokens[0][0] + window - now) if self.tokens else window
+            self.requests.append(now)
+            self.tokens.append((now, tokens))
+            return None
+
+class Handler(BaseHTTPRequestHandler):
+    server: ThreadingHTTPServer
+    protocol_version = "HTTP/1.1"
+
+    @property
+    def fake(self) -> FakeOpenAI:
+        return self.server.fake
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+    def _json(self, status: int, body: Dict[str, Any], headers: Optional[Dict[str, str]] = None) -> None:
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+        self.fake.count(status)
+
+    def do_GET(self) -> None:
+        if self.path.rstrip("/").endswith("/stats"):
+            with self.fake.lock:
+                stats = dict(self.fake.stats)
+            self._json(200, stats)
+        else:
+            self._json(404, {"error": {"message": "Not found."}})
+
+    def do_POST(self) -> None:
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self._json(404, {"error": {"message": "Not found."}})
+            return
+        args = self.fake.args
+        prompt_tokens = sum(len(str(message.get("content", ""))) for message in request.get("messages", [])) // 4
+        completion_tokens = max(1, int(random.expovariate(1 / args.completion_tokens)))
+        retry_after = self.fake.admit(prompt_tokens + completion_tokens)
+        if retry_after is not None:
+            self._json(429, {"error": {"message": "Rate limit reached.", "type": "requests",
+                                       "code": "rate_limit_exceeded"}},
+                       # rounded up, so that a retry after the delay is admitted
+                       {"Retry-After": f"{max(math.ceil(retry_after * 100) / 100, 0.1):.2f}"})
+            return
+        if random.random() < args.error_rate:
+            self._json(500, {"error": {"message": "The server had an error.", "type": "server_error"}})
+            return
+
+        latency = args.latency + (args.slow_latency if random.random() < args.slow_fraction else 0.0)
+        time.sleep(latency)
+        content, tool_calls = self._answer(request, completion_tokens)
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                 "total_tokens": prompt_tokens + completion_tokens}
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        if request.get("stream"):
+            self._stream(completion_id, request, content, tool_calls, usage)
+            return
+        time.sleep(completion_tokens / args.tokens_per_second if args.tokens_per_second else 0.0)
+        message = {"role": "assistant", "content": None if tool_calls else content}
+        if tool_calls:
+            message["tool_calls"] = tool_calls
+        self._json(200, {"id": completion_id, "object": "chat.completion", "created": int(time.time()),
+                         "model": request.get("model"), "usage": usage,
+                         "choices": [{"index": 0, "message": message,
+                                      "finish_reason": "tool_calls" if tool_calls else "stop"}]})
+
+    def _answer(self, request: Dict[str, Any], completion_tokens: int) -> Tuple[str, Optional[List[Dict[str, Any]]]]:
+        """ The content of the answer, or its tool calls if the request forces one. """
+        response_format = request.get("response_format") or {}
+        if response_format.get("type") == "json_schema":
+            schema = response_format["json_schema"].get("schema", {})
+            return json.dumps(_placeholder(schema, schema.get("$defs", {}))), None
+        tool_choice = request.get("tool_choice")
+        if request.get("tools") and tool_choice not in (None, "none", "auto"):
+            name = tool_choice.get("function", {}).get("name") if isinstance(tool_choice, dict) else None
+            tool = next((tool for tool in request["tools"] if tool["function"]["name"] == name), request["tools"][0])
+            schema = tool["function"].get("parameters", {})
+            return "", [{"id": f"call_{uuid.uuid4().hex[:24]}", "type": "function",
+                         "function": {"name": tool["function"]["name"],
+                                      "arguments": json.dumps(_placeholder(schema, schema.get("$defs", {})))}}]
+        return " ".join("token" for _ in range(completion_tokens)), None
+
+    def _stream(self, completion_id: str, request: Dict[str, Any], content: str,
+                tool_calls: Optional[List[Dict[str, Any]]], usage: Dict[str, int]) -> None:
+        """ Streams the answer as server-sent events, one word at a time at the configured token rate. """
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        base = {"id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()),
+                "model": request.get("model")}
+
+        def send(choices: List[Dict[str, Any]], **extra) -> None:
+            self.wfile.write(f"data: {json.dumps({**base, 'choices': choices, **extra})}\n\n".encode())
+            self.wfile.flush()
+
+        delay = 1 / self.fake.args.tokens_per_second if self.fake.args.tokens_per_second else 0.0
+        if tool_calls:
+            send([{"index": 0, "delta": {"role": "assistant", "tool_calls": [{"index": 0, **tool_calls[0]}]},
+                   "finish_reason": None}])
+        else:
+            for i, word in enumerate(content.split(" ")):
+                time.sleep(delay)
+                send([{"index": 0, "delta": {"role": "assistant", "content": word if i == 0 else f" {word}"},
+                       "finish_reason": None}])
+        send([{"index": 0, "delta": {}, "finish_reason": "tool_calls" if tool_calls else "stop"}])
+        if (request.get("stream_options") or {}).get("include_usage"):
+            send([], usage=usage)
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.fake.count(200)
+
+def serve(args: argparse.Namespace) -> ThreadingHTTPServer:
+    """ Starts the server on a background thread, returning it (`shutdown()` stops it). """
+    server = ThreadingHTTPServer((args.host, args.port), Handler)
+    server.daemon_threads = True
+    server.fake = FakeOpenAI(args)
+    threading.Thread(target=server.serve_forever, name="fake-openai", daemon=True).start()
+    return server
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8900)
+    parser.add_argument("--latency", type=float, default=0.3, help="Seconds before the first token.")
+    parser.add_argument("--tokens-per-second", type=float, default=200.0, help="Token rate, 0 for instant completions.")
+    parser.add_argument("--completion-tokens", type=int, default=50, help="Mean completion length.")
+    parser.add_argument("--slow-fraction", type=float, default=0.0, help="Fraction of the requests which are slow.")
+    parser.add_argument("--slow-latency", type=float, default=5.0, help="Extra seconds a slow request takes.")
+    parser.add_argument("--rpm", type=int, default=0, help="Requests per minute before answering 429, 0 for none.")
+    parser.add_argument("--tpm", type=int, default=0, help="Tokens per minute before answering 429, 0 for none.")
+    parser.add_argument("--window", type=float, default=60.0, help="Seconds the --rpm and --tpm limits apply over.")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of the requests failing with a 500.")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    add_arguments(parser)
+    args = parser.parse_args()
+    server = serve(args)
+    print(f"Fake OpenAI API listening on http://{args.host}:{args.port}/v1")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+if __name__ == '__main__':
+    main()
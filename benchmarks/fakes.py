@@ -0,0 +1,218 @@
+"""
+In-process stand-ins for the external services of the agent, so that the graph and the worker task can be benchmarked
+offline and deterministically:
+* `FakeChatModel`, a chat model whose latency is a time to first token plus the time to generate its completion at a
+  given token rate, and which routes every prompt by its keywords,
+* `InMemoryLogger`, a `MongoDBLogger` which keeps the task documents in a dictionary,
+* `InMemoryMetrics`, a `MetricsRecorder` which keeps the raw samples in memory rather than bucketing them in Redis.
+The web search is `core.search_service.StubSearchBackend`, and Celery runs the tasks eagerly (see `bench_graph`).
+"""
+import asyncio
+import hashlib
+import re
+import threading
+import time
+from langchain_core.messages import AIMessage, AIMessageChunk
+from core.log_schemas import TaskLogEndUpdate, TaskLogEntry, TaskStep
+from core.instrumentation import current_node_metrics
+from core.metrics import MetricsRecorder
+from core.mongodb_logger import MongoDBLogger, QUEUED_STATUS, WRITE_THROUGH
+from typing import *
+
+# keywords of the routes, checked in order, the 'general' route taking every other prompt
+_ROUTE_KEYWORDS: Tuple[Tuple[str, re.Pattern], ...] = (
+    ("code", re.compile(r"\b(code|function|python|script|bug|implement|class|sql|regex)\b", re.I)),
+    ("summarize", re.compile(r"\b(summari[sz]e|summary|tl;?dr|condense)\b", re.I)),
+    ("content", re.compile(r"\b(blog|article|write|essay|post|newsletter)\b", re.I)),
+)
+_WORDS = ("agent", "graph", "latency", "token", "model", "route", "worker", "queue", "cache", "search", "answer",
+          "prompt", "thread", "state", "node", "result")
+
+def fake_route(prompt: str) -> str:
+    """ The route the fake router picks for a prompt, by its keywords. """
+    for route, pattern in _ROUTE_KEYWORDS:
+        if pattern.search(prompt):
+            return route
+    return "general"
+
+class FakeChatModel:
+    """
+    Stands in for `ChatOpenAI`. A call waits `ttft` seconds, then generates its completion at `tokens_per_second`
+    (streamed chunk by chunk through `stream`/`astream`). The completion and its length only depend on the prompt, so
+    a replay makes the same calls with the same latencies. The router's structured output classifies the user prompt
+    by its keywords.
+    """
+    def __init__(self, ttft: float = 0.3, tokens_per_second: float = 80.0, completion_tokens: int = 150,
+                 model_name: str = "gpt-4.1"):
+        """
+        :param ttft:                Seconds before the first token.
+        :param tokens_per_second:   Generation rate of the completion, 0 to generate it instantly.
+        :param completion_tokens:   Mean completion length, each prompt getting between half and 1.5 times as many.
+        :param model_name:          The model reported on the calls, which prices them.
+        """
+        self.ttft = ttft
+        self.tokens_per_second = tokens_per_second
+        self.completion_tokens = completion_tokens
+        self.model_name = model_name
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def _plan(self, prompt: Any) -> Tuple[List[str], Dict[str, int]]:
+        """ The words of the completion of a prompt, and the usage reported with it. """
+        with self._lock:
+            self.calls += 1
+        text = str(prompt)
+        seed = int.from_bytes(hashlib.blake2b(text.encode(), digest_size=8).digest(), "little")
+        length = max(1, self.completion_tokens // 2 + seed % (self.completion_tokens + 1))
+        words = [_WORDS[(seed >> (i % 48)) % len(_WORDS)] for i in range(length)]
+        prompt_tokens = max(1, len(text) // 4)
+        return words, {"input_tokens": prompt_tokens, "output_tokens": length, "total_tokens": prompt_tokens + length}
+
+    def _generation_time(self, tokens: int) -> float:
+        return tokens / self.tokens_per_second if self.tokens_per_second > 0 else 0.0
+
+    def invoke(self, prompt: Any, *args, **kwargs) -> AIMessage:
+        words, usage = self._plan(prompt)
+        time.sleep(self.ttft + self._generation_time(len(words)))
+        return AIMessage(content=" ".join(words), usage_metadata=usage)
+
+    async def ainvoke(self, prompt: Any, *args, **kwargs) -> AIMessage:
+        words, usage = self._plan(prompt)
+        await asyncio.sleep(self.ttft + self._generation_time(len(words)))
+        return AIMessage(content=" ".join(words), usage_metadata=usage)
+
+    def stream(self, prompt: Any, *args, **kwargs) -> Iterator[AIMessageChunk]:
+        words, usage = self._plan(prompt)
+        time.sleep(self.ttft)
+        for i, word in enumerate(words):
+            yield AIMessageChunk(content=word if i == 0 else f" {word}")
+            time.sleep(self._generation_time(1))
+        # as with `stream_usage`, the usage arrives on a last, empty chunk
+        yield AIMessageChunk(content="", usage_metadata=usage)
+
+    async def astream(self, prompt: Any, *args, **kwargs) -> AsyncIterator[AIMessageChunk]:
+        words, usage = self._plan(prompt)
+        await asyncio.sleep(self.ttft)
+        for i, word in enumerate(words):
+            yield AIMessageChunk(content=word if i == 0 else f" {word}")
+            await asyncio.sleep(self._generation_time(1))
+        yield AIMessageChunk(content="", usage_metadata=usage)
+
+    def with_structured_output(self, schema: Any, include_raw: bool = False, **kwargs) -> Any:
+        llm = self
+
+        class _Structured:
+            """ The router: a short completion, parsed into the route of the user prompt it classifies. """
+            @staticmethod
+            def _output(prompt: Any, message: AIMessage) -> Dict[str, Any]:
+                parsed = {"task": fake_route(str(prompt)), "choice_summary": "routed by the fake model's keywords"}
+                return {"raw": message, "parsed": parsed, "parsing_error": None} if include_raw else parsed
+
+            def invoke(self, prompt: Any, *args, **kwargs) -> Any:
+                _, usage = llm._plan(prompt)
+                time.sleep(llm.ttft + llm._generation_time(8))
+                return self._output(prompt, AIMessage(content="", usage_metadata={**usage, "output_tokens": 8}))
+
+            async def ainvoke(self, prompt: Any, *args, **kwargs) -> Any:
+                _, usage = llm._plan(prompt)
+                await asyncio.sleep(llm.ttft + llm._generation_time(8))
+                return self._output(prompt, AIMessage(content="", usage_metadata={**usage, "output_tokens": 8}))
+
+        return _Structured()
+
+class InMemoryLogger(MongoDBLogger):
+    """ `MongoDBLogger` keeping the task documents in a dictionary, with the same schemas, instead of in MongoDB. """
+    def __init__(self):
+        # no MongoClient, publisher or status records, see `MongoDBLogger.__init__`
+        self.mode = WRITE_THROUGH
+        self.publisher = None
+        self.status_cache = None
+        self.documents: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+
+    def ensure_indexes(self) -> None:
+        pass
+
+    def _insert(self, entry: TaskLogEntry) -> None:
+        with self._lock:
+            self.documents[entry.task_id] = entry.model_dump(by_alias=True, exclude_none=True)
+
+    def _set(self, task_id: str, fields: Dict[str, Any]) -> None:
+        with self._lock:
+            self.documents.setdefault(task_id, {"task_id": task_id}).update(fields)
+
+    def log_task_start(self, task_id: str, prompt_content: str, thread_id: Optional[str] = None) -> None:
+        self._insert(TaskLogEntry(task_id=task_id, prompt=prompt_content, thread_id=thread_id))
+
+    def log_tasks_queued(self, tasks: Sequence[Tuple[str, str]], batch_id: Optional[str] = None) -> None:
+        for task_id, prompt_content in tasks:
+            self._insert(TaskLogEntry(task_id=task_id, prompt=prompt_content, status=QUEUED_STATUS,
+                                      current_event="QUEUED", batch_id=batch_id))
+
+    def log_task_queued(self, task_id: str, prompt_content: str, thread_id: Optional[str] = None) -> None:
+        self._insert(TaskLogEntry(task_id=task_id, prompt=prompt_content, status=QUEUED_STATUS,
+                                  current_event="QUEUED", thread_id=thread_id))
+
+    def log_task_coalesced(self, task_id: str, leader_task_id: str) -> None:
+        self._set(task_id, {"coalesced_with": leader_task_id})
+
+    def log_task_running(self, task_id: str) -> None:
+        self._set(task_id, {"status": TaskLogEntry.model_fields["status"].default, "current_event": "START"})
+
+    def log_task_end(self, task_id: str, final_state: Dict[str, Any], final_status: Optional[str] = "Completed",
+                     time_to_first_token: Optional[float] = None, cache_hit: Optional[bool] = None) -> None:
+        self._set(task_id, TaskLogEndUpdate(
+            final_response=getattr(final_state['response'], 'content', final_state['response']),
+            task=final_state['task_classification']['task'],
+            task_choice_summary=final_state['task_classification']['choice_summary'],
+            search_results=final_state.get('search_results') or [],
+            search_query=final_state.get('search_query') or "n/a",
+            status=final_status,
+            time_to_first_token_ms=None if time_to_first_token is None else round(time_to_first_token * 1e3, 3),
+            cache_hit=cache_hit,
+        ).model_dump(exclude_none=True))
+
+    def log_step(self, task_id: str, node_name: str, updates: Dict[str, Any]) -> None:
+        metrics = current_node_metrics()
+        step = TaskStep(node=node_name, **(metrics.step_fields() if metrics is not None else {}))
+        with self._lock:
+            self.documents.setdefault(task_id, {"task_id": task_id}).setdefault("trajectory", []).append(
+                step.model_dump(exclude_none=True))
+
+    def get_task_by_id(self, task_id: str) -> Optional[Dict[str, Any]]:
+        return self.documents.get(task_id)
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+class InMemoryMetrics(MetricsRecorder):
+    """ `MetricsRecorder` keeping every raw sample, by metric name and label set, for exact percentiles. """
+    def __init__(self):
+        self.samples: Dict[str, List[Tuple[Dict[str, str], float]]] = {}
+        self.counters: Dict[str, Dict[Tuple[Tuple[str, str], ...], float]] = {}
+        self._lock = threading.Lock()
+
+    def observe_many(self, samples: Iterable[Tuple[str, float, Dict[str, str]]]) -> None:
+        with self._lock:
+            for name, value, labels in samples:
+                self.samples.setdefault(name, []).append((labels, value))
+
+    def inc_many(self, increments: Iterable[Tuple[str, Dict[str, str], float]]) -> None:
+        with self._lock:
+            for name, labels, amount in increments:
+                counter = self.counters.setdefault(name, {})
+                key = tuple(sorted(labels.items()))
+                counter[key] = counter.get(key, 0.0) + amount
+
+    def values(self, name: str, label: Optional[str] = None) -> Dict[str, List[float]]:
+        """ The samples of a metric grouped by the value of one of their labels (all together if None). """
+        grouped: Dict[str, List[float]] = {}
+        for labels, value in self.samples.get(name, []):
+            grouped.setdefault(labels.get(label, "all") if label else "all", []).append(value)
+        return grouped
+
+    def render(self) -> str:
+        raise NotImplementedError("The in-memory metrics are read with `values`.")
@@ -0,0 +1,15 @@
+"""
+Summary statistics shared by the benchmarks.
+"""
+import math
+from typing import *
+
+def percentiles(values: Sequence[float]) -> Dict[str, float]:
+    """ The count, mean and nearest-rank p50/p95/p99 of latencies in seconds, reported in milliseconds. """
+    if not values:
+        return {"count": 0}
+    ordered = sorted(values)
+    rank = lambda q: ordered[max(0, math.ceil(q * len(ordered)) - 1)]
+    return {"count": len(ordered), "mean_ms": round(sum(ordered) / len(ordered) * 1e3, 2),
+            "p50_ms": round(rank(0.50) * 1e3, 2), "p95_ms": round(rank(0.95) * 1e3, 2),
+            "p99_ms": round(rank(0.99) * 1e3, 2)}
@@ -1,5 +1,14 @@
-from .agent_graph import build_graph, display_graph
 from .mongodb_logger import MongoDBLogger
 from .env_utils import doublecheck_env
 # specifies what to import when user writes 'from core import *'.
-__all__ = ["build_graph", "display_graph", "MongoDBLogger", "doublecheck_env"]
\ No newline at end of file
+__all__ = ["build_graph", "display_graph", "MongoDBLogger", "doublecheck_env"]
+
+def __getattr__(name: str):
+    """
+    Imports the graph on first use. It pulls in LangChain, LangGraph and the LLM and search clients, which the
+    processes that only log or enqueue tasks (e.g. the API) never need.
+    """
+    if name in ("build_graph", "display_graph"):
+        from . import agent_graph
+        return getattr(agent_graph, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
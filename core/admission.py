@@ -0,0 +1,210 @@
+import os
+import math
+import redis
+from typing import *
+
+_KEY_PREFIX = "admission"
+# the limits of a route, 0 meaning unlimited: the per-client token bucket refills at `rate` requests per second up to
+# `burst` requests, and the route stops admitting tasks once the broker queues hold `max_queue_depth` tasks or
+# `max_in_flight` admitted tasks have not finished
+LIMIT_FIELDS: Tuple[str, ...] = ("rate", "burst", "max_queue_depth", "max_in_flight")
+# the API routes which enqueue tasks, as named in $ADMISSION_ROUTE_LIMITS
+ROUTES: Tuple[str, ...] = ("execute", "execute_batch")
+# Redis lists a broker queue is made of: the Redis transport keeps the tasks of every priority step but the first in a
+# list of their own (see the route queues of `worker.client`), named after the queue and the step
+_PRIORITY_SUFFIXES: Tuple[str, ...] = ("", "\x06\x163", "\x06\x166", "\x06\x169")
+
+# Checks the limits of a route and, if they all pass, takes the request's cost from the client's token bucket and
+# registers its tasks as in flight. Running as one script, concurrent requests across every API process cannot
+# overshoot a limit together. The clock is the server's, shared by every API process.
+# KEYS[1]: in-flight tasks (scored by admission time), KEYS[2]: token bucket of the client, KEYS[3..]: the lists of
+# the broker queues.
+# ARGV: max in flight, max queue depth, rate, burst, tasks, tokens, in-flight TTL, task IDs...
+# Returns: {verdict ('ok', 'queue_depth', 'in_flight' or 'quota'), seconds until the quota admits it, depth, in flight}
+_ADMIT_SCRIPT = """
+local now = redis.call('TIME')
+now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+local max_in_flight, max_depth = tonumber(ARGV[1]), tonumber(ARGV[2])
+local rate, burst = tonumber(ARGV[3]), tonumber(ARGV[4])
+local cost, tokens_cost = tonumber(ARGV[5]), tonumber(ARGV[6])
+-- tasks whose worker never released them (e.g. lost with their worker) stop counting after the TTL
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now - tonumber(ARGV[7]))
+local in_flight = redis.call('ZCARD', KEYS[1])
+local depth = 0
+for i = 3, #KEYS do
+    depth = depth + redis.call('LLEN', KEYS[i])
+end
+if max_depth > 0 and depth + cost > max_depth then
+    return {'queue_depth', '0', depth, in_flight}
+end
+if max_in_flight > 0 and in_flight + cost > max_in_flight then
+    return {'in_flight', '0', depth, in_flight}
+end
+if rate > 0 then
+    local bucket = redis.call('HMGET', KEYS[2], 'tokens', 'ts')
+    local tokens = tonumber(bucket[1]) or burst
+    local elapsed = math.max(0, now - (tonumber(bucket[2]) or now))
+    tokens = math.min(burst, tokens + elapsed * rate)
+    if tokens < tokens_cost then
+        return {'quota', tostring((tokens_cost - tokens) / rate), depth, in_flight}
+    end
+    redis.call('HSET', KEYS[2], 'tokens', tostring(tokens - tokens_cost), 'ts', tostring(now))
+    redis.call('EXPIRE', KEYS[2], math.ceil(burst / rate) + 1)
+end
+for i = 8, #ARGV do
+    redis.call('ZADD', KEYS[1], now, ARGV[i])
+end
+return {'ok', '0', depth, in_flight + #ARGV - 7}
+"""
+
+class AdmissionRejected(Exception):
+    """ A request was refused by admission control, and may be retried after `retry_after` seconds. """
+    def __init__(self, reason: str, retry_after: int, message: str):
+        super().__init__(message)
+        self.reason = reason
+        self.retry_after = retry_after
+
+def parse_route_limits(spec: str) -> Dict[str, Dict[str, float]]:
+    """ Parses a 'route.limit=value,...' override, e.g. 'execute.rate=2,execute_batch.max_queue_depth=5000'. """
+    limits: Dict[str, Dict[str, float]] = {}
+    for item in spec.split(","):
+        if not item.strip():
+            continue
+        name, sep, value = item.partition("=")
+        route, dot, field = name.strip().partition(".")
+        if not sep or not dot or route not in ROUTES or field not in LIMIT_FIELDS:
+            raise ValueError(f"Invalid admission limit '{item}', expected 'route.limit=value' with a route among "
+                             f"{', '.join(ROUTES)} and a limit among {', '.join(LIMIT_FIELDS)}.")
+        limits.setdefault(route, {})[field] = float(value)
+    return limits
+
+class AdmissionController:
+    """
+    Keeps a burst of requests from growing the broker's queue without bound. Before a route enqueues tasks, it checks:
+    * the depth of the broker queues the workers consume,
+    * the number of tasks admitted which have not finished yet, which the API registers and the workers release,
+    * a token bucket per client, refilled at a steady rate up to a burst.
+    A request over any limit is refused with the number of seconds after which to retry it, and enqueues nothing. The
+    state lives in Redis, so the limits hold across every API process.
+    """
+    def __init__(self, redis_url: Optional[str] = None, limits: Optional[Dict[str, Dict[str, float]]] = None,
+                 queues: Optional[Sequence[str]] = None, retry_after: Optional[int] = None,
+                 in_flight_ttl: Optional[int] = None):
+        """
+        :param redis_url:       Defaults to $REDIS_URL.
+        :param limits:          The limits of every route of `ROUTES` ({limit: value} for the fields of
+                                `LIMIT_FIELDS`). Defaults to $ADMISSION_RATE, $ADMISSION_BURST,
+                                $ADMISSION_MAX_QUEUE_DEPTH and $ADMISSION_MAX_IN_FLIGHT for every route (all 0, i.e.
+                                unlimited, if not set), overridden per route by $ADMISSION_ROUTE_LIMITS.
+        :param queues:          The broker queues whose depth is checked. Defaults to $ADMISSION_QUEUES or 'celery'.
+                                With the route queues of the workers, these are the queues the tasks first land in
+                                ('classify') or all of them.
+        :param retry_after:     Seconds a client is told to wait when the queue or the tasks in flight are full.
+                                Defaults to $ADMISSION_RETRY_AFTER_SECONDS or 5.
+        :param in_flight_ttl:   Seconds after which an admitted task no longer counts as in flight, in case its worker
+                                never released it. Defaults to $ADMISSION_IN_FLIGHT_TTL_SECONDS or 1 hour.
+        """
+        redis_url = redis_url or os.getenv("REDIS_URL")
+        if not redis_url:
+            raise ValueError("REDIS_URL environment variable not set.")
+        self.redis = redis.Redis.from_url(redis_url, decode_responses=True)
+        if limits is None:
+            defaults = {field: float(os.getenv(f"ADMISSION_{field.upper()}", "0")) for field in LIMIT_FIELDS}
+            overrides = parse_route_limits(os.getenv("ADMISSION_ROUTE_LIMITS", ""))
+            limits = {route: {**defaults, **overrides.get(route, {})} for route in ROUTES}
+        for route, route_limits in limits.items():
+            if route_limits.get("rate", 0) > 0 and route_limits.get("burst", 0) <= 0:
+                # a bucket without a burst would never hold a whole token
+                route_limits["burst"] = max(1.0, route_limits["rate"])
+        self.limits = limits
+        self.queues = list(queues or [queue.strip() for queue in os.getenv("ADMISSION_QUEUES", "celery").split(",")
+                                      if queue.strip()])
+        self.retry_after = retry_after or int(os.getenv("ADMISSION_RETRY_AFTER_SECONDS", "5"))
+        self.in_flight_ttl = in_flight_ttl or int(os.getenv("ADMISSION_IN_FLIGHT_TTL_SECONDS", "3600"))
+        self._admit = self.redis.register_script(_ADMIT_SCRIPT)
+
+    @property
+    def enabled(self) -> bool:
+        """ Whether any route has a limit. """
+        return any(value > 0 for route_limits in self.limits.values() for value in route_limits.values())
+
+    @property
+    def tracks_in_flight(self) -> bool:
+        """ Whether the tasks in flight are counted, which the workers must then release (see `release`). """
+        return any(route_limits.get("max_in_flight", 0) > 0 for route_limits in self.limits.values())
+
+    def admit(self, route: str, client_id: str, task_ids: Sequence[str] = (), cost: Optional[int] = None) -> None:
+        """
+        Admits a request or refuses it. An admitted request's tasks count as in flight until `release`d.
+        :param route:       The API route, one of `ROUTES`.
+        :param client_id:   The client the quota is kept per.
+        :param task_ids:    The IDs of the tasks the request enqueues, if known before they are enqueued (else `track`
+                            them once they are).
+        :param cost:        The number of tasks the request enqueues. Defaults to the number of `task_ids`, or 1.
+        :raises AdmissionRejected: A limit is reached.
+        """
+        route_limits = self.limits.get(route, {})
+        if not any(value > 0 for value in route_limits.values()):
+            # the route is not limited, but its tasks still take the slots of the routes which limit the tasks in flight
+            self.track(task_ids)
+            return
+        cost = cost or len(task_ids) or 1
+        rate, burst = route_limits.get("rate", 0), route_limits.get("burst", 0)
+        try:
+            verdict, wait, depth, in_flight = self._admit(
+                keys=[f"{_KEY_PREFIX}:in_flight", f"{_KEY_PREFIX}:bucket:{route}:{client_id}",
+                      *(queue + suffix for queue in self.queues for suffix in _PRIORITY_SUFFIXES)],
+                # a request costing more than the burst empties the bucket rather than being refused forever
+                args=[route_limits.get("max_in_flight", 0), route_limits.get("max_queue_depth", 0), rate, burst,
+                      cost, min(cost, burst), self.in_flight_ttl,
+                      *(task_ids if self.tracks_in_flight else ())])
+        except redis.RedisError as e:
+            # admission control must not take the API down with Redis, the enqueue fails on its own if the broker is
+            print(f"Failed to check the admission of a request to '{route}', admitting it. Error: \n{e}")
+            return
+        if verdict == "quota":
+            raise AdmissionRejected(verdict, max(1, math.ceil(float(wait))),
+                                    f"Rate limit of {rate:g} tasks per second exceeded for this client.")
+        if verdict == "queue_depth":
+            raise AdmissionRejected(verdict, self.retry_after,
+                                    f"The task queue is full ({depth} tasks queued), retry later.")
+        if verdict == "in_flight":
+            raise AdmissionRejected(verdict, self.retry_after,
+                                    f"Too many tasks in flight ({in_flight} tasks), retry later.")
+
+    def track(self, task_ids: Sequence[str]) -> None:
+        """ Registers the tasks of an admitted request as in flight, when their IDs were only known once enqueued. """
+        if not self.tracks_in_flight or not task_ids:
+            return
+        try:
+            seconds, microseconds = self.redis.time()
+            score = seconds + microseconds / 1e6
+            self.redis.zadd(f"{_KEY_PREFIX}:in_flight", {task_id: score for task_id in task_ids})
+        except redis.RedisError as e:
+            print(f"Failed to register {len(task_ids)} tasks as in flight. Error: \n{e}")
+
+    def release(self, task_id: str) -> None:
+        """ Unregisters a task which finished (or will never run), freeing its slot. Redis errors never fail a task. """
+        if not self.tracks_in_flight:
+            return
+        try:
+            self.redis.zrem(f"{_KEY_PREFIX}:in_flight", task_id)
+        except redis.RedisError as e:
+            print(f"Failed to release the in-flight slot of task {task_id}. Error: \n{e}")
+
+    def queue_depths(self) -> Dict[str, int]:
+        """ The number of tasks waiting in every broker queue, at any priority. """
+        pipe = self.redis.pipeline(transaction=False)
+        for queue in self.queues:
+            for suffix in _PRIORITY_SUFFIXES:
+                pipe.llen(queue + suffix)
+        lengths = pipe.execute()
+        step = len(_PRIORITY_SUFFIXES)
+        return {queue: sum(lengths[i * step:(i + 1) * step]) for i, queue in enumerate(self.queues)}
+
+    def in_flight(self) -> int:
+        """ The number of admitted tasks which have not finished yet, if they are tracked. """
+        return self.redis.zcard(f"{_KEY_PREFIX}:in_flight")
+
+    def close(self) -> None:
+        self.redis.close()
@@ -1,22 +1,47 @@
-from PIL import Image
+import asyncio
+import os
 from io import BytesIO
 # LangChain imports
 from langchain_openai import ChatOpenAI
 from langgraph.graph.state import CompiledStateGraph
 from langgraph.types import Command
 from langgraph.graph import END, START, StateGraph
-# for access to the Google search engine
-from langchain_google_community import GoogleSearchAPIWrapper
+# web search shared by every task, with its own cache (the Google search engine is used by default)
+from .search_service import SearchService, load_search_service
+from .page_fetcher import PageFetcher
 # checkpointer for persistence
+from langgraph.checkpoint.base import BaseCheckpointSaver
 from langgraph.checkpoint.memory import InMemorySaver
 # import logger which logs data to MongoDB
 from .mongodb_logger import MongoDBLogger
-
+# per-node timing and token usage instrumentation
+from .instrumentation import (instrument_node, invoke_llm, invoke_structured_llm, ainvoke_llm, ainvoke_structured_llm,
+                              record_search_latency, record_retrieval)
+from .metrics import MetricsRecorder
+from .token_stream import TokenStreamPublisher
+# answers the routing decision locally when it is confident enough
+from .local_classifier import LocalTaskClassifier
+from .response_cache import ResponseCache
+# starts the likely answer while the LLM router is classifying the prompt
+from .speculation import SpeculativeRouter, SPECULATIVE_ROUTES
+# assigns a model to every node
+from .model_registry import ModelRegistry
+# condenses content too long for a single call with a map-reduce
+from .summarizer import Summarizer, load_summarizer
+# retrieves the passages of the indexed documents relevant to the prompt
+from .document_index import DocumentIndex
+
+from functools import partial
 from typing import *
 
 AGENTS: List[str] = ["general", "code", "summarize", "content"]
 T_AGENT = Literal[*AGENTS]
 DEFAULT_TASK: T_AGENT = "general"
+# `choice_summary` of the default route, when no LLM is used or its output could not be parsed
+NO_LLM_CHOICE_SUMMARY = "default choice when no llm is used"
+UNPARSED_CHOICE_SUMMARY = "default choice since the llm output could not be parsed"
+# number of previous turns of a thread kept in its state and given to the agents as context
+CONVERSATION_MAX_TURNS: int = int(os.getenv("CONVERSATION_MAX_TURNS", "10"))
 
 class TaskClassification(TypedDict):
     """
@@ -26,6 +51,16 @@ class TaskClassification(TypedDict):
     task: T_AGENT
     choice_summary: str # Not necessary, but interesting to look into why an LLM chose a certain task
 
+class ConversationTurn(TypedDict):
+    """ One previous exchange of a thread. """
+    prompt: str
+    response: str
+
+def _append_turns(history: Optional[List[ConversationTurn]],
+                  turns: Optional[List[ConversationTurn]]) -> List[ConversationTurn]:
+    """ Reducer of the conversation, which only keeps its most recent CONVERSATION_MAX_TURNS turns. """
+    return ((history or []) + (turns or []))[-CONVERSATION_MAX_TURNS:]
+
 class ToyAgentFrameworkState(TypedDict):
     """
     Class describing the state parameters of the agent.
@@ -34,8 +69,10 @@ class ToyAgentFrameworkState(TypedDict):
     prompt_content: str
     # id of this task
     task_id: str
-    # FIXME: let's optionally support documents in the near future
+    # documents given along with the prompt, which the summarizing agent summarizes as the prompt asks
     documents: List[str]
+    # passages of the indexed documents retrieved for the prompt, given as context to every agent
+    retrieved_passages: List[Dict[str, Any]] | None
 
     # store the classification result which specifies which agent to use
     task_classification: TaskClassification | None
@@ -43,239 +80,580 @@ class ToyAgentFrameworkState(TypedDict):
     # stores the search results that were used to aid with the Content Generation Agent
     search_results: List[Dict[str, Any]] | None
     search_query: str | None
+    # every candidate query that was searched, the first of which is `search_query`
+    search_queries: List[str] | None
+    # extracted text of the search result pages by link, only set when the page fetching stage is enabled
+    page_contents: Dict[str, str] | None
 
     # store the response from the LLM
     response: str
 
-def classify_task(logger: MongoDBLogger, llm: Optional[ChatOpenAI],
-                     state: ToyAgentFrameworkState) -> Command[T_AGENT]:
-    """
-    This task invokes the LLM to figure out which agent it should send the user's request towards.
-    :param logger:
-    :param llm:
-    :param state:   Current state in the graph.
-    :return:        Parameters to update in the state in the graph.
+    # the previous turns of the thread, restored by the checkpointer when a thread ID is reused
+    conversation: Annotated[List[ConversationTurn], _append_turns]
+
+def _with_context(state: ToyAgentFrameworkState, prompt: str) -> str:
+    """ Prefixes a prompt with the passages retrieved for it and the previous turns of the thread, if there are any. """
+    passages = state.get("retrieved_passages") or []
+    turns = state.get("conversation") or []
+    if not passages and not turns:
+        return prompt
+    sections = []
+    if passages:
+        excerpts = "\n\n".join(f"[{passage['doc_id']}]: {passage['text']}" for passage in passages)
+        sections.append(f"---- RELEVANT DOCUMENT PASSAGES (use them if they help with the request) ----\n{excerpts}")
+    if turns:
+        history = "\n".join(f"USER: {turn['prompt']}\nASSISTANT: {turn['response']}" for turn in turns)
+        sections.append(f"---- CONVERSATION SO FAR ----\n{history}")
+    context = "\n".join(sections)
+    return f"""
+    {context}
+    ---- CURRENT REQUEST ----
+    {prompt}
     """
 
-    classification_prompt = f"""
+def _retrieve(state: ToyAgentFrameworkState, retriever: DocumentIndex) -> List[Dict[str, Any]]:
+    """ The passages of the indexed documents most relevant to the prompt. """
+    with record_retrieval() as passages:
+        passages.extend(retriever.search(state['prompt_content']))
+    return passages
+
+def _turn(state: ToyAgentFrameworkState, response: Any) -> List[ConversationTurn]:
+    """ The turn answered by a response, to append to the conversation. """
+    return [{'prompt': state["prompt_content"], 'response': getattr(response, 'content', response)}]
+
+def _classification_prompt(state: ToyAgentFrameworkState) -> str:
+    return f"""
     Analyze the following prompt and determine whether it is a general query or one that can benefit from a coding
     agent, a summarizing agent, or a content generating agent (e.g. write a blog). The classification is limited to 
     the options: ['general', 'code', 'summarize', 'content']. 
     
     {state['prompt_content']}
     """
-    print("We are currently in the classification task!")
-    if llm:
-        # get a structured output of what the task at hand is
-        structured_llm = llm.with_structured_output(TaskClassification)
-        classification = structured_llm.invoke(classification_prompt)
-        goto = classification.get("task", DEFAULT_TASK)
-    else:
-        # by default, use the general llm task
-        classification: TaskClassification = {
+
+def _route(logger: MongoDBLogger, state: ToyAgentFrameworkState,
+           classification: Optional[TaskClassification], parsed: bool = True) -> Command[T_AGENT]:
+    """
+    Logs the classification and routes the graph to its agent.
+    :param state:           Current state in the graph, along with the passages retrieved by the classification.
+    :param classification:  The classification, or None if no LLM was used (`parsed` is True) or its output could
+                            not be parsed (`parsed` is False), in which case the default agent is used.
+    """
+    if classification is None:
+        classification = {
             'task': DEFAULT_TASK,
-            'choice_summary': 'default choice when no llm is used'
+            'choice_summary': NO_LLM_CHOICE_SUMMARY if parsed else UNPARSED_CHOICE_SUMMARY
         }
-        goto=DEFAULT_TASK
     updates = {'task_classification': classification}
+    if 'retrieved_passages' in state:
+        updates['retrieved_passages'] = state['retrieved_passages']
     logger.log_step(state['task_id'], 'task_classification', updates)
     return Command(
         update = updates,
-        goto = goto,
+        goto = _routed_task(classification),
     )
 
-def general_task(logger: MongoDBLogger, llm: Optional[ChatOpenAI],
-                     state: ToyAgentFrameworkState) -> ToyAgentFrameworkState:
+def _routed_task(classification: Optional[TaskClassification]) -> str:
+    return (classification or {}).get("task", DEFAULT_TASK)
+
+def classify_task(logger: MongoDBLogger, llm: Optional[ChatOpenAI],
+                     state: ToyAgentFrameworkState,
+                     classifier: Optional[LocalTaskClassifier] = None,
+                     speculation: Optional[SpeculativeRouter] = None,
+                     answer_llms: Optional[Dict[str, ChatOpenAI]] = None,
+                     retriever: Optional[DocumentIndex] = None) -> Command[T_AGENT]:
     """
-    This task simply acts upon the original query, answering the user's prompt.
+    This task invokes the LLM to figure out which agent it should send the user's request towards.
     :param logger:
     :param llm:
-    :param state:   Current state in the graph.
-    :return:        Parameters to update in the state in the graph.
+    :param state:       Current state in the graph.
+    :param classifier:  Optional local classifier consulted first. The LLM is only invoked when the local
+                        classifier is not confident enough.
+    :param speculation: Optional speculative router, which starts the answer of the predicted route while the LLM
+                        classifies the prompt.
+    :param answer_llms: LLMs of the answering agents by route, for their speculative generation. The router's LLM is
+                        used for the routes which are not given.
+    :param retriever:   Optional document index, whose passages relevant to the prompt are retrieved first so that
+                        every route (and the speculative generation) answers with them.
+    :return:            Parameters to update in the state in the graph.
     """
-    print("We are currently in the general task!")
-    original_prompt = state["prompt_content"]
+    print("We are currently in the classification task!")
+    if retriever is not None:
+        state = {**state, 'retrieved_passages': _retrieve(state, retriever)}
+    local_classification = classifier.classify(state['prompt_content']) if classifier else None
+    if local_classification:
+        # the local classifier is confident, skip the round trip to the LLM
+        return _route(logger, state, local_classification)
     if llm:
-        response = llm.invoke(original_prompt)
-    else:
-        response = "Hi, I am the general task agent!"
+        predicted = speculation.predict(state) if speculation else None
+        if predicted:
+            answer_llm = (answer_llms or {}).get(predicted, llm)
+            speculation.start(state['task_id'], predicted, lambda: invoke_llm(
+                answer_llm, _with_context(state, _ANSWER_PROMPTS[predicted](state))))
+        try:
+            # get a structured output of what the task at hand is
+            classification = invoke_structured_llm(llm, TaskClassification, _classification_prompt(state))
+        except Exception:
+            if predicted:
+                speculation.discard(state['task_id'])
+            raise
+        if predicted:
+            speculation.resolve(state['task_id'], _routed_task(classification))
+        return _route(logger, state, classification, parsed=False)
+    # by default, use the general llm task
+    return _route(logger, state, None)
+
+def _coding_prompt(state: ToyAgentFrameworkState) -> str:
+    return f"""
+    You are a useful coding assistant that will aid in answering the prompt below. You output should be in the language
+    specified by the user, otherwise, default to Python. You will solely output code and nothing else, i.e. no verbal
+    reasoning. Be precise and considerate with your changes, doing the absolute best to avoid creating bugs.
+    
+    {state["prompt_content"]}
+    """
 
-    updates = {'response': response}
-    logger.log_step(state['task_id'], 'general', updates)
+def _summarizing_prompt(state: ToyAgentFrameworkState, condensed: Optional[str] = None) -> str:
+    """
+    :param condensed:   The merged summaries of the content when it was too long to be given as is, see
+                        `core.summarizer.Summarizer`.
+    """
+    documents = state.get("documents") or []
+    if condensed is None and not documents:
+        return f"""
+        You are a useful summarizing assistant that will help the user 
+        summarize their content in a concise, readable, and clear manner. 
+
+        {state["prompt_content"]}
+        """
+    # without documents, the condensed content is the prompt itself
+    request = state["prompt_content"] if documents else "Summarize the content."
+    content = condensed if condensed is not None else "\n\n".join(documents)
+    note = "The content was too long to be read at once, below are the merged summaries of its parts." \
+        if condensed is not None else ""
+    return f"""
+        You are a useful summarizing assistant that will help the user 
+        summarize their content in a concise, readable, and clear manner. {note}
+
+        ---- REQUEST ----
+        {request}
+        ---- CONTENT ----
+        {content}
+        """
+
+def _content_to_condense(llm: Optional[ChatOpenAI], state: ToyAgentFrameworkState,
+                         summarizer: Optional[Summarizer]) -> Optional[List[str]]:
+    """ The content to summarize (the documents, else the prompt) if it is too long to be given to the LLM as is. """
+    if llm is None or summarizer is None:
+        return None
+    content = state.get("documents") or [state["prompt_content"]]
+    return None if summarizer.fits(content) else content
+
+# prompts of the agents which only need the user's prompt, i.e. whose answer can start before the classification
+_ANSWER_PROMPTS: Dict[str, Callable[[ToyAgentFrameworkState], str]] = {
+    "general": lambda state: state["prompt_content"],
+    "code": _coding_prompt,
+    "summarize": _summarizing_prompt,
+}
+
+def _generate(llm: Optional[ChatOpenAI], state: ToyAgentFrameworkState, node: str,
+              speculation: Optional[SpeculativeRouter]) -> Optional[Any]:
+    """ The response of an answering agent, committing the speculative generation of its task if there is one. """
+    response = speculation.commit(state['task_id'], node) if speculation else None
+    if response is None and llm:
+        response = invoke_llm(llm, _with_context(state, _ANSWER_PROMPTS[node](state)), stream=True)
+    return response
+
+def _answer(logger: MongoDBLogger, state: ToyAgentFrameworkState, node: str,
+            response: Optional[Any]) -> ToyAgentFrameworkState:
+    """ Logs the response of an answering agent (a placeholder if no LLM was used) and appends it to the thread. """
+    if response is None:
+        response = "Hi, I am the general task agent!"
+    updates = {'response': response, 'conversation': _turn(state, response)}
+    if state.get('documents'):
+        # the documents were answered, they are not kept in the thread's checkpoint
+        updates['documents'] = []
+    logger.log_step(state['task_id'], node, updates)
     return updates
 
+def general_task(logger: MongoDBLogger, llm: Optional[ChatOpenAI],
+                 state: ToyAgentFrameworkState,
+                 speculation: Optional[SpeculativeRouter] = None) -> ToyAgentFrameworkState:
+    """
+    This task simply acts upon the original query, answering the user's prompt.
+    :param logger:
+    :param llm:
+    :param state:       Current state in the graph.
+    :param speculation: Optional speculative router, whose generation of this task's answer is committed if it
+                        started one.
+    :return:            Parameters to update in the state in the graph.
+    """
+    print("We are currently in the general task!")
+    return _answer(logger, state, 'general', _generate(llm, state, 'general', speculation))
+
 
 def coding_task(logger: MongoDBLogger, llm: Optional[ChatOpenAI],
-                     state: ToyAgentFrameworkState) -> ToyAgentFrameworkState:
+                state: ToyAgentFrameworkState,
+                speculation: Optional[SpeculativeRouter] = None) -> ToyAgentFrameworkState:
     """
     This task solely outputs code for the user.
     :param logger:
     :param llm:
-    :param state:   Current state in the graph.
-    :return:        Parameters to update in the state in the graph.
+    :param state:       Current state in the graph.
+    :param speculation: Optional speculative router, whose generation of this task's answer is committed if it
+                        started one.
+    :return:            Parameters to update in the state in the graph.
     """
     print("We are currently in the coding task!")
-    original_prompt = state["prompt_content"]
-    draft_prompt = f"""
-    You are a useful coding assistant that will aid in answering the prompt below. You output should be in the language
-    specified by the user, otherwise, default to Python. You will solely output code and nothing else, i.e. no verbal
-    reasoning. Be precise and considerate with your changes, doing the absolute best to avoid creating bugs.
-    
-    {original_prompt}
-    """
-    if llm:
-        response = llm.invoke(draft_prompt)
-    else:
-        response = "Hi, I am the general task agent!"
-
-    updates = {'response': response}
-    logger.log_step(state['task_id'], 'code', updates)
-    return updates
+    return _answer(logger, state, 'code', _generate(llm, state, 'code', speculation))
 
 
 def summarizing_task(logger: MongoDBLogger, llm: Optional[ChatOpenAI],
-                     state: ToyAgentFrameworkState) -> ToyAgentFrameworkState:
+                     state: ToyAgentFrameworkState,
+                     speculation: Optional[SpeculativeRouter] = None,
+                     summarizer: Optional[Summarizer] = None) -> ToyAgentFrameworkState:
     """
-    This task is responsible for summarizing the user's prompt.
+    This task is responsible for summarizing the user's prompt, or the documents given along with it.
     :param logger:
     :param llm:
-    :param state:   Current state in the graph.
-    :return:        Parameters to update in the state in the graph.
+    :param state:       Current state in the graph.
+    :param speculation: Optional speculative router, whose generation of this task's answer is committed if it
+                        started one.
+    :param summarizer:  Optional summarizer, which condenses the content first if it is too long for a single call.
+    :return:            Parameters to update in the state in the graph.
     """
     print("We are currently in the summarization task!")
-    original_prompt = state["prompt_content"]
-    draft_prompt = f"""
-        You are a useful summarizing assistant that will help the user 
-        summarize their content in a concise, readable, and clear manner. 
+    content = _content_to_condense(llm, state, summarizer)
+    if content is None:
+        return _answer(logger, state, 'summarize', _generate(llm, state, 'summarize', speculation))
+    if speculation:
+        # the speculation was started on the whole content, which is too long
+        speculation.discard(state['task_id'])
+    prompt = _summarizing_prompt(state, summarizer.condense(llm, content))
+    return _answer(logger, state, 'summarize', invoke_llm(llm, _with_context(state, prompt), stream=True))
+
+def _parse_search_queries(text: str, max_queries: int) -> List[str]:
+    """ Parses the LLM's candidate queries, one per line, dropping list markers, quotes and duplicates. """
+    queries = []
+    for line in text.splitlines():
+        query = line.strip().lstrip("-*0123456789.) ").strip().strip('"').strip()
+        if query and query not in queries:
+            queries.append(query)
+    return queries[:max_queries]
+
+def _search_query_prompt(state: ToyAgentFrameworkState, max_queries: int) -> str:
+    return f"""
+    You are going to read the following prompt and return in a STRICTLY concise fashion, up to {max_queries}
+    distinct, high-quality search queries to Google that should return the most relevant and helpful links to the
+    prompt. Write one query per line with no numbering or other text. Each line will be passed directly into the
+    Google search bar.
+
+    {state["prompt_content"]}
+    """
 
-        {original_prompt}
-        """
+def _search(logger: MongoDBLogger, state: ToyAgentFrameworkState, search: SearchService,
+            search_queries: List[str]) -> ToyAgentFrameworkState:
+    """ Searches the candidate queries concurrently (the original prompt if there are none) and logs the results. """
+    if not search_queries:
+        # just use the original prompt as the query
+        search_queries = [state["prompt_content"]]
 
-    if llm:
-        response = llm.invoke(draft_prompt)
-    else:
-        response = "Hi, I am the general task agent!"
+    # let's now execute the searches concurrently, the results are deduplicated by link
+    with record_search_latency():
+        search_results = search.search_many(search_queries)
 
-    updates = {'response': response}
-    logger.log_step(state['task_id'], 'summarize', updates)
+    updates = {'search_query': search_queries[0], 'search_queries': search_queries, 'search_results': search_results}
+    logger.log_step(state['task_id'], 'content', updates)
     return updates
 
 def content_web_searching_task(logger: MongoDBLogger, llm: Optional[ChatOpenAI],
-                               state: ToyAgentFrameworkState) -> ToyAgentFrameworkState:
+                               state: ToyAgentFrameworkState,
+                               search: Optional[SearchService] = None) -> ToyAgentFrameworkState:
     """
-
+    This task writes a few candidate search queries for the user's prompt and searches them concurrently.
     :param logger:
     :param llm:
     :param state:
+    :param search:  Search service shared across tasks. One is built from the environment if omitted.
     :return:
     """
     print("We are currently in the content web searching task!")
-    original_prompt = state["prompt_content"]
-
-    draft_prompt = f"""
-    You are going to read the following prompt and return in a STRICTLY concise fashion, a high-quality
-    search query to Google that should return the most relevant and helpful links to the prompt. Your response will
-    be passed directly into the Google search bar.
-
-    {original_prompt}
-    """
+    search = search or load_search_service()
+    search_queries = []
     if llm:
-        search_query = llm.invoke(draft_prompt).content
-    else:
-        # just use the original prompt as the query
-        search_query = original_prompt
-
-    # let's initialize the Google Search Wrapper
-    search = GoogleSearchAPIWrapper(k=4)  # we retrieve the first 4 results
-
-    # let's now execute the search on the original prompt
-    try:
-        search_results = search.results(search_query, num_results=4)
-    except Exception as e:
-        search_results = None
-        print(f"Error during the Google Search. Check your API key and CSE ID. Error: \n{e}")
-
-    updates = {'search_query': search_query, 'search_results': search_results}
-    logger.log_step(state['task_id'], 'content', updates)
+        draft_prompt = _with_context(state, _search_query_prompt(state, search.max_queries))
+        search_queries = _parse_search_queries(invoke_llm(llm, draft_prompt).content, search.max_queries)
+    return _search(logger, state, search, search_queries)
+
+def _fetched(logger: MongoDBLogger, state: ToyAgentFrameworkState,
+             page_contents: Dict[str, str]) -> ToyAgentFrameworkState:
+    updates = {'page_contents': page_contents}
+    # the page texts are only needed to generate the response, the log only records which pages were fetched
+    logger.log_step(state['task_id'], 'content_fetch', {'fetched_links': list(page_contents)})
     return updates
 
-def content_generation_task(logger: MongoDBLogger, llm: Optional[ChatOpenAI],
-                            state: ToyAgentFrameworkState) -> ToyAgentFrameworkState:
+def content_page_fetching_task(logger: MongoDBLogger, llm: Optional[ChatOpenAI],
+                               state: ToyAgentFrameworkState, fetcher: PageFetcher) -> ToyAgentFrameworkState:
     """
-    This task is responsible for generating content related to the user's prompt.
+    This optional task fetches the pages of the search results concurrently and keeps their main text, which gives the
+    content generation agent much more to work with than the search snippets.
     :param logger:  MongoDBLogger object.
-    :param llm:     LLM object instance.
+    :param llm:     LLM object instance (unused).
     :param state:   Current state in the graph.
+    :param fetcher: The page fetcher shared across tasks.
     :return:        Parameters to update in the state in the graph.
     """
-    print("We are currently in the content generation task!")
-    original_prompt = state["prompt_content"]
+    print("We are currently in the content page fetching task!")
+    links = [result.get('link') for result in state.get('search_results') or []]
+    return _fetched(logger, state, fetcher.fetch_many(links))
+
+def _content_generation_prompt(state: ToyAgentFrameworkState) -> str:
     search_results = state["search_results"]
+    page_contents = state.get("page_contents") or {}
 
     # format the results for the LLM to easily read and cite
     formatted_sources = []
     if search_results:
         for i, result in enumerate(search_results):
+            # prefer the fetched page over the short snippet of the search engine
+            page_text = page_contents.get(result.get('link'))
             formatted_sources.append(
-                f"[Source {i+1}]: {result.get('snippet', 'No Snippet available.')}"
+                f"[Source {i+1}]: {page_text or result.get('snippet', 'No Snippet available.')}"
                 f"\nLink: {result.get('link', 'No URL link available.')}"
             )
     # join the formatted sources into a paragraph that we will append to the response below
     sources_text = "\n".join(formatted_sources)
 
-    draft_prompt = f"""
+    return f"""
         You are a content generation agent. Your task is to write a high-quality, comprehensive response
         to the user's request. You must use the information provided in the 'SEARCH RESULTS' section
         below if they are highly relevant and include clear citations (e.g., [Source 1], [Source 2]) in your 
         final output.
 
         ---- USER REQUEST ----
-        {original_prompt}
+        {state["prompt_content"]}
         ---- SEARCH RESULTS ----
         {sources_text}
         """
 
+def content_generation_task(logger: MongoDBLogger, llm: Optional[ChatOpenAI],
+                            state: ToyAgentFrameworkState) -> ToyAgentFrameworkState:
+    """
+    This task is responsible for generating content related to the user's prompt.
+    :param logger:  MongoDBLogger object.
+    :param llm:     LLM object instance.
+    :param state:   Current state in the graph.
+    :return:        Parameters to update in the state in the graph.
+    """
+    print("We are currently in the content generation task!")
+    draft_prompt = _with_context(state, _content_generation_prompt(state))
+    response = invoke_llm(llm, draft_prompt, stream=True) if llm else None
+    return _answer(logger, state, 'content_post_web_search', response)
+
+# Asynchronous nodes, used when the graph is run with `ainvoke` (see `build_graph`). They share their prompts with the
+# synchronous nodes above but await the LLM, so that a single event loop keeps many tasks in flight. The calls which
+# only have a blocking client (MongoDB, the search backends) run on the loop's default thread pool; `asyncio.to_thread`
+# copies the context, so the steps they log still carry the metrics of their node.
+
+async def aclassify_task(logger: MongoDBLogger, llm: Optional[ChatOpenAI],
+                         state: ToyAgentFrameworkState,
+                         classifier: Optional[LocalTaskClassifier] = None,
+                         speculation: Optional[SpeculativeRouter] = None,
+                         answer_llms: Optional[Dict[str, ChatOpenAI]] = None,
+                         retriever: Optional[DocumentIndex] = None) -> Command[T_AGENT]:
+    """ Asynchronous counterpart of `classify_task`. """
+    print("We are currently in the classification task!")
+    if retriever is not None:
+        state = {**state, 'retrieved_passages': await asyncio.to_thread(_retrieve, state, retriever)}
+    local_classification = classifier.classify(state['prompt_content']) if classifier else None
+    if local_classification:
+        return await asyncio.to_thread(_route, logger, state, local_classification)
     if llm:
-        response = llm.invoke(draft_prompt)
-    else:
-        response = "Hi, I am the general task agent!"
+        predicted = speculation.predict(state) if speculation else None
+        if predicted:
+            answer_llm = (answer_llms or {}).get(predicted, llm)
+            speculation.astart(state['task_id'], predicted, lambda: ainvoke_llm(
+                answer_llm, _with_context(state, _ANSWER_PROMPTS[predicted](state))))
+        try:
+            classification = await ainvoke_structured_llm(llm, TaskClassification, _classification_prompt(state))
+        except BaseException:
+            # including the cancellation of the graph, which must not leave the speculation running
+            if predicted:
+                speculation.discard(state['task_id'])
+            raise
+        if predicted:
+            speculation.resolve(state['task_id'], _routed_task(classification))
+        return await asyncio.to_thread(_route, logger, state, classification, False)
+    return await asyncio.to_thread(_route, logger, state, None)
+
+async def _aanswer(logger: MongoDBLogger, llm: Optional[ChatOpenAI], state: ToyAgentFrameworkState, node: str,
+                   prompt: str, speculation: Optional[SpeculativeRouter] = None) -> ToyAgentFrameworkState:
+    response = await speculation.acommit(state['task_id'], node) if speculation else None
+    if response is None and llm:
+        response = await ainvoke_llm(llm, _with_context(state, prompt), stream=True)
+    return await asyncio.to_thread(_answer, logger, state, node, response)
+
+async def ageneral_task(logger: MongoDBLogger, llm: Optional[ChatOpenAI],
+                        state: ToyAgentFrameworkState,
+                        speculation: Optional[SpeculativeRouter] = None) -> ToyAgentFrameworkState:
+    """ Asynchronous counterpart of `general_task`. """
+    print("We are currently in the general task!")
+    return await _aanswer(logger, llm, state, 'general', state["prompt_content"], speculation)
 
-    updates = {'response': response}
-    logger.log_step(state['task_id'], 'content_post_web_search', updates)
-    return updates
+async def acoding_task(logger: MongoDBLogger, llm: Optional[ChatOpenAI],
+                       state: ToyAgentFrameworkState,
+                       speculation: Optional[SpeculativeRouter] = None) -> ToyAgentFrameworkState:
+    """ Asynchronous counterpart of `coding_task`. """
+    print("We are currently in the coding task!")
+    return await _aanswer(logger, llm, state, 'code', _coding_prompt(state), speculation)
 
-def build_graph(logger: MongoDBLogger, llm: Optional[ChatOpenAI]) -> CompiledStateGraph:
+async def asummarizing_task(logger: MongoDBLogger, llm: Optional[ChatOpenAI],
+                            state: ToyAgentFrameworkState,
+                            speculation: Optional[SpeculativeRouter] = None,
+                            summarizer: Optional[Summarizer] = None) -> ToyAgentFrameworkState:
+    """ Asynchronous counterpart of `summarizing_task`. """
+    print("We are currently in the summarization task!")
+    content = _content_to_condense(llm, state, summarizer)
+    if content is None:
+        return await _aanswer(logger, llm, state, 'summarize', _summarizing_prompt(state), speculation)
+    if speculation:
+        speculation.discard(state['task_id'])
+    condensed = await summarizer.acondense(llm, content)
+    return await _aanswer(logger, llm, state, 'summarize', _summarizing_prompt(state, condensed))
+
+async def acontent_web_searching_task(logger: MongoDBLogger, llm: Optional[ChatOpenAI],
+                                      state: ToyAgentFrameworkState,
+                                      search: Optional[SearchService] = None) -> ToyAgentFrameworkState:
+    """ Asynchronous counterpart of `content_web_searching_task`. """
+    print("We are currently in the content web searching task!")
+    search = search or load_search_service()
+    search_queries = []
+    if llm:
+        draft_prompt = _with_context(state, _search_query_prompt(state, search.max_queries))
+        search_queries = _parse_search_queries((await ainvoke_llm(llm, draft_prompt)).content, search.max_queries)
+    return await asyncio.to_thread(_search, logger, state, search, search_queries)
+
+async def acontent_page_fetching_task(logger: MongoDBLogger, llm: Optional[ChatOpenAI],
+                                      state: ToyAgentFrameworkState, fetcher: PageFetcher) -> ToyAgentFrameworkState:
+    """ Asynchronous counterpart of `content_page_fetching_task`. """
+    print("We are currently in the content page fetching task!")
+    links = [result.get('link') for result in state.get('search_results') or []]
+    page_contents = await fetcher.afetch_many(links)
+    return await asyncio.to_thread(_fetched, logger, state, page_contents)
+
+async def acontent_generation_task(logger: MongoDBLogger, llm: Optional[ChatOpenAI],
+                                   state: ToyAgentFrameworkState) -> ToyAgentFrameworkState:
+    """ Asynchronous counterpart of `content_generation_task`. """
+    print("We are currently in the content generation task!")
+    return await _aanswer(logger, llm, state, 'content_post_web_search', _content_generation_prompt(state))
+
+def _bind(node: Callable, logger: MongoDBLogger, llm: Optional[ChatOpenAI],
+          use_async: bool) -> Callable[[ToyAgentFrameworkState], Any]:
+    """ Binds a node to the logger and LLM, keeping it a coroutine function if it is asynchronous. """
+    if use_async:
+        async def bound(state: ToyAgentFrameworkState) -> Any:
+            return await node(logger, llm, state)
+        return bound
+    return lambda state: node(logger, llm, state)
+
+def build_graph(logger: MongoDBLogger, llm: Optional[ChatOpenAI],
+                checkpointer: Optional[BaseCheckpointSaver] = None,
+                metrics: Optional[MetricsRecorder] = None,
+                token_stream: Optional[TokenStreamPublisher] = None,
+                classifier: Optional[LocalTaskClassifier] = None,
+                response_cache: Optional[ResponseCache] = None,
+                search: Optional[SearchService] = None,
+                page_fetcher: Optional[PageFetcher] = None,
+                speculation: Optional[SpeculativeRouter] = None,
+                models: Optional[ModelRegistry] = None,
+                summarizer: Optional[Summarizer] = None,
+                retriever: Optional[DocumentIndex] = None,
+                use_async: bool = False) -> CompiledStateGraph:
     """
-
-    :return:
+    Builds and compiles the agent graph. Every node is instrumented (see `core.instrumentation.instrument_node`).
+    :param logger:          MongoDBLogger object shared by every node.
+    :param llm:             LLM object instance, or None to run the graph without invoking any LLM.
+    :param checkpointer:    Checkpointer to compile the graph with. A fresh `InMemorySaver` is used when omitted.
+    :param metrics:         Where to export the per-node histograms, or None to only record them in the task log.
+    :param token_stream:    Where to stream the tokens of the user-facing responses, or None to not stream them.
+    :param classifier:      Local classifier tried before the LLM router, or None to always route with the LLM.
+    :param response_cache:  Cache consulted before every LLM call of the nodes, or None to not cache them.
+    :param search:          Search service of the content route. One is built from the environment if omitted.
+    :param page_fetcher:    Fetches the pages of the search results before the content generation, or None to only
+                            give the snippets of the search results to the LLM.
+    :param speculation:     Starts the answer of the `general`, `code` and `summarize` routes while the LLM router
+                            classifies the prompt, or None to only start it once the prompt is classified.
+    :param models:          Assigns the LLM of every node, in place of `llm`. Ignored when `llm` is None.
+    :param summarizer:      Condenses the content of the summarizing agent when it is too long for a single call. One
+                            is built from the environment if omitted.
+    :param retriever:       Document index whose passages relevant to the prompt are given to every agent, or None to
+                            not retrieve any.
+    :param use_async:       Whether to build the graph out of the asynchronous nodes, in which case it must be run
+                            with `ainvoke` rather than `invoke`.
+    :return:                The compiled graph.
     """
 
+    # the search service (and its cache) is built once and shared by every task run on this graph
+    search = search or load_search_service(metrics)
+    # as is the summarizer, whose pool and cache of chunk summaries are shared across tasks
+    summarizer = summarizer or load_summarizer(metrics)
+
+    def llm_of(node: str) -> Optional[ChatOpenAI]:
+        return models.llm(node) if llm is not None and models is not None else llm
+    answer_llms = {route: llm_of(route) for route in SPECULATIVE_ROUTES}
+
     # Create the graph
     builder = StateGraph(ToyAgentFrameworkState)
 
     # Add nodes
-    builder.add_node("task_classification", lambda s : classify_task(logger, llm, s))
-    builder.add_node("general", lambda s : general_task(logger, llm, s))
-    builder.add_node("code", lambda s : coding_task(logger, llm, s))
-    builder.add_node("summarize", lambda s : summarizing_task(logger, llm, s))
-    builder.add_node("content", lambda s : content_web_searching_task(logger, llm, s))
-    builder.add_node("content_post_web_search", lambda s : content_generation_task(logger, llm, s))
+    if use_async:
+        nodes = {
+            "task_classification": partial(aclassify_task, classifier=classifier, speculation=speculation,
+                                           answer_llms=answer_llms, retriever=retriever),
+            "general": partial(ageneral_task, speculation=speculation),
+            "code": partial(acoding_task, speculation=speculation),
+            "summarize": partial(asummarizing_task, speculation=speculation, summarizer=summarizer),
+            "content": partial(acontent_web_searching_task, search=search),
+            "content_post_web_search": acontent_generation_task,
+        }
+        if page_fetcher is not None:
+            nodes["content_fetch"] = partial(acontent_page_fetching_task, fetcher=page_fetcher)
+    else:
+        nodes = {
+            "task_classification": partial(classify_task, classifier=classifier, speculation=speculation,
+                                           answer_llms=answer_llms, retriever=retriever),
+            "general": partial(general_task, speculation=speculation),
+            "code": partial(coding_task, speculation=speculation),
+            "summarize": partial(summarizing_task, speculation=speculation, summarizer=summarizer),
+            "content": partial(content_web_searching_task, search=search),
+            "content_post_web_search": content_generation_task,
+        }
+        if page_fetcher is not None:
+            nodes["content_fetch"] = partial(content_page_fetching_task, fetcher=page_fetcher)
+    for name, node in nodes.items():
+        builder.add_node(name, instrument_node(name, _bind(node, logger, llm_of(name), use_async), metrics,
+                                               token_stream, response_cache))
 
     # Add edges
     builder.add_edge(START, "task_classification")
     builder.add_edge("general", END)
     builder.add_edge("code", END)
     builder.add_edge("summarize", END)
-    builder.add_edge("content", "content_post_web_search")
+    if page_fetcher is not None:
+        builder.add_edge("content", "content_fetch")
+        builder.add_edge("content_fetch", "content_post_web_search")
+    else:
+        builder.add_edge("content", "content_post_web_search")
     builder.add_edge("content_post_web_search", END)
 
-    memory = InMemorySaver()
-    app = builder.compile(checkpointer = memory)
+    if checkpointer is None:
+        checkpointer = InMemorySaver()
+    app = builder.compile(checkpointer = checkpointer)
 
     return app
 
 def display_graph(a: CompiledStateGraph):
     """ Use the Pillow library to open a window which visually display the application graph. """
+    # only needed to display the graph, so Pillow is not imported along with it
+    from PIL import Image
     # get the raw PNG byte data
     png_bytes = a.get_graph().draw_mermaid_png()
     # wrap the bytes in an in-memory file stream
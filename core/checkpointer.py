@@ -0,0 +1,243 @@
+import os
+import random
+import asyncio
+import threading
+from datetime import datetime, timezone
+from pymongo import ASCENDING, DESCENDING, ReplaceOne, UpdateOne
+from pymongo.database import Database
+from pymongo.errors import OperationFailure
+from langchain_core.runnables import RunnableConfig
+from langgraph.checkpoint.base import (
+    WRITES_IDX_MAP,
+    BaseCheckpointSaver,
+    ChannelVersions,
+    Checkpoint,
+    CheckpointMetadata,
+    CheckpointTuple,
+    get_checkpoint_id,
+    get_checkpoint_metadata,
+)
+from typing import *
+
+class MongoCheckpointSaver(BaseCheckpointSaver[str]):
+    """
+    LangGraph checkpointer persisting the checkpoints of every thread to MongoDB, so that a follow-up prompt on a
+    thread ID resumes from the state the previous task left, whichever worker runs it. Storage stays bounded:
+    * `compact` keeps only the `history_window` most recent checkpoints of a thread (and their pending writes), and
+    * a TTL index evicts the checkpoints of threads which were idle for `idle_ttl` seconds.
+    Each checkpoint is stored as a single document holding its channel values, so dropping old checkpoints never leaves
+    orphaned values behind.
+    """
+    def __init__(self, db: Database, history_window: Optional[int] = None, idle_ttl: Optional[int] = None,
+                 collection_name: Optional[str] = None):
+        """
+        :param db:              The database to store the checkpoints in, usually the logger's.
+        :param history_window:  Checkpoints kept per thread by `compact`. Defaults to $CHECKPOINT_HISTORY_WINDOW or 4.
+        :param idle_ttl:        Seconds after its last checkpoint that a thread is evicted, 0 to never evict. Defaults
+                                to $CHECKPOINT_IDLE_TTL_SECONDS or 7 days.
+        :param collection_name: Defaults to $MONGO_CHECKPOINT_COLLECTION_NAME or 'Checkpoints'. The pending writes are
+                                stored in the collection of the same name suffixed with 'Writes'.
+        """
+        super().__init__()
+        self.history_window = max(1, history_window or int(os.getenv("CHECKPOINT_HISTORY_WINDOW", "4")))
+        self.idle_ttl = idle_ttl if idle_ttl is not None else int(os.getenv("CHECKPOINT_IDLE_TTL_SECONDS",
+                                                                            str(7 * 24 * 3600)))
+        collection_name = collection_name or os.getenv("MONGO_CHECKPOINT_COLLECTION_NAME", "Checkpoints")
+        self.db = db
+        self.checkpoints = db[collection_name]
+        self.writes = db[f"{collection_name}Writes"]
+        # the indexes are created on first use so that building the saver needs no round trip to the database
+        self._indexes_ready = False
+        self._indexes_lock = threading.Lock()
+
+    # ---------------------------------------------------------------------------------------------------------------
+    # Storage helpers
+    # ---------------------------------------------------------------------------------------------------------------
+    def _ensure_indexes(self) -> None:
+        if self._indexes_ready:
+            return
+        with self._indexes_lock:
+            if self._indexes_ready:
+                return
+            self.checkpoints.create_index(
+                [("thread_id", ASCENDING), ("checkpoint_ns", ASCENDING), ("checkpoint_id", DESCENDING)], unique=True)
+            self.writes.create_index(
+                [("thread_id", ASCENDING), ("checkpoint_ns", ASCENDING), ("checkpoint_id", ASCENDING),
+                 ("task_id", ASCENDING), ("idx", ASCENDING)], unique=True)
+            if self.idle_ttl > 0:
+                for collection in (self.checkpoints, self.writes):
+                    self._ensure_ttl_index(collection)
+            self._indexes_ready = True
+
+    def _ensure_ttl_index(self, collection) -> None:
+        """ Creates the TTL index on `created_at`, or updates its expiry if it was created with another one. """
+        try:
+            collection.create_index("created_at", expireAfterSeconds=self.idle_ttl)
+        except OperationFailure:
+            self.db.command("collMod", collection.name,
+                            index={"keyPattern": {"created_at": 1}, "expireAfterSeconds": self.idle_ttl})
+
+    def _dump(self, value: Any) -> Dict[str, Any]:
+        type_, data = self.serde.dumps_typed(value)
+        return {"type": type_, "data": data}
+
+    def _load(self, value: Dict[str, Any]) -> Any:
+        return self.serde.loads_typed((value["type"], bytes(value["data"])))
+
+    def _to_tuple(self, document: Dict[str, Any]) -> CheckpointTuple:
+        thread_id, checkpoint_ns = document["thread_id"], document["checkpoint_ns"]
+        checkpoint_id, parent_checkpoint_id = document["checkpoint_id"], document.get("parent_checkpoint_id")
+        writes = self.writes.find(
+            {"thread_id": thread_id, "checkpoint_ns": checkpoint_ns, "checkpoint_id": checkpoint_id},
+        ).sort([("task_id", ASCENDING), ("idx", ASCENDING)])
+        return CheckpointTuple(
+            config={"configurable": {"thread_id": thread_id, "checkpoint_ns": checkpoint_ns,
+                                     "checkpoint_id": checkpoint_id}},
+            checkpoint=self._load(document["checkpoint"]),
+            metadata=self._load(document["metadata"]),
+            parent_config=(
+                {"configurable": {"thread_id": thread_id, "checkpoint_ns": checkpoint_ns,
+                                  "checkpoint_id": parent_checkpoint_id}}
+                if parent_checkpoint_id else None
+            ),
+            pending_writes=[(write["task_id"], write["channel"], self._load(write["value"])) for write in writes],
+        )
+
+    # ---------------------------------------------------------------------------------------------------------------
+    # BaseCheckpointSaver
+    # ---------------------------------------------------------------------------------------------------------------
+    def get_tuple(self, config: RunnableConfig) -> Optional[CheckpointTuple]:
+        """ Returns the checkpoint given by the config, or the latest checkpoint of its thread. """
+        query = {"thread_id": config["configurable"]["thread_id"],
+                 "checkpoint_ns": config["configurable"].get("checkpoint_ns", "")}
+        if checkpoint_id := get_checkpoint_id(config):
+            query["checkpoint_id"] = checkpoint_id
+        document = self.checkpoints.find_one(query, sort=[("checkpoint_id", DESCENDING)])
+        return self._to_tuple(document) if document is not None else None
+
+    def list(self, config: Optional[RunnableConfig], *, filter: Optional[Dict[str, Any]] = None,
+             before: Optional[RunnableConfig] = None, limit: Optional[int] = None) -> Iterator[CheckpointTuple]:
+        """ Lists the checkpoints matching the config, newest first. """
+        query: Dict[str, Any] = {}
+        if config is not None:
+            query["thread_id"] = config["configurable"]["thread_id"]
+            if (checkpoint_ns := config["configurable"].get("checkpoint_ns")) is not None:
+                query["checkpoint_ns"] = checkpoint_ns
+            if checkpoint_id := get_checkpoint_id(config):
+                query["checkpoint_id"] = checkpoint_id
+        if before is not None and (before_id := get_checkpoint_id(before)):
+            query.setdefault("checkpoint_id", {})
+            if isinstance(query["checkpoint_id"], dict):
+                query["checkpoint_id"]["$lt"] = before_id
+        for document in self.checkpoints.find(query).sort("checkpoint_id", DESCENDING):
+            checkpoint_tuple = self._to_tuple(document)
+            # the metadata is serialized, so it is filtered here rather than by the query
+            if filter and not all(checkpoint_tuple.metadata.get(key) == value for key, value in filter.items()):
+                continue
+            if limit is not None:
+                if limit <= 0:
+                    break
+                limit -= 1
+            yield checkpoint_tuple
+
+    def put(self, config: RunnableConfig, checkpoint: Checkpoint, metadata: CheckpointMetadata,
+            new_versions: ChannelVersions) -> RunnableConfig:
+        """ Saves a checkpoint, together with every channel value it holds. """
+        self._ensure_indexes()
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        key = {"thread_id": thread_id, "checkpoint_ns": checkpoint_ns, "checkpoint_id": checkpoint["id"]}
+        self.checkpoints.replace_one(key, {
+            **key,
+            "parent_checkpoint_id": config["configurable"].get("checkpoint_id"),
+            "checkpoint": self._dump(checkpoint),
+            "metadata": self._dump(get_checkpoint_metadata(config, metadata)),
+            "created_at": datetime.now(timezone.utc),
+        }, upsert=True)
+        return {"configurable": {"thread_id": thread_id, "checkpoint_ns": checkpoint_ns,
+                                 "checkpoint_id": checkpoint["id"]}}
+
+    def put_writes(self, config: RunnableConfig, writes: Sequence[Tuple[str, Any]], task_id: str,
+                   task_path: str = "") -> None:
+        """ Saves the pending writes of a task in a single round trip. """
+        if not writes:
+            return
+        self._ensure_indexes()
+        key = {"thread_id": config["configurable"]["thread_id"],
+               "checkpoint_ns": config["configurable"].get("checkpoint_ns", ""),
+               "checkpoint_id": config["configurable"]["checkpoint_id"]}
+        now = datetime.now(timezone.utc)
+        operations = []
+        for idx, (channel, value) in enumerate(writes):
+            idx = WRITES_IDX_MAP.get(channel, idx)
+            write_key = {**key, "task_id": task_id, "idx": idx}
+            document = {**write_key, "channel": channel, "value": self._dump(value), "task_path": task_path,
+                        "created_at": now}
+            # regular writes are only saved once, the special writes (negative index) replace the previous ones
+            if idx >= 0:
+                operations.append(UpdateOne(write_key, {"$setOnInsert": document}, upsert=True))
+            else:
+                operations.append(ReplaceOne(write_key, document, upsert=True))
+        self.writes.bulk_write(operations, ordered=False)
+
+    def delete_thread(self, thread_id: str) -> None:
+        """ Deletes every checkpoint and pending write of a thread. """
+        self.checkpoints.delete_many({"thread_id": thread_id})
+        self.writes.delete_many({"thread_id": thread_id})
+
+    def get_next_version(self, current: Optional[str], channel: None) -> str:
+        # same versioning as `InMemorySaver`, i.e. a zero padded counter with a random tie breaker
+        if current is None:
+            current_v = 0
+        elif isinstance(current, int):
+            current_v = current
+        else:
+            current_v = int(current.split(".")[0])
+        return f"{current_v + 1:032}.{random.random():016}"
+
+    # The async API runs the synchronous methods in a thread, pymongo being a blocking driver.
+    async def aget_tuple(self, config: RunnableConfig) -> Optional[CheckpointTuple]:
+        return await asyncio.to_thread(self.get_tuple, config)
+
+    async def alist(self, config: Optional[RunnableConfig], *, filter: Optional[Dict[str, Any]] = None,
+                    before: Optional[RunnableConfig] = None,
+                    limit: Optional[int] = None) -> AsyncIterator[CheckpointTuple]:
+        checkpoint_tuples = await asyncio.to_thread(
+            lambda: list(self.list(config, filter=filter, before=before, limit=limit)))
+        for checkpoint_tuple in checkpoint_tuples:
+            yield checkpoint_tuple
+
+    async def aput(self, config: RunnableConfig, checkpoint: Checkpoint, metadata: CheckpointMetadata,
+                   new_versions: ChannelVersions) -> RunnableConfig:
+        return await asyncio.to_thread(self.put, config, checkpoint, metadata, new_versions)
+
+    async def aput_writes(self, config: RunnableConfig, writes: Sequence[Tuple[str, Any]], task_id: str,
+                          task_path: str = "") -> None:
+        await asyncio.to_thread(self.put_writes, config, writes, task_id, task_path)
+
+    async def adelete_thread(self, thread_id: str) -> None:
+        await asyncio.to_thread(self.delete_thread, thread_id)
+
+    # ---------------------------------------------------------------------------------------------------------------
+    # Retention
+    # ---------------------------------------------------------------------------------------------------------------
+    def compact(self, thread_id: str) -> int:
+        """
+        Drops every checkpoint of a thread (and their pending writes) but the `history_window` most recent ones of
+        each namespace. Only the latest checkpoint is needed to resume a thread; the others are kept for inspection.
+        :param thread_id:
+        :return:            The number of checkpoints dropped.
+        """
+        kept: Dict[str, int] = {}
+        stale: List[str] = []
+        cursor = self.checkpoints.find({"thread_id": thread_id}, {"checkpoint_ns": 1, "checkpoint_id": 1, "_id": 0})
+        for document in cursor.sort("checkpoint_id", DESCENDING):
+            checkpoint_ns = document["checkpoint_ns"]
+            if kept.get(checkpoint_ns, 0) < self.history_window:
+                kept[checkpoint_ns] = kept.get(checkpoint_ns, 0) + 1
+            else:
+                stale.append(document["checkpoint_id"])
+        if stale:
+            self.checkpoints.delete_many({"thread_id": thread_id, "checkpoint_id": {"$in": stale}})
+            self.writes.delete_many({"thread_id": thread_id, "checkpoint_id": {"$in": stale}})
+        return len(stale)
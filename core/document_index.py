@@ -0,0 +1,344 @@
+import os
+import re
+import json
+import fcntl
+import hashlib
+import threading
+from contextlib import contextmanager
+import numpy as np
+from .summarizer import TokenCounter, iter_chunks
+from typing import *
+
+_TOKEN_PATTERN = re.compile(r"[a-z0-9+#]+")
+
+def _row(doc_id: str, text: str) -> bytes:
+    """ A line of the rows file. """
+    return (json.dumps({"doc_id": doc_id, "text": text}) + "\n").encode("utf-8")
+
+class Embedder(Protocol):
+    """ Anything that turns texts into L2 normalized vectors of `dim` float32 components. """
+    name: str
+    dim: int
+
+    def embed(self, texts: Sequence[str]) -> np.ndarray:
+        ...
+
+class HashingEmbedder:
+    """
+    Deterministic, offline embedder for local development and tests: the word unigrams and bigrams of a text are hashed
+    into `dim` signed buckets (the hashing trick) with a sublinear term frequency. Texts sharing words get close
+    vectors, the same text always gets the same vector, and no model or network access is needed.
+    """
+    def __init__(self, dim: int = 384):
+        self.dim = dim
+        self.name = f"hashing-{dim}"
+
+    def embed(self, texts: Sequence[str]) -> np.ndarray:
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            words = _TOKEN_PATTERN.findall(text.lower())
+            for token in words + [f"{a} {b}" for a, b in zip(words, words[1:])]:
+                digest = int.from_bytes(hashlib.blake2b(token.encode(), digest_size=8).digest(), "little")
+                vectors[row, digest % self.dim] += 1.0 if digest >> 63 else -1.0
+        np.copysign(np.log1p(np.abs(vectors)), vectors, out=vectors)
+        return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+class OpenAIEmbedder:
+    """ OpenAI embeddings through `OpenAIEmbeddings`, which is built on first use and then reused. """
+    def __init__(self, model: str = "text-embedding-3-small", dim: int = 1536):
+        self.model = model
+        self.dim = dim
+        self.name = f"openai-{model}-{dim}"
+        self._client = None
+        self._lock = threading.Lock()
+
+    def embed(self, texts: Sequence[str]) -> np.ndarray:
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    from langchain_openai import OpenAIEmbeddings
+                    self._client = OpenAIEmbeddings(model=self.model, dimensions=self.dim)
+        vectors = np.asarray(self._client.embed_documents(list(texts)), dtype=np.float32).reshape(-1, self.dim)
+        return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+class DocumentIndex:
+    """
+    Vector index of document chunks, stored in a directory shared by the API (which ingests the documents) and the
+    workers (which search them):
+    * `vectors.<generation>.f32`, the embeddings, a float32 matrix memory mapped with spare rows to append to,
+    * `deleted.<generation>.u8`, one tombstone byte per row, also memory mapped,
+    * `rows.<generation>.jsonl`, the document ID and the text of every row, in row order,
+    * `state.json`, the number of rows, the capacity, the generation and the revision (the number of writes), replaced
+      atomically after every write.
+
+    Appending a document writes its rows past the last one (doubling the files when they are full) and deleting one
+    only sets its tombstones, so neither rewrites the index. `compact` drops the deleted rows into a new generation.
+    Writers take an exclusive file lock; readers pick up the writes of other processes on their next search.
+    """
+    def __init__(self, directory: str, embedder: Embedder, chunk_tokens: int = 300, top_k: int = 4,
+                 min_score: float = 0.2):
+        """
+        :param directory:       Where the index is stored, created if needed.
+        :param embedder:        Embeds the chunks and the queries. An existing index must have been built by an
+                                embedder of the same name.
+        :param chunk_tokens:    Token budget of a chunk.
+        :param top_k:           Default number of chunks returned by a search.
+        :param min_score:       Default minimum similarity of the chunks returned by a search.
+        """
+        self.directory = directory
+        self.embedder = embedder
+        self.chunk_tokens = chunk_tokens
+        self.top_k = top_k
+        self.min_score = min_score
+        self.counter = TokenCounter()
+        os.makedirs(directory, exist_ok=True)
+        self._state_path = os.path.join(directory, "state.json")
+        self._lock = threading.RLock()
+        self._state: Dict[str, Any] = {"count": 0, "capacity": 0, "generation": 0}
+        # (generation, capacity) of the mapped files, and generation of the rows read so far
+        self._mapped: Tuple[int, int] = (0, 0)
+        self._vectors: Optional[np.memmap] = None
+        self._deleted: Optional[np.memmap] = None
+        self._rows_generation = 0
+        self._rows: List[Tuple[str, str]] = []
+        self._rows_offset = 0
+        self._refresh()
+
+    @property
+    def revision(self) -> int:
+        """ Number of writes made to the index, which changes whenever a search may return different chunks. """
+        self._refresh()
+        return self._state.get("revision", 0)
+
+    @property
+    def size(self) -> int:
+        """ Number of live (not deleted) chunks. """
+        self._refresh()
+        with self._lock:
+            count = self._state["count"]
+            return int(count - np.count_nonzero(self._deleted[:count])) if count else 0
+
+    # ---------------------------------------------------------------------------------------------------------------
+    # Search
+    # ---------------------------------------------------------------------------------------------------------------
+    def search(self, query: str, k: Optional[int] = None, min_score: Optional[float] = None) -> List[Dict[str, Any]]:
+        """
+        Returns the chunks closest to the query by cosine similarity, with one matrix-vector product over the mapped
+        vectors and a partial sort.
+        :param query:       The query.
+        :param k:           Maximum number of chunks, `top_k` by default.
+        :param min_score:   Chunks less similar than this are left out, `min_score` by default.
+        :return:            {'doc_id', 'text', 'score'} of every chunk, most similar first.
+        """
+        k = self.top_k if k is None else k
+        min_score = self.min_score if min_score is None else min_score
+        self._refresh()
+        with self._lock:
+            count, vectors, deleted, rows = self._state["count"], self._vectors, self._deleted, self._rows
+        if not count or k <= 0:
+            return []
+        query_vector = self.embedder.embed([query])[0]
+        scores = vectors[:count] @ query_vector
+        scores[deleted[:count] != 0] = -np.inf
+        k = min(k, count)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [{"doc_id": rows[i][0], "text": rows[i][1], "score": float(scores[i])}
+                for i in top if scores[i] >= min_score]
+
+    # ---------------------------------------------------------------------------------------------------------------
+    # Ingestion
+    # ---------------------------------------------------------------------------------------------------------------
+    def add(self, doc_id: str, text: str) -> int:
+        """
+        Chunks, embeds and appends a document, replacing the previous version of the same document ID.
+        :return:    The number of chunks of the document.
+        """
+        chunks = list(iter_chunks(text, self.counter, self.chunk_tokens))
+        # embed before taking the lock, the other writers need not wait for it
+        vectors = self.embedder.embed(chunks) if chunks else np.zeros((0, self.embedder.dim), dtype=np.float32)
+        with self._write():
+            self._tombstone(doc_id)
+            count = self._state["count"]
+            if chunks:
+                self._reserve(count + len(chunks))
+                self._vectors[count:count + len(chunks)] = vectors
+                self._deleted[count:count + len(chunks)] = 0
+                self._vectors.flush()
+                self._deleted.flush()
+            with open(self._path("rows", "jsonl"), "ab") as f:
+                # drop the rows of a write which failed before updating the state
+                f.truncate(self._state.get("rows_bytes", 0))
+                for chunk in chunks:
+                    f.write(_row(doc_id, chunk))
+                rows_bytes = f.tell()
+            # the rows are only visible to the readers once the new count is written
+            self._write_state(count=count + len(chunks), rows_bytes=rows_bytes)
+        return len(chunks)
+
+    def delete(self, doc_id: str) -> int:
+        """
+        Deletes every chunk of a document by setting its tombstones.
+        :return:    The number of chunks deleted, 0 if the document is not indexed.
+        """
+        with self._write():
+            deleted = self._tombstone(doc_id)
+            if deleted:
+                self._write_state()
+        return deleted
+
+    def compact(self) -> None:
+        """ Rewrites the live rows into a new generation of files, reclaiming the space of the deleted ones. """
+        with self._write():
+            count = self._state["count"]
+            live = np.flatnonzero(self._deleted[:count] == 0) if count else np.zeros(0, dtype=np.int64)
+            generation = self._state["generation"] + 1
+            capacity = max(len(live), 1)
+            vectors = self._create(self._path("vectors", "f32", generation), np.float32, capacity, self.embedder.dim)
+            deleted = self._create(self._path("deleted", "u8", generation), np.uint8, capacity)
+            vectors[:len(live)] = self._vectors[live] if len(live) else 0
+            vectors.flush()
+            deleted.flush()
+            with open(self._path("rows", "jsonl", generation), "wb") as f:
+                for i in live:
+                    f.write(_row(*self._rows[i]))
+                rows_bytes = f.tell()
+            old_generation = self._state["generation"]
+            self._write_state(count=len(live), capacity=capacity, generation=generation, rows_bytes=rows_bytes)
+            for name, extension in (("vectors", "f32"), ("deleted", "u8"), ("rows", "jsonl")):
+                try:
+                    # a reader still mapping the old files keeps them alive until it picks up the new generation
+                    os.remove(self._path(name, extension, old_generation))
+                except OSError:
+                    pass
+
+    # ---------------------------------------------------------------------------------------------------------------
+    # Storage
+    # ---------------------------------------------------------------------------------------------------------------
+    def _path(self, name: str, extension: str, generation: Optional[int] = None) -> str:
+        generation = self._state["generation"] if generation is None else generation
+        return os.path.join(self.directory, f"{name}.{generation}.{extension}")
+
+    @contextmanager
+    def _write(self) -> Iterator[None]:
+        """ Serializes the writers of every process, on an up to date view of the index. """
+        with self._lock, open(os.path.join(self.directory, "write.lock"), "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                self._refresh()
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _refresh(self) -> None:
+        """ Picks up the writes made to the index since the last call, by this process or another one. """
+        try:
+            # the state is a few bytes, reading it on every search is cheaper than any file change notification
+            with open(self._state_path, "r", encoding="utf-8") as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return
+        with self._lock:
+            if state["revision"] != self._state.get("revision"):
+                if state["embedder"] != self.embedder.name:
+                    raise ValueError(f"The index at {self.directory} was built with the embedder "
+                                     f"'{state['embedder']}', not '{self.embedder.name}'.")
+                self._state = state
+            self._sync()
+
+    def _sync(self) -> None:
+        """ Maps the files of the current state again if they changed, and reads its new rows. """
+        generation, capacity = self._state["generation"], self._state["capacity"]
+        if self._rows_generation != generation:
+            self._rows, self._rows_offset, self._rows_generation = [], 0, generation
+        if self._mapped != (generation, capacity):
+            self._map()
+            self._mapped = (generation, capacity)
+        self._read_rows()
+
+    def _map(self) -> None:
+        capacity = self._state["capacity"]
+        if not capacity:
+            self._vectors = self._deleted = None
+            return
+        self._vectors = np.memmap(self._path("vectors", "f32"), dtype=np.float32, mode="r+",
+                                  shape=(capacity, self.embedder.dim))
+        self._deleted = np.memmap(self._path("deleted", "u8"), dtype=np.uint8, mode="r+", shape=(capacity,))
+
+    def _read_rows(self) -> None:
+        """ Reads the rows appended since the last call, up to the count of the state. """
+        count = self._state["count"]
+        if len(self._rows) >= count:
+            return
+        with open(self._path("rows", "jsonl"), "rb") as f:
+            f.seek(self._rows_offset)
+            while len(self._rows) < count:
+                line = f.readline()
+                if not line.endswith(b"\n"):
+                    break
+                row = json.loads(line)
+                self._rows.append((row["doc_id"], row["text"]))
+            self._rows_offset = f.tell()
+
+    def _reserve(self, rows: int) -> None:
+        """ Grows the mapped files to hold at least this many rows, doubling their capacity. """
+        capacity = self._state["capacity"]
+        if rows <= capacity:
+            return
+        capacity = max(rows, capacity * 2, 1024)
+        for name, extension, row_bytes in (("vectors", "f32", 4 * self.embedder.dim), ("deleted", "u8", 1)):
+            with open(self._path(name, extension), "ab") as f:
+                f.truncate(capacity * row_bytes)
+        self._write_state(capacity=capacity)
+
+    @staticmethod
+    def _create(path: str, dtype: Any, rows: int, dim: Optional[int] = None) -> np.memmap:
+        return np.memmap(path, dtype=dtype, mode="w+", shape=(rows, dim) if dim else (rows,))
+
+    def _tombstone(self, doc_id: str) -> int:
+        count = self._state["count"]
+        rows = [i for i, (row_doc_id, _) in enumerate(self._rows[:count]) if row_doc_id == doc_id]
+        if not rows:
+            return 0
+        self._deleted[rows] = 1
+        self._deleted.flush()
+        return len(rows)
+
+    def _write_state(self, **changes: Any) -> None:
+        state = {**self._state, **changes, "embedder": self.embedder.name, "dim": self.embedder.dim,
+                 "revision": self._state.get("revision", 0) + 1}
+        tmp_path = f"{self._state_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self._state_path)
+        self._state = state
+        self._sync()
+
+def load_embedder() -> Embedder:
+    """
+    Builds the embedder from the environment: $EMBEDDER is 'hashing' (offline, deterministic) or 'openai', with
+    $EMBEDDING_MODEL and $EMBEDDING_DIM.
+    """
+    name = os.getenv("EMBEDDER", "hashing").lower()
+    if name == "openai":
+        return OpenAIEmbedder(os.getenv("EMBEDDING_MODEL", "text-embedding-3-small"),
+                              int(os.getenv("EMBEDDING_DIM", "1536")))
+    if name != "hashing":
+        raise ValueError(f"Unknown embedder '{name}', expected 'hashing' or 'openai'.")
+    return HashingEmbedder(int(os.getenv("EMBEDDING_DIM", "384")))
+
+def load_document_index() -> Optional[DocumentIndex]:
+    """
+    Builds the document index if $DOCUMENT_INDEX is enabled, else returns None. It is stored in $DOCUMENT_INDEX_DIR,
+    chunked by $DOCUMENT_CHUNK_TOKENS, and searched for $RETRIEVAL_TOP_K chunks at least $RETRIEVAL_MIN_SCORE similar to
+    the prompt.
+    """
+    if os.getenv("DOCUMENT_INDEX", "").lower() not in ("1", "true"):
+        return None
+    return DocumentIndex(
+        os.getenv("DOCUMENT_INDEX_DIR", ".cache/document_index"),
+        load_embedder(),
+        chunk_tokens=int(os.getenv("DOCUMENT_CHUNK_TOKENS", "300")),
+        top_k=int(os.getenv("RETRIEVAL_TOP_K", "4")),
+        min_score=float(os.getenv("RETRIEVAL_MIN_SCORE", "0.2")),
+    )
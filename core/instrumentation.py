@@ -0,0 +1,404 @@
+import asyncio
+import inspect
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from .metrics import MetricsRecorder
+from .token_stream import TokenSink, TokenStreamPublisher
+from .response_cache import ResponseCache, cache_key
+from typing import *
+
+if TYPE_CHECKING:
+    # LangChain is only imported to return a cached response, so that the processes which merely import the logger
+    # (e.g. the API) do not import it
+    from langchain_core.language_models import BaseChatModel
+    from langchain_core.messages import BaseMessage
+
+# USD per one million (prompt, completion) tokens, used to estimate the cost of a node's LLM calls
+MODEL_PRICING: Dict[str, Tuple[float, float]] = {
+    "gpt-4.1": (2.00, 8.00),
+    "gpt-4.1-mini": (0.40, 1.60),
+    "gpt-4.1-nano": (0.10, 0.40),
+    "gpt-4o": (2.50, 10.00),
+    "gpt-4o-mini": (0.15, 0.60),
+}
+
+class NodeMetrics:
+    """ Accumulates the timings and token usage of a single execution of a graph node. """
+    def __init__(self, node: str):
+        self.node = node
+        self.started = time.perf_counter()
+        self.duration_s: Optional[float] = None
+        self.llm_latency_s = 0.0
+        self.llm_calls = 0
+        self.search_latency_s = 0.0
+        self.searches = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cost_usd = 0.0
+        self.model: Optional[str] = None
+        # time from the start of the node's first streamed LLM call to its first token
+        self.ttft_s: Optional[float] = None
+        # where to relay the tokens of the node's streamed LLM calls, if streaming is enabled
+        self.token_sink: Optional[TokenSink] = None
+        # cache consulted before each of the node's LLM calls, if caching is enabled
+        self.response_cache: Optional[ResponseCache] = None
+        self.cache_hits = 0
+        # outcome of the speculative routing, see `core.speculation.SpeculativeRouter`
+        self.speculative_route: Optional[str] = None
+        self.speculation_hit: Optional[bool] = None
+        self.speculation_saved_s: Optional[float] = None
+        # chunks of the content summarized with a map-reduce, and how many of them were cached
+        self.chunks = 0
+        self.cached_chunks = 0
+        # passages retrieved from the document index, and the wall time of the retrieval
+        self.retrieval_latency_s: Optional[float] = None
+        self.retrieved_chunks = 0
+
+    def elapsed(self) -> float:
+        """ Wall time of the node, up to now if the node is still running. """
+        return self.duration_s if self.duration_s is not None else time.perf_counter() - self.started
+
+    def add_llm_call(self, model: Optional[str], latency_s: float, message: Any) -> None:
+        """ Records one LLM call along with the token usage reported on the returned message, if any. """
+        self.llm_calls += 1
+        self.llm_latency_s += latency_s
+        self.model = model or self.model
+        usage = getattr(message, "usage_metadata", None) or {}
+        prompt_tokens = usage.get("input_tokens", 0)
+        completion_tokens = usage.get("output_tokens", 0)
+        self.prompt_tokens += prompt_tokens
+        self.completion_tokens += completion_tokens
+        prompt_price, completion_price = MODEL_PRICING.get(model or "", (0.0, 0.0))
+        self.cost_usd += (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1e6
+
+    def merge(self, other: "NodeMetrics") -> None:
+        """ Adds the LLM calls recorded on other metrics, e.g. those of work done on this node's behalf. """
+        self.llm_calls += other.llm_calls
+        self.llm_latency_s += other.llm_latency_s
+        self.prompt_tokens += other.prompt_tokens
+        self.completion_tokens += other.completion_tokens
+        self.cost_usd += other.cost_usd
+        self.cache_hits += other.cache_hits
+        self.model = other.model or self.model
+
+    def step_fields(self) -> Dict[str, Any]:
+        """ The fields to store in this node's `TaskStep`. Fields of work the node did not do are left out. """
+        fields: Dict[str, Any] = {"duration_ms": round(self.elapsed() * 1e3, 3)}
+        if self.llm_calls:
+            fields.update(
+                llm_latency_ms=round(self.llm_latency_s * 1e3, 3),
+                prompt_tokens=self.prompt_tokens,
+                completion_tokens=self.completion_tokens,
+                cost_usd=self.cost_usd,
+                model=self.model,
+            )
+        if self.ttft_s is not None:
+            fields["ttft_ms"] = round(self.ttft_s * 1e3, 3)
+        if self.cache_hits:
+            fields["cache_hit"] = True
+        if self.searches:
+            fields["search_latency_ms"] = round(self.search_latency_s * 1e3, 3)
+        if self.speculative_route is not None:
+            fields.update(speculative_route=self.speculative_route, speculation_hit=self.speculation_hit)
+        if self.speculation_saved_s is not None:
+            fields["speculation_saved_ms"] = round(self.speculation_saved_s * 1e3, 3)
+        if self.chunks:
+            fields.update(chunks=self.chunks, cached_chunks=self.cached_chunks)
+        if self.retrieval_latency_s is not None:
+            fields.update(retrieval_latency_ms=round(self.retrieval_latency_s * 1e3, 3),
+                          retrieved_chunks=self.retrieved_chunks)
+        return fields
+
+    def samples(self, route: str) -> List[Tuple[str, float, Dict[str, str]]]:
+        """ The histogram samples of this node for the `MetricsRecorder`. """
+        labels = {"node": self.node, "route": route}
+        # the LLM samples are also labelled by model, to compare the tiers a node was run with
+        llm_labels = {**labels, "model": self.model or "unknown"}
+        samples = [("agent_node_duration_seconds", self.elapsed(), labels)]
+        if self.llm_calls:
+            samples += [
+                ("agent_llm_latency_seconds", self.llm_latency_s, llm_labels),
+                ("agent_prompt_tokens", self.prompt_tokens, llm_labels),
+                ("agent_completion_tokens", self.completion_tokens, llm_labels),
+            ]
+        if self.ttft_s is not None:
+            samples.append(("agent_llm_time_to_first_token_seconds", self.ttft_s, llm_labels))
+        if self.searches:
+            samples.append(("agent_search_latency_seconds", self.search_latency_s, labels))
+        if self.retrieval_latency_s is not None:
+            samples.append(("agent_retrieval_latency_seconds", self.retrieval_latency_s, labels))
+        return samples
+
+_current_metrics: ContextVar[Optional[NodeMetrics]] = ContextVar("current_node_metrics", default=None)
+
+def current_node_metrics() -> Optional[NodeMetrics]:
+    """ Returns the metrics of the node currently executing, or None when called outside an instrumented node. """
+    return _current_metrics.get()
+
+@contextmanager
+def use_node_metrics(metrics: NodeMetrics) -> Iterator[NodeMetrics]:
+    """ Makes `metrics` the current node's metrics for the enclosed calls, e.g. on a thread working for a node. """
+    token = _current_metrics.set(metrics)
+    try:
+        yield metrics
+    finally:
+        _current_metrics.reset(token)
+
+def _model_name(llm: Any) -> Optional[str]:
+    return getattr(llm, "model_name", None) or getattr(llm, "model", None)
+
+def _llm_cache_key(metrics: Optional[NodeMetrics], llm: Any, prompt: Any) -> Optional[str]:
+    """ Cache key of an LLM call made by the current node, or None if the node does not cache its calls. """
+    if metrics is None or metrics.response_cache is None:
+        return None
+    # keyed on the exact prompt: the prompts of the nodes embed code and documents, whose case and spacing matter
+    return cache_key("llm", str(prompt), metrics.node, _model_name(llm), normalize=False)
+
+def _cached_message(metrics: Optional[NodeMetrics], key: Optional[str], stream: bool,
+                    start: float) -> Optional["BaseMessage"]:
+    """ The cached response of an LLM call, relayed to the node's token sink if streamed, or None on a miss. """
+    if key is None:
+        return None
+    cached = metrics.response_cache.get(key)
+    if cached is None:
+        return None
+    metrics.cache_hits += 1
+    if stream and metrics.token_sink is not None:
+        metrics.ttft_s = metrics.ttft_s or time.perf_counter() - start
+        metrics.token_sink.write(cached["content"])
+        metrics.token_sink.flush()
+    from langchain_core.messages import AIMessage
+    return AIMessage(content=cached["content"])
+
+def _streams(metrics: Optional[NodeMetrics], stream: bool) -> bool:
+    return stream and metrics is not None and metrics.token_sink is not None
+
+def _aggregate_chunk(metrics: NodeMetrics, message: Optional["BaseMessage"], chunk: "BaseMessage",
+                     start: float) -> "BaseMessage":
+    """ Records the time to first token of a streamed chunk, returning the aggregate of the chunks so far. """
+    if metrics.ttft_s is None and chunk.content:
+        metrics.ttft_s = time.perf_counter() - start
+    return chunk if message is None else message + chunk
+
+def _relay_chunk(metrics: NodeMetrics, message: Optional["BaseMessage"], chunk: "BaseMessage",
+                 start: float) -> "BaseMessage":
+    """ Relays a streamed chunk to the node's token sink, returning the aggregate of the chunks so far. """
+    message = _aggregate_chunk(metrics, message, chunk, start)
+    metrics.token_sink.write(chunk.content)
+    return message
+
+def _record_llm_call(metrics: Optional[NodeMetrics], llm: Any, start: float, message: "BaseMessage") -> None:
+    if metrics is not None:
+        metrics.add_llm_call(_model_name(llm), time.perf_counter() - start, message)
+
+def _cache_message(metrics: Optional[NodeMetrics], key: Optional[str], message: "BaseMessage") -> None:
+    if key is not None:
+        metrics.response_cache.set(key, {"content": message.content})
+
+def invoke_llm(llm: "BaseChatModel", prompt: Any, stream: bool = False) -> "BaseMessage":
+    """
+    Invokes the LLM, recording the latency and token usage of the call on the current node.
+    :param llm:     LLM object instance.
+    :param prompt:  Input passed to `llm.invoke`.
+    :param stream:  Whether the response is meant for the user. If so, and the current node has a token sink (i.e.
+                    token streaming is enabled), the response is streamed through `llm.stream` and every token is
+                    relayed to the sink as it arrives.
+    :return:        The message returned by the LLM. When streamed, this is the aggregate of the streamed chunks.
+    """
+    metrics = current_node_metrics()
+    start = time.perf_counter()
+    key = _llm_cache_key(metrics, llm, prompt)
+    cached = _cached_message(metrics, key, stream, start)
+    if cached is not None:
+        return cached
+    if _streams(metrics, stream):
+        message = None
+        for chunk in llm.stream(prompt):
+            message = _relay_chunk(metrics, message, chunk, start)
+        metrics.token_sink.flush()
+    else:
+        message = llm.invoke(prompt)
+    _record_llm_call(metrics, llm, start, message)
+    _cache_message(metrics, key, message)
+    return message
+
+async def ainvoke_llm(llm: "BaseChatModel", prompt: Any, stream: bool = False) -> "BaseMessage":
+    """
+    Asynchronous counterpart of `invoke_llm`, awaiting `llm.ainvoke` (or `llm.astream`) so that the event loop runs
+    other tasks while the LLM answers. The round trips to Redis of the cache and the token sink run on threads, so that
+    they do not hold up the other graphs on the loop.
+    :param llm:     LLM object instance.
+    :param prompt:  Input passed to `llm.ainvoke`.
+    :param stream:  See `invoke_llm`.
+    :return:        The message returned by the LLM.
+    """
+    metrics = current_node_metrics()
+    start = time.perf_counter()
+    key = _llm_cache_key(metrics, llm, prompt)
+    if key is not None:
+        cached = await asyncio.to_thread(_cached_message, metrics, key, stream, start)
+        if cached is not None:
+            return cached
+    if _streams(metrics, stream):
+        message = None
+        async for chunk in llm.astream(prompt):
+            message = _aggregate_chunk(metrics, message, chunk, start)
+            if metrics.token_sink.buffer(chunk.content):
+                await asyncio.to_thread(metrics.token_sink.flush)
+        await asyncio.to_thread(metrics.token_sink.flush)
+    else:
+        message = await llm.ainvoke(prompt)
+    _record_llm_call(metrics, llm, start, message)
+    if key is not None:
+        await asyncio.to_thread(_cache_message, metrics, key, message)
+    return message
+
+def _cached_structured(metrics: Optional[NodeMetrics], key: Optional[str]) -> Optional[Any]:
+    if key is None:
+        return None
+    cached = metrics.response_cache.get(key)
+    if cached is not None:
+        metrics.cache_hits += 1
+    return cached
+
+def _record_structured_call(metrics: Optional[NodeMetrics], llm: Any, start: float,
+                            output: Dict[str, Any]) -> Optional[Any]:
+    """ Records a structured LLM call, returning its parsed output. """
+    if metrics is not None:
+        metrics.add_llm_call(_model_name(llm), time.perf_counter() - start, output.get("raw"))
+    return output.get("parsed")
+
+def _cache_structured(metrics: Optional[NodeMetrics], key: Optional[str], parsed: Optional[Any]) -> None:
+    if key is not None and parsed is not None:
+        metrics.response_cache.set(key, parsed)
+
+def invoke_structured_llm(llm: "BaseChatModel", schema: Any, prompt: Any) -> Optional[Any]:
+    """
+    Invokes the LLM with a structured output schema, recording the latency and token usage of the call on the current
+    node. The raw message is requested alongside the parsed output since only the former carries the token usage.
+    :param llm:     LLM object instance.
+    :param schema:  Schema passed to `llm.with_structured_output`.
+    :param prompt:  Input passed to the structured LLM.
+    :return:        The parsed output, or None if the LLM output could not be parsed.
+    """
+    metrics = current_node_metrics()
+    key = _llm_cache_key(metrics, llm, prompt)
+    cached = _cached_structured(metrics, key)
+    if cached is not None:
+        return cached
+    structured_llm = llm.with_structured_output(schema, include_raw=True)
+    start = time.perf_counter()
+    output = structured_llm.invoke(prompt)
+    parsed = _record_structured_call(metrics, llm, start, output)
+    _cache_structured(metrics, key, parsed)
+    return parsed
+
+async def ainvoke_structured_llm(llm: "BaseChatModel", schema: Any, prompt: Any) -> Optional[Any]:
+    """ Asynchronous counterpart of `invoke_structured_llm`, with the cache's round trips run on threads. """
+    metrics = current_node_metrics()
+    key = _llm_cache_key(metrics, llm, prompt)
+    if key is not None:
+        cached = await asyncio.to_thread(_cached_structured, metrics, key)
+        if cached is not None:
+            return cached
+    structured_llm = llm.with_structured_output(schema, include_raw=True)
+    start = time.perf_counter()
+    output = await structured_llm.ainvoke(prompt)
+    parsed = _record_structured_call(metrics, llm, start, output)
+    if key is not None:
+        await asyncio.to_thread(_cache_structured, metrics, key, parsed)
+    return parsed
+
+@contextmanager
+def record_search_latency() -> Iterator[None]:
+    """ Context manager which records the wall time of the enclosed web search on the current node. """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics = current_node_metrics()
+        if metrics is not None:
+            metrics.searches += 1
+            metrics.search_latency_s += time.perf_counter() - start
+
+@contextmanager
+def record_retrieval() -> Iterator[List[Any]]:
+    """
+    Context manager which records the wall time of the enclosed document retrieval on the current node, along with the
+    number of passages appended to the list it yields.
+    """
+    passages: List[Any] = []
+    start = time.perf_counter()
+    try:
+        yield passages
+    finally:
+        metrics = current_node_metrics()
+        if metrics is not None:
+            metrics.retrieval_latency_s = (metrics.retrieval_latency_s or 0.0) + time.perf_counter() - start
+            metrics.retrieved_chunks += len(passages)
+
+def _route_of(state: Dict[str, Any], result: Any) -> str:
+    """ The route a node ran on, taking the classification from the node's own output if it just made it. """
+    updates = getattr(result, "update", result)
+    for source in (updates, state):
+        classification = source.get("task_classification") if isinstance(source, dict) else None
+        if classification:
+            return classification.get("task") or "unknown"
+    return "unknown"
+
+def instrument_node(node_name: str, node: Callable[[Dict[str, Any]], Any],
+                    recorder: Optional[MetricsRecorder] = None,
+                    token_stream: Optional[TokenStreamPublisher] = None,
+                    response_cache: Optional[ResponseCache] = None) -> Callable[[Dict[str, Any]], Any]:
+    """
+    Wraps a graph node so that its wall time, LLM latency, token usage and search latency are measured. While the node
+    runs, its `NodeMetrics` are available through `current_node_metrics`, which is how `MongoDBLogger.log_step` stores
+    them in the node's `TaskStep`. Once the node returns, the metrics are exported as histograms through the recorder.
+    :param node_name:   Name of the node in the graph.
+    :param node:        The node itself, either a function or a coroutine function (the wrapper is of the same kind).
+    :param recorder:    Where to export the metrics, or None to only store them in the task log.
+    :param token_stream: Where to stream the tokens of the node's user-facing LLM calls, or None to not stream.
+    :param response_cache: Cache of the node's LLM calls, keyed by the prompt, the node and the model.
+    :return:            The instrumented node.
+    """
+    def start(state: Dict[str, Any]) -> Tuple[NodeMetrics, Any]:
+        metrics = NodeMetrics(node_name)
+        metrics.response_cache = response_cache
+        if token_stream is not None:
+            metrics.token_sink = token_stream.sink(state["task_id"], node_name)
+        return metrics, _current_metrics.set(metrics)
+
+    def finish(state: Dict[str, Any], metrics: NodeMetrics, result: Any) -> None:
+        if recorder is not None:
+            route = _route_of(state, result)
+            recorder.observe_many(metrics.samples(route))
+            if metrics.cost_usd:
+                recorder.inc("agent_llm_cost_usd_total", {"node": node_name, "route": route, "model": metrics.model},
+                             metrics.cost_usd)
+
+    def instrumented(state: Dict[str, Any]) -> Any:
+        metrics, token = start(state)
+        try:
+            result = node(state)
+        finally:
+            metrics.duration_s = time.perf_counter() - metrics.started
+            _current_metrics.reset(token)
+        finish(state, metrics, result)
+        return result
+
+    async def ainstrumented(state: Dict[str, Any]) -> Any:
+        # every task runs in its own asyncio task, hence its own copy of the context, so the metrics of concurrent
+        # nodes on the same event loop never mix
+        metrics, token = start(state)
+        try:
+            result = await node(state)
+        finally:
+            metrics.duration_s = time.perf_counter() - metrics.started
+            _current_metrics.reset(token)
+        if recorder is not None:
+            # the export is a round trip to Redis, which would hold up every graph on the loop
+            await asyncio.to_thread(finish, state, metrics, result)
+        return result
+
+    return ainstrumented if inspect.iscoroutinefunction(node) else instrumented
@@ -0,0 +1,484 @@
+import os
+import time
+import math
+import random
+import asyncio
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future, FIRST_COMPLETED, wait
+import openai
+import redis
+from .metrics import MetricsRecorder
+from typing import *
+
+_KEY_PREFIX = "llm_budget"
+# errors worth another attempt, with the reason they are counted under
+_RETRYABLE: Tuple[Tuple[Type[Exception], str], ...] = (
+    (openai.RateLimitError, "rate_limited"),
+    (openai.APITimeoutError, "timeout"),
+    (openai.APIConnectionError, "connection"),
+    (openai.InternalServerError, "server_error"),
+)
+# latencies of the recent calls of a model which the hedging delay is the percentile of, and how many of them are
+# needed before any call is hedged
+_LATENCY_WINDOW = 200
+_MIN_LATENCY_SAMPLES = 20
+
+# Takes a request and an estimate of its tokens from the budget of a model, refilled continuously at its per-minute
+# limits up to one minute's worth, unless a cooldown is in force (see `_COOLDOWN_SCRIPT`).
+# KEYS[1]: budget of the model, KEYS[2]: cooldown of the model. ARGV: requests per minute, tokens per minute, tokens.
+# Returns: '0' once taken, else the seconds to wait before the budget can cover the request.
+_ACQUIRE_SCRIPT = """
+local now = redis.call('TIME')
+now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+local cooldown = tonumber(redis.call('GET', KEYS[2]) or '0')
+if cooldown > now then
+    return tostring(cooldown - now)
+end
+local rpm, tpm, cost = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local state = redis.call('HMGET', KEYS[1], 'requests', 'tokens', 'ts')
+local elapsed = math.max(0, now - (tonumber(state[3]) or now))
+local requests = math.min(rpm, (tonumber(state[1]) or rpm) + elapsed * rpm / 60)
+local tokens = math.min(tpm, (tonumber(state[2]) or tpm) + elapsed * tpm / 60)
+-- a request larger than a minute's worth of tokens waits for a full budget rather than forever
+cost = math.min(cost, tpm)
+local delay = 0
+if rpm > 0 and requests < 1 then
+    delay = (1 - requests) * 60 / rpm
+end
+if tpm > 0 and tokens < cost then
+    delay = math.max(delay, (cost - tokens) * 60 / tpm)
+end
+if delay > 0 then
+    return tostring(delay)
+end
+redis.call('HSET', KEYS[1], 'requests', tostring(requests - 1), 'tokens', tostring(tokens - cost), 'ts', tostring(now))
+redis.call('EXPIRE', KEYS[1], 120)
+return '0'
+"""
+
+# Stops every process from calling a model for the given seconds, e.g. after the provider answered with a 429.
+# KEYS[1]: cooldown of the model. ARGV[1]: seconds.
+_COOLDOWN_SCRIPT = """
+local now = redis.call('TIME')
+now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+local until_ = now + tonumber(ARGV[1])
+if until_ > tonumber(redis.call('GET', KEYS[1]) or '0') then
+    redis.call('SET', KEYS[1], tostring(until_), 'PX', math.ceil(tonumber(ARGV[1]) * 1000))
+end
+return 1
+"""
+
+class LLMBudgetExhausted(Exception):
+    """ The budget of a model could not cover a call within the longest wait allowed. """
+
+def parse_model_limits(spec: str) -> Dict[str, Tuple[float, float]]:
+    """ Parses a 'model=rpm/tpm,...' assignment, e.g. 'gpt-4.1=500/30000,gpt-4.1-mini=500/200000'. """
+    limits = {}
+    for item in spec.split(","):
+        if not item.strip():
+            continue
+        model, sep, rates = item.partition("=")
+        rpm, slash, tpm = rates.partition("/")
+        if not sep or not slash or not model.strip():
+            raise ValueError(f"Invalid model rate limit '{item}', expected 'model=rpm/tpm'.")
+        limits[model.strip()] = (float(rpm), float(tpm))
+    return limits
+
+def _usage_tokens(output: Any) -> Optional[int]:
+    """ Total tokens of an LLM response (or of the raw message of a structured output), if it reports them. """
+    message = output.get("raw") if isinstance(output, dict) else output
+    usage = getattr(message, "usage_metadata", None)
+    return usage.get("total_tokens") if usage else None
+
+def _retry_reason(error: Exception) -> Optional[str]:
+    return next((reason for kind, reason in _RETRYABLE if isinstance(error, kind)), None)
+
+def _retry_after(error: Exception) -> Optional[float]:
+    """ The delay the provider asked for, from the `Retry-After` header of its error response. """
+    response = getattr(error, "response", None)
+    value = response.headers.get("retry-after") if response is not None else None
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+class LLMGovernor:
+    """
+    Puts every LLM call of the cluster under one budget per model, so that a burst of tasks queues on the budget rather
+    than drawing waves of 429s from the provider:
+    * a call first takes one request and an estimate of its tokens from the model's budget in Redis, refilled at the
+      model's requests and tokens per minute, and waits for it if it is spent. Once answered, the estimate is settled
+      against the tokens the call actually used,
+    * a call which fails with a rate limit, a timeout, a connection or a server error is retried with an exponential
+      backoff and full jitter (or after the provider's `Retry-After`). A rate limit also stops the whole cluster from
+      calling the model until the backoff has passed,
+    * optionally, a call not answered within a percentile of the model's recent latencies is hedged: a duplicate request
+      is sent (if the budget covers it right away) and whichever answers first is used. Streamed calls are never hedged,
+      their tokens already being relayed to the user.
+    The LLM clients are wrapped with `govern`, so every node, the summarizer and the speculative router go through it.
+    """
+    def __init__(self, redis_url: Optional[str] = None, limits: Optional[Dict[str, Tuple[float, float]]] = None,
+                 default_limits: Tuple[float, float] = (0.0, 0.0), max_wait: float = 60.0, max_retries: int = 2,
+                 backoff_base: float = 0.5, backoff_max: float = 20.0, completion_tokens: int = 500,
+                 hedge_percentile: float = 0.0, hedge_min_delay: float = 1.0, hedge_max_workers: int = 16,
+                 metrics: Optional[MetricsRecorder] = None):
+        """
+        :param redis_url:           Defaults to $REDIS_URL. Only needed if a model has a rate limit.
+        :param limits:              (requests per minute, tokens per minute) of every model, 0 meaning unlimited.
+        :param default_limits:      The limits of the models missing from `limits`.
+        :param max_wait:            Longest time a call waits for the budget before failing.
+        :param max_retries:         Retries of a failed call, which the governor makes instead of the client.
+        :param backoff_base:        Upper bound of the first backoff, doubled on every retry.
+        :param backoff_max:         Upper bound of any backoff.
+        :param completion_tokens:   Completion tokens a call is assumed to use until it is answered.
+        :param hedge_percentile:    Percentile (e.g. 95) of a model's recent latencies after which a call is hedged,
+                                    0 to never hedge.
+        :param hedge_min_delay:     Shortest time a call is left alone before being hedged.
+        :param hedge_max_workers:   Threads running the duplicates of the hedged synchronous calls. A call is not
+                                    hedged while they are all busy.
+        :param metrics:             Where to count the retries and hedges and observe the budget waits.
+        """
+        self.limits = limits or {}
+        self.default_limits = default_limits
+        self.redis: Optional[redis.Redis] = None
+        if any(rate > 0 for rates in (*self.limits.values(), default_limits) for rate in rates):
+            redis_url = redis_url or os.getenv("REDIS_URL")
+            if not redis_url:
+                raise ValueError("REDIS_URL environment variable not set.")
+            self.redis = redis.Redis.from_url(redis_url, decode_responses=True)
+            self._acquire = self.redis.register_script(_ACQUIRE_SCRIPT)
+            self._cooldown = self.redis.register_script(_COOLDOWN_SCRIPT)
+        self.max_wait = max_wait
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.completion_tokens = completion_tokens
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_delay = hedge_min_delay
+        self.metrics = metrics
+        self._latencies: Dict[str, Deque[float]] = {}
+        self._latencies_lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=hedge_max_workers, thread_name_prefix="llm-hedge") \
+            if hedge_percentile > 0 else None
+        # the duplicates in flight, so that one is only sent when a thread of the pool can run it right away
+        self._hedge_slots = threading.BoundedSemaphore(hedge_max_workers)
+
+    def govern(self, llm: Any) -> "GovernedChatModel":
+        """ Wraps an LLM client so that its calls go through the governor. """
+        return GovernedChatModel(llm, self)
+
+    # ---------------------------------------------------------------------------------------------------------------
+    # Budget
+    # ---------------------------------------------------------------------------------------------------------------
+    def _limits(self, model: str) -> Tuple[float, float]:
+        return self.limits.get(model, self.default_limits)
+
+    def _estimate(self, prompt: Any) -> int:
+        # about 4 characters per token, plus the completion the call is assumed to use
+        return len(str(prompt)) // 4 + self.completion_tokens
+
+    def _try_acquire(self, model: str, tokens: int) -> float:
+        """ Takes a call from the model's budget, returning 0, or the seconds to wait if the budget is spent. """
+        rpm, tpm = self._limits(model)
+        if self.redis is None or (rpm <= 0 and tpm <= 0):
+            return 0.0
+        try:
+            return float(self._acquire(keys=[f"{_KEY_PREFIX}:{model}", f"{_KEY_PREFIX}:{model}:cooldown"],
+                                       args=[rpm, tpm, tokens]))
+        except redis.RedisError as e:
+            # the provider's own limits still apply, and its 429s are retried
+            print(f"Failed to take an LLM call from the budget of {model}, calling anyway. Error: \n{e}")
+            return 0.0
+
+    def _observe_wait(self, model: str, waited: float) -> None:
+        if self.metrics is not None and self.redis is not None:
+            self.metrics.observe("agent_llm_budget_wait_seconds", waited, {"model": model})
+
+    def acquire(self, model: str, tokens: int) -> None:
+        """ Waits until the model's budget covers a call, and takes it. """
+        start = time.perf_counter()
+        while (delay := self._try_acquire(model, tokens)) > 0:
+            if time.perf_counter() - start + delay > self.max_wait:
+                raise LLMBudgetExhausted(f"The budget of {model} could not cover a call within {self.max_wait:g} s.")
+            # a little jitter so that the processes woken up together do not all retry at once
+            time.sleep(delay * random.uniform(1.0, 1.2))
+        self._observe_wait(model, time.perf_counter() - start)
+
+    async def aacquire(self, model: str, tokens: int) -> None:
+        """
+        Asynchronous counterpart of `acquire`. Like every round trip to Redis of the asynchronous calls, the script
+        runs on a thread so that it does not hold up the other calls on the loop.
+        """
+        start = time.perf_counter()
+        while (delay := await asyncio.to_thread(self._try_acquire, model, tokens)) > 0:
+            if time.perf_counter() - start + delay > self.max_wait:
+                raise LLMBudgetExhausted(f"The budget of {model} could not cover a call within {self.max_wait:g} s.")
+            await asyncio.sleep(delay * random.uniform(1.0, 1.2))
+        await asyncio.to_thread(self._observe_wait, model, time.perf_counter() - start)
+
+    def _settle(self, model: str, reserved: int, output: Any) -> None:
+        """ Gives back the tokens a call reserved but did not use, or takes those it used beyond its estimate. """
+        used = _usage_tokens(output)
+        if self.redis is None or used is None or used == reserved or self._limits(model)[1] <= 0:
+            return
+        try:
+            self.redis.hincrbyfloat(f"{_KEY_PREFIX}:{model}", "tokens", reserved - used)
+        except redis.RedisError as e:
+            print(f"Failed to settle the tokens of an LLM call to {model}. Error: \n{e}")
+
+    def _penalize(self, model: str, seconds: float) -> None:
+        """ Pauses every call to the model across the cluster. """
+        if self.redis is None:
+            return
+        try:
+            self._cooldown(keys=[f"{_KEY_PREFIX}:{model}:cooldown"], args=[seconds])
+        except redis.RedisError as e:
+            print(f"Failed to pause the LLM calls to {model}. Error: \n{e}")
+
+    # ---------------------------------------------------------------------------------------------------------------
+    # Retries
+    # ---------------------------------------------------------------------------------------------------------------
+    def _backoff(self, model: str, error: Exception, attempt: int) -> Optional[float]:
+        """ The delay before retrying a failed call, or None if it must not be retried. """
+        reason = _retry_reason(error)
+        if reason is None or attempt >= self.max_retries:
+            return None
+        delay = _retry_after(error)
+        if delay is None:
+            delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+        if reason == "rate_limited":
+            self._penalize(model, delay)
+        if self.metrics is not None:
+            self.metrics.inc("agent_llm_retries_total", {"model": model, "reason": reason})
+        return delay
+
+    def call(self, model: str, prompt: Any, invoke: Callable[[], Any], hedge: bool = True) -> Any:
+        """
+        Makes a call under the model's budget, retrying it on transient errors.
+        :param model:   The model called.
+        :param prompt:  The prompt, to estimate the tokens of the call.
+        :param invoke:  Makes the call.
+        :param hedge:   Whether the call may be hedged.
+        :return:        What the call returned.
+        """
+        tokens = self._estimate(prompt)
+        for attempt in range(self.max_retries + 1):
+            self.acquire(model, tokens)
+            try:
+                return self._hedged(model, tokens, invoke) if hedge else self._attempt(model, tokens, invoke)
+            except Exception as e:
+                delay = self._backoff(model, e, attempt)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+
+    async def acall(self, model: str, prompt: Any, invoke: Callable[[], Awaitable[Any]], hedge: bool = True) -> Any:
+        """ Asynchronous counterpart of `call`. """
+        tokens = self._estimate(prompt)
+        for attempt in range(self.max_retries + 1):
+            await self.aacquire(model, tokens)
+            try:
+                return await (self._ahedged(model, tokens, invoke) if hedge else
+                              self._aattempt(model, tokens, invoke))
+            except Exception as e:
+                delay = await asyncio.to_thread(self._backoff, model, e, attempt)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+
+    def stream(self, model: str, prompt: Any, stream: Callable[[], Iterator[Any]]) -> Iterator[Any]:
+        """ Streams a call under the model's budget, retrying it on transient errors until its first chunk. """
+        tokens = self._estimate(prompt)
+        for attempt in range(self.max_retries + 1):
+            self.acquire(model, tokens)
+            started, last = False, None
+            try:
+                for chunk in stream():
+                    started, last = True, chunk
+                    yield chunk
+                # the usage arrives on the last chunk
+                self._settle(model, tokens, last)
+                return
+            except Exception as e:
+                delay = None if started else self._backoff(model, e, attempt)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+
+    async def astream(self, model: str, prompt: Any, stream: Callable[[], AsyncIterator[Any]]) -> AsyncIterator[Any]:
+        """ Asynchronous counterpart of `stream`. """
+        tokens = self._estimate(prompt)
+        for attempt in range(self.max_retries + 1):
+            await self.aacquire(model, tokens)
+            started, last = False, None
+            try:
+                async for chunk in stream():
+                    started, last = True, chunk
+                    yield chunk
+                await asyncio.to_thread(self._settle, model, tokens, last)
+                return
+            except Exception as e:
+                delay = None if started else await asyncio.to_thread(self._backoff, model, e, attempt)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+
+    # ---------------------------------------------------------------------------------------------------------------
+    # Hedging
+    # ---------------------------------------------------------------------------------------------------------------
+    def _record_latency(self, model: str, latency: float) -> None:
+        with self._latencies_lock:
+            self._latencies.setdefault(model, deque(maxlen=_LATENCY_WINDOW)).append(latency)
+
+    def hedge_delay(self, model: str) -> Optional[float]:
+        """ The time after which a call to the model is hedged, or None if its calls are not hedged (yet). """
+        if self.hedge_percentile <= 0:
+            return None
+        with self._latencies_lock:
+            latencies = sorted(self._latencies.get(model, ()))
+        if len(latencies) < _MIN_LATENCY_SAMPLES:
+            return None
+        rank = max(0, math.ceil(self.hedge_percentile / 100 * len(latencies)) - 1)
+        return max(self.hedge_min_delay, latencies[rank])
+
+    def _attempt(self, model: str, tokens: int, invoke: Callable[[], Any]) -> Any:
+        start = time.perf_counter()
+        output = invoke()
+        self._record_latency(model, time.perf_counter() - start)
+        self._settle(model, tokens, output)
+        return output
+
+    async def _aattempt(self, model: str, tokens: int, invoke: Callable[[], Awaitable[Any]]) -> Any:
+        start = time.perf_counter()
+        output = await invoke()
+        self._record_latency(model, time.perf_counter() - start)
+        await asyncio.to_thread(self._settle, model, tokens, output)
+        return output
+
+    def _count_hedge(self, model: str, winner: str) -> None:
+        if self.metrics is not None:
+            self.metrics.inc("agent_llm_hedges_total", {"model": model, "winner": winner})
+
+    def _run_attempt(self, future: Future, model: str, tokens: int, invoke: Callable[[], Any]) -> None:
+        """ Runs an attempt on the current thread, resolving the future with its outcome. """
+        try:
+            future.set_result(self._attempt(model, tokens, invoke))
+        except BaseException as e:
+            future.set_exception(e)
+
+    def _hedged(self, model: str, tokens: int, invoke: Callable[[], Any]) -> Any:
+        delay = self.hedge_delay(model)
+        if delay is None:
+            return self._attempt(model, tokens, invoke)
+        # The primary attempt starts right away on a thread of its own, while the calling thread waits for the delay:
+        # going through the pool would cap the calls in flight, and the time queued in it would count towards the delay,
+        # hedging the calls precisely when the pool is saturated. Only the duplicates run on the pool.
+        primary = Future()
+        threading.Thread(target=self._run_attempt, args=(primary, model, tokens, invoke), name="llm-call",
+                         daemon=True).start()
+        if wait([primary], timeout=delay).done or not self._hedge_slots.acquire(blocking=False):
+            # answered in time, or every thread of the pool is already running a duplicate
+            return primary.result()
+        if self._try_acquire(model, tokens) > 0:
+            # the budget cannot spare a duplicate right now
+            self._hedge_slots.release()
+            return primary.result()
+        hedge = self._pool.submit(self._attempt, model, tokens, invoke)
+        hedge.add_done_callback(lambda _: self._hedge_slots.release())
+        done, _ = wait([primary, hedge], return_when=FIRST_COMPLETED)
+        # a failed attempt leaves the call to the other one; the slower one runs to completion in the background, where
+        # it settles its own tokens
+        first: Future = primary if primary in done else hedge
+        second: Future = hedge if first is primary else primary
+        if first.exception() is not None:
+            wait([second])
+            if second.exception() is not None:
+                raise primary.exception()
+            first = second
+        self._count_hedge(model, "primary" if first is primary else "hedge")
+        return first.result()
+
+    async def _ahedged(self, model: str, tokens: int, invoke: Callable[[], Awaitable[Any]]) -> Any:
+        delay = self.hedge_delay(model)
+        if delay is None:
+            return await self._aattempt(model, tokens, invoke)
+        primary = asyncio.ensure_future(self._aattempt(model, tokens, invoke))
+        done, _ = await asyncio.wait([primary], timeout=delay)
+        if done or await asyncio.to_thread(self._try_acquire, model, tokens) > 0:
+            return await primary
+        hedge = asyncio.ensure_future(self._aattempt(model, tokens, invoke))
+        attempts = [primary, hedge]
+        try:
+            while attempts:
+                done, _ = await asyncio.wait(attempts, return_when=asyncio.FIRST_COMPLETED)
+                for attempt in done:
+                    attempts.remove(attempt)
+                    if attempt.exception() is None:
+                        await asyncio.to_thread(self._count_hedge, model, "primary" if attempt is primary else "hedge")
+                        return attempt.result()
+            raise primary.exception()
+        finally:
+            # unlike a thread, the slower attempt can be cancelled; the tokens it reserved stay taken
+            for attempt in attempts:
+                attempt.cancel()
+
+    def close(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+        if self.redis is not None:
+            self.redis.close()
+
+class GovernedChatModel:
+    """
+    An LLM client whose calls go through an `LLMGovernor`. It exposes the calls the graph makes (`invoke`, `ainvoke`,
+    `stream`, `astream` and `with_structured_output`) and passes any other attribute through to the client.
+    """
+    def __init__(self, llm: Any, governor: LLMGovernor, model_name: Optional[str] = None):
+        self.llm = llm
+        self.governor = governor
+        self.model_name = model_name or getattr(llm, "model_name", None) or getattr(llm, "model", None)
+
+    def invoke(self, prompt: Any, *args, **kwargs) -> Any:
+        return self.governor.call(self.model_name, prompt, lambda: self.llm.invoke(prompt, *args, **kwargs))
+
+    async def ainvoke(self, prompt: Any, *args, **kwargs) -> Any:
+        return await self.governor.acall(self.model_name, prompt, lambda: self.llm.ainvoke(prompt, *args, **kwargs))
+
+    def stream(self, prompt: Any, *args, **kwargs) -> Iterator[Any]:
+        return self.governor.stream(self.model_name, prompt, lambda: self.llm.stream(prompt, *args, **kwargs))
+
+    def astream(self, prompt: Any, *args, **kwargs) -> AsyncIterator[Any]:
+        return self.governor.astream(self.model_name, prompt, lambda: self.llm.astream(prompt, *args, **kwargs))
+
+    def with_structured_output(self, schema: Any, **kwargs) -> "GovernedChatModel":
+        return GovernedChatModel(self.llm.with_structured_output(schema, **kwargs), self.governor, self.model_name)
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.llm, name)
+
+def load_llm_governor(metrics: Optional[MetricsRecorder] = None) -> Optional[LLMGovernor]:
+    """
+    Builds the LLM governor from the environment, if enabled by a rate limit or by hedging: $LLM_RPM and $LLM_TPM are
+    the limits of every model, overridden per model by $LLM_MODEL_LIMITS ('model=rpm/tpm,...'). The calls wait for the
+    budget for at most $LLM_BUDGET_MAX_WAIT_SECONDS, are retried $LLM_MAX_RETRIES times with backoffs starting under
+    $LLM_BACKOFF_BASE_SECONDS and capped at $LLM_BACKOFF_MAX_SECONDS, and reserve $LLM_EXPECTED_COMPLETION_TOKENS
+    completion tokens. $LLM_HEDGE_PERCENTILE enables hedging, no sooner than $LLM_HEDGE_MIN_DELAY_SECONDS.
+    """
+    limits = parse_model_limits(os.getenv("LLM_MODEL_LIMITS", ""))
+    default_limits = (float(os.getenv("LLM_RPM", "0")), float(os.getenv("LLM_TPM", "0")))
+    hedge_percentile = float(os.getenv("LLM_HEDGE_PERCENTILE", "0"))
+    if not limits and not any(default_limits) and hedge_percentile <= 0:
+        return None
+    return LLMGovernor(
+        limits=limits,
+        default_limits=default_limits,
+        max_wait=float(os.getenv("LLM_BUDGET_MAX_WAIT_SECONDS", "60")),
+        max_retries=int(os.getenv("LLM_MAX_RETRIES", "2")),
+        backoff_base=float(os.getenv("LLM_BACKOFF_BASE_SECONDS", "0.5")),
+        backoff_max=float(os.getenv("LLM_BACKOFF_MAX_SECONDS", "20")),
+        completion_tokens=int(os.getenv("LLM_EXPECTED_COMPLETION_TOKENS", "500")),
+        hedge_percentile=hedge_percentile,
+        hedge_min_delay=float(os.getenv("LLM_HEDGE_MIN_DELAY_SECONDS", "1.0")),
+        metrics=metrics,
+    )
@@ -0,0 +1,208 @@
+import os
+import re
+import numpy as np
+from typing import *
+
+# Keyword rules which are confident enough to route a prompt on their own. A rule only decides when exactly one route
+# matches, e.g. "summarize this python script" is left to the model (or the LLM). The code rule is limited to tokens
+# which hardly appear outside of code questions, words like "function" or "class" are left to the model.
+KEYWORD_RULES: Dict[str, re.Pattern] = {
+    "code": re.compile(
+        r"```|(?<![\w+#])(c\+\+|c#)(?![\w+#])|\b(python|javascript|typescript|java|golang|kotlin|sql|regex|powershell|"
+        r"stack ?trace|traceback)\b", re.IGNORECASE),
+    "summarize": re.compile(r"\b(summari[sz]e|summary|tl;?dr|condense|key points|main points|recap)\b", re.IGNORECASE),
+    "content": re.compile(
+        r"\b(blog|article|essay|newsletter|press release|social media post|linkedin post|tweet|copywriting|"
+        r"write (me )?(a|an) (post|story|piece))\b", re.IGNORECASE),
+}
+# confidence given to a decision made by the keyword rules until their agreement with the LLM has been measured by
+# `scripts/train_local_classifier.py`, which saves it with the model. It is below the default threshold, so that rules
+# nobody measured never skip the LLM.
+DEFAULT_RULE_CONFIDENCE = 0.5
+# minimum confidence for a local decision to be used instead of the LLM's
+DEFAULT_THRESHOLD = 0.8
+# prefix of the `choice_summary` of local decisions, which lets the training script tell them apart from the LLM's
+LOCAL_CHOICE_PREFIX = "local classifier"
+
+_TOKEN_PATTERN = re.compile(r"[a-z0-9+#]+")
+
+def _tokenize(text: str) -> List[str]:
+    """ Lowercased word unigrams and bigrams. """
+    words = _TOKEN_PATTERN.findall(text.lower())
+    return words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+
+class LocalTaskClassifier:
+    """
+    Routes a prompt to one of the agents without a network call: first through the keyword rules, then through a
+    TF-IDF + softmax regression model trained on the routing decisions the LLM logged to MongoDB (see
+    `scripts/train_local_classifier.py`). Both only answer when their confidence reaches the threshold, otherwise the
+    LLM router is used.
+    """
+    def __init__(self, labels: Sequence[str], vocabulary: Optional[Dict[str, int]] = None,
+                 idf: Optional[np.ndarray] = None, weights: Optional[np.ndarray] = None,
+                 bias: Optional[np.ndarray] = None, threshold: float = DEFAULT_THRESHOLD,
+                 rule_confidence: float = DEFAULT_RULE_CONFIDENCE):
+        self.labels = list(labels)
+        self.threshold = threshold
+        self.rule_confidence = rule_confidence
+        self.vocabulary = vocabulary or {}
+        self.idf = idf
+        self.weights = weights
+        self.bias = bias
+
+    @property
+    def has_model(self) -> bool:
+        return self.weights is not None
+
+    # ---------------------------------------------------------------------------------------------------------------
+    # Inference
+    # ---------------------------------------------------------------------------------------------------------------
+    def classify(self, prompt: str) -> Optional[Dict[str, str]]:
+        """
+        :param prompt:  The user's prompt.
+        :return:        A `TaskClassification` dictionary if the local prediction reaches the threshold, else None.
+        """
+        label, confidence, source = self.predict(prompt)
+        if label is None or confidence < self.threshold:
+            return None
+        return {
+            'task': label,
+            'choice_summary': f"{LOCAL_CHOICE_PREFIX} ({source}) with confidence {confidence:.2f}",
+        }
+
+    def predict(self, prompt: str) -> Tuple[Optional[str], float, str]:
+        """
+        :param prompt:  The user's prompt.
+        :return:        (label, confidence, source) where source is 'rules' or 'model'. The label is None when
+                        neither the rules nor the model could make a prediction.
+        """
+        rule_label = self.match_rules(prompt)
+        if rule_label is not None:
+            return rule_label, self.rule_confidence, "rules"
+        if not self.has_model:
+            return None, 0.0, "model"
+        probabilities = self.predict_proba([prompt])[0]
+        best = int(np.argmax(probabilities))
+        return self.labels[best], float(probabilities[best]), "model"
+
+    def match_rules(self, prompt: str) -> Optional[str]:
+        """ The route of the only keyword rule matching the prompt, None if no rule or several rules match. """
+        matches = [label for label, pattern in KEYWORD_RULES.items() if label in self.labels and pattern.search(prompt)]
+        return matches[0] if len(matches) == 1 else None
+
+    def predict_proba(self, prompts: Sequence[str]) -> np.ndarray:
+        """ Class probabilities of the model, shape (len(prompts), len(labels)). """
+        return self.predict_proba_features(self.transform(prompts))
+
+    def predict_proba_features(self, features: np.ndarray) -> np.ndarray:
+        """ Same as `predict_proba`, for an already transformed TF-IDF matrix. """
+        logits = features @ self.weights + self.bias
+        logits -= logits.max(axis=1, keepdims=True)
+        exp = np.exp(logits)
+        return exp / exp.sum(axis=1, keepdims=True)
+
+    def transform(self, prompts: Sequence[str]) -> np.ndarray:
+        """ L2 normalized TF-IDF matrix of the prompts, shape (len(prompts), len(vocabulary)). """
+        matrix = np.zeros((len(prompts), len(self.vocabulary)), dtype=np.float32)
+        for row, prompt in enumerate(prompts):
+            for token in _tokenize(prompt):
+                column = self.vocabulary.get(token)
+                if column is not None:
+                    matrix[row, column] += 1.0
+        # sublinear term frequency
+        np.log1p(matrix, out=matrix)
+        matrix *= self.idf
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        return matrix / np.maximum(norms, 1e-12)
+
+    # ---------------------------------------------------------------------------------------------------------------
+    # Training and persistence
+    # ---------------------------------------------------------------------------------------------------------------
+    @classmethod
+    def train(cls, prompts: Sequence[str], targets: Sequence[str], labels: Sequence[str], max_features: int = 2000,
+              min_df: int = 2, epochs: int = 300, learning_rate: float = 1.0,
+              l2: float = 1e-3) -> "LocalTaskClassifier":
+        """
+        Fits the TF-IDF vocabulary and a softmax regression with full-batch gradient descent.
+        :param prompts:         Training prompts.
+        :param targets:         The route the LLM chose for each prompt.
+        :param labels:          Every route the classifier may predict.
+        :param max_features:    Size cap of the vocabulary, keeping the most frequent terms.
+        :param min_df:          Minimum number of prompts a term must appear in.
+        :param epochs:          Gradient descent iterations.
+        :param learning_rate:   Gradient descent step size.
+        :param l2:              L2 regularization strength.
+        :return:                The trained classifier.
+        """
+        document_frequency: Dict[str, int] = {}
+        for prompt in prompts:
+            for token in set(_tokenize(prompt)):
+                document_frequency[token] = document_frequency.get(token, 0) + 1
+        terms = sorted((t for t, df in document_frequency.items() if df >= min_df),
+                       key=lambda t: (-document_frequency[t], t))[:max_features]
+        vocabulary = {term: i for i, term in enumerate(terms)}
+        df = np.array([document_frequency[t] for t in terms], dtype=np.float32)
+        idf = (np.log((1 + len(prompts)) / (1 + df)) + 1).astype(np.float32)
+
+        classifier = cls(labels, vocabulary, idf)
+        features = classifier.transform(prompts)
+        label_index = {label: i for i, label in enumerate(classifier.labels)}
+        one_hot = np.zeros((len(targets), len(classifier.labels)), dtype=np.float32)
+        one_hot[np.arange(len(targets)), [label_index[t] for t in targets]] = 1.0
+
+        weights = np.zeros((features.shape[1], len(classifier.labels)), dtype=np.float32)
+        bias = np.zeros(len(classifier.labels), dtype=np.float32)
+        classifier.weights, classifier.bias = weights, bias
+        for _ in range(epochs):
+            error = (classifier.predict_proba_features(features) - one_hot) / len(targets)
+            weights -= learning_rate * (features.T @ error + l2 * weights)
+            bias -= learning_rate * error.sum(axis=0)
+        return classifier
+
+    def save(self, path: str) -> None:
+        """ Saves the model, along with the confidence of the keyword rules, to a NumPy `.npz` file. """
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        terms = sorted(self.vocabulary, key=self.vocabulary.get)
+        np.savez(path, labels=np.array(self.labels), terms=np.array(terms), idf=self.idf, weights=self.weights,
+                 bias=self.bias, rule_confidence=np.float64(self.rule_confidence))
+
+    @classmethod
+    def load(cls, path: str, threshold: float = DEFAULT_THRESHOLD,
+             rule_confidence: Optional[float] = None) -> "LocalTaskClassifier":
+        """
+        Loads a model saved by `save`.
+        :param rule_confidence: Overrides the confidence of the keyword rules saved with the model (models saved
+                                before it was measured fall back to `DEFAULT_RULE_CONFIDENCE`).
+        """
+        with np.load(path, allow_pickle=False) as data:
+            vocabulary = {str(term): i for i, term in enumerate(data["terms"])}
+            if rule_confidence is None:
+                rule_confidence = float(data["rule_confidence"]) if "rule_confidence" in data.files else \
+                    DEFAULT_RULE_CONFIDENCE
+            return cls([str(label) for label in data["labels"]], vocabulary, data["idf"], data["weights"],
+                       data["bias"], threshold, rule_confidence)
+
+def load_local_classifier(labels: Sequence[str]) -> Optional[LocalTaskClassifier]:
+    """
+    Builds the local classifier from the environment. $LOCAL_CLASSIFIER enables it, the model at
+    $LOCAL_CLASSIFIER_PATH is loaded if it exists (otherwise only the keyword rules are used, and only once
+    $LOCAL_CLASSIFIER_RULE_CONFIDENCE vouches for them),
+    $LOCAL_CLASSIFIER_THRESHOLD sets the confidence below which the LLM decides instead, and
+    $LOCAL_CLASSIFIER_RULE_CONFIDENCE, if set, overrides the confidence of the keyword rules measured by the training
+    script.
+    :param labels:  Every route the classifier may predict.
+    :return:        The classifier, or None if it is disabled.
+    """
+    if os.getenv("LOCAL_CLASSIFIER", "").lower() not in ("1", "true"):
+        return None
+    path = os.getenv("LOCAL_CLASSIFIER_PATH", "models/task_classifier.npz")
+    threshold = float(os.getenv("LOCAL_CLASSIFIER_THRESHOLD", str(DEFAULT_THRESHOLD)))
+    rule_confidence = float(os.getenv("LOCAL_CLASSIFIER_RULE_CONFIDENCE")) \
+        if os.getenv("LOCAL_CLASSIFIER_RULE_CONFIDENCE") else None
+    if os.path.exists(path):
+        print(f"Loaded the local task classifier from {path}.")
+        return LocalTaskClassifier.load(path, threshold, rule_confidence)
+    print(f"No local task classifier model found at {path}, only the keyword rules will be used"
+          f"{'' if rule_confidence is not None else ', once $LOCAL_CLASSIFIER_RULE_CONFIDENCE is set'}.")
+    return LocalTaskClassifier(labels, threshold=threshold,
+                               rule_confidence=DEFAULT_RULE_CONFIDENCE if rule_confidence is None else rule_confidence)
@@ -1,12 +1,35 @@
 from pydantic import BaseModel, Field
-from datetime import datetime
+from datetime import datetime, timezone
 from typing import *
 
 # --- Core Sub-Schema ---
 class TaskStep(BaseModel):
     """ Schema for a single step/node transition within a task. """
     node: str
-    timestamp: datetime = Field(default_factory=datetime.now)
+    # in UTC like `created_at`, so that the queue delay and execution time of a task can be told apart from its steps
+    timestamp: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    # Instrumentation of the node, see `core.instrumentation.NodeMetrics`. Only the work a node did is recorded.
+    duration_ms: Optional[float] = None
+    llm_latency_ms: Optional[float] = None
+    ttft_ms: Optional[float] = None
+    search_latency_ms: Optional[float] = None
+    prompt_tokens: Optional[int] = None
+    completion_tokens: Optional[int] = None
+    cost_usd: Optional[float] = None
+    model: Optional[str] = None
+    # whether the node's LLM output was served from the response cache
+    cache_hit: Optional[bool] = None
+    # speculative routing: the predicted route and whether the router agreed, on the classification step, and the
+    # latency the committed speculation saved, on the answering step
+    speculative_route: Optional[str] = None
+    speculation_hit: Optional[bool] = None
+    speculation_saved_ms: Optional[float] = None
+    # number of chunks the summarized content was split into, and how many of their summaries were cached
+    chunks: Optional[int] = None
+    cached_chunks: Optional[int] = None
+    # time spent retrieving passages from the document index, and how many were given to the agent
+    retrieval_latency_ms: Optional[float] = None
+    retrieved_chunks: Optional[int] = None
 
 # --- 1. Insertion Schema (Full Document) ---
 class TaskLogEntry(BaseModel):
@@ -15,6 +38,8 @@ class TaskLogEntry(BaseModel):
     prompt: str
     status: str = "In Progress"
     current_event: str = "START"
+    # creation time in UTC, which the status index and the optional retention TTL index are built on
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
     # Fields that start empty but are updated later
     web_search_query: Optional[str] = None
     search_results: List[Dict[str, Any]] = Field(default_factory=list)
@@ -22,6 +47,13 @@ class TaskLogEntry(BaseModel):
     final_response: Optional[str] = None
     task: Optional[str] = None
     task_choice_summary: Optional[str] = None
+    # ID of the conversation thread the task belongs to
+    thread_id: Optional[str] = None
+    # ID of the batch the task was submitted with, see `MongoDBLogger.log_tasks_queued`
+    batch_id: Optional[str] = None
+    # ID of the task whose result this task receives, when it duplicated a task in flight (see
+    # `core.request_coalescer.RequestCoalescer`)
+    coalesced_with: Optional[str] = None
 
 # --- 2. $SET Update Schema (Partial Document Update) ---
 class TaskLogEndUpdate(BaseModel):
@@ -33,6 +65,10 @@ class TaskLogEndUpdate(BaseModel):
     search_query: Optional[str]
     search_results: List[Dict[str, Any]] # To overwrite final results
     status: str = "Completed"
+    # time from the start of the task in the worker to its first streamed token, if the response was streamed
+    time_to_first_token_ms: Optional[float] = None
+    # whether the whole response was served from the response cache, skipping the graph
+    cache_hit: Optional[bool] = None
 
 # --- 3. $PUSH Update Schema (For Array Appending) ---
 class TaskLogStepPush(BaseModel):
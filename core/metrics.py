@@ -0,0 +1,141 @@
+import os
+import json
+import redis
+from typing import *
+
+# Histogram definitions: name -> (help text, upper bounds of the buckets). The '+Inf' bucket is implicit.
+LATENCY_BUCKETS: Tuple[float, ...] = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+TOKEN_BUCKETS: Tuple[float, ...] = (16, 64, 256, 512, 1024, 2048, 4096, 8192, 16384, 32768)
+HISTOGRAMS: Dict[str, Tuple[str, Tuple[float, ...]]] = {
+    "agent_node_duration_seconds": ("Wall time spent in a graph node.", LATENCY_BUCKETS),
+    "agent_llm_latency_seconds": ("Latency of the LLM calls made by a graph node.", LATENCY_BUCKETS),
+    "agent_search_latency_seconds": ("Latency of the web searches made by a graph node.", LATENCY_BUCKETS),
+    "agent_retrieval_latency_seconds": ("Latency of the document index searches made by a graph node.",
+                                        LATENCY_BUCKETS),
+    "agent_prompt_tokens": ("Prompt tokens sent to the LLM by a graph node.", TOKEN_BUCKETS),
+    "agent_completion_tokens": ("Completion tokens returned by the LLM to a graph node.", TOKEN_BUCKETS),
+    "agent_task_duration_seconds": ("End-to-end wall time of a task in the worker.", LATENCY_BUCKETS),
+    "agent_llm_time_to_first_token_seconds": ("Time from the start of a streamed LLM call to its first token.",
+                                              LATENCY_BUCKETS),
+    "agent_time_to_first_token_seconds": ("Time from the start of a task in the worker to its first streamed token.",
+                                          LATENCY_BUCKETS),
+    "agent_speculation_saved_seconds": ("Latency saved by a committed speculative generation.", LATENCY_BUCKETS),
+    "agent_llm_budget_wait_seconds": ("Time an LLM call waited for the rate limit budget of its model.",
+                                      LATENCY_BUCKETS),
+}
+# Counter definitions: name -> help text.
+COUNTERS: Dict[str, str] = {
+    "agent_llm_cost_usd_total": "Estimated LLM spend in US dollars.",
+    "agent_response_cache_requests_total": "Lookups of the response cache by layer ('task' or 'llm') and result.",
+    "agent_speculation_total": "Speculative generations by predicted route and outcome ('hit' or 'miss').",
+    "agent_coalesced_requests_total": "Requests answered with a task already submitted, by reason ('idempotency_key' "
+                                      "or 'duplicate').",
+    "agent_admission_rejections_total": "Requests refused by admission control, by route and reason ('queue_depth', "
+                                        "'in_flight' or 'quota').",
+    "agent_llm_retries_total": "Retries of failed LLM calls, by model and reason ('rate_limited', 'timeout', "
+                               "'connection' or 'server_error').",
+    "agent_llm_hedges_total": "Hedged LLM calls, by model and the attempt which answered first ('primary' or 'hedge').",
+}
+# Gauge definitions: name -> help text. A gauge holds the last value set.
+GAUGES: Dict[str, str] = {
+    "agent_queue_depth": "Tasks waiting in a broker queue.",
+    "agent_tasks_in_flight": "Tasks admitted by the API which have not finished yet.",
+}
+
+_KEY_PREFIX = "metrics"
+# separates the encoded label set from the bucket bound in a histogram's hash field
+_FIELD_SEP = "\t"
+
+def _label_key(labels: Dict[str, str]) -> str:
+    return json.dumps(sorted(labels.items()))
+
+def _format_labels(label_key: str, **extra: str) -> str:
+    items = [(k, v) for k, v in json.loads(label_key)] + list(extra.items())
+    if not items:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in items) + "}"
+
+class MetricsRecorder:
+    """
+    Prometheus-style histograms and counters stored in Redis.
+
+    The API and the Celery workers are separate processes (and containers), so the metrics recorded by the workers are
+    aggregated in Redis, and the API renders them in the Prometheus text exposition format on its `/metrics` endpoint.
+    Each histogram is a Redis hash holding a count per (label set, bucket) plus a running sum and count per label set.
+    Recording a metric never raises, a Redis outage only results in lost samples.
+    """
+    def __init__(self, redis_url: Optional[str] = None):
+        redis_url = redis_url or os.getenv("REDIS_URL")
+        if not redis_url:
+            raise ValueError("REDIS_URL environment variable not set.")
+        self.redis = redis.Redis.from_url(redis_url)
+
+    def observe(self, name: str, value: float, labels: Dict[str, str]) -> None:
+        """ Records a single sample, e.g. `observe("agent_node_duration_seconds", 0.4, {"node": "general"})`. """
+        self.observe_many([(name, value, labels)])
+
+    def observe_many(self, samples: Iterable[Tuple[str, float, Dict[str, str]]]) -> None:
+        """ Records several histogram samples in one round trip to Redis. """
+        pipe = self.redis.pipeline(transaction=False)
+        for name, value, labels in samples:
+            _, buckets = HISTOGRAMS[name]
+            bound = next((b for b in buckets if value <= b), "+Inf")
+            key = f"{_KEY_PREFIX}:hist:{name}"
+            label_key = _label_key(labels)
+            pipe.hincrby(key, f"{label_key}{_FIELD_SEP}{bound}", 1)
+            pipe.hincrbyfloat(key, f"{label_key}{_FIELD_SEP}sum", value)
+            pipe.hincrby(key, f"{label_key}{_FIELD_SEP}count", 1)
+        self._execute(pipe)
+
+    def inc(self, name: str, labels: Dict[str, str], amount: float = 1) -> None:
+        """ Increments a counter. """
+        self.inc_many([(name, labels, amount)])
+
+    def inc_many(self, increments: Iterable[Tuple[str, Dict[str, str], float]]) -> None:
+        """ Increments several counters in one round trip to Redis. """
+        pipe = self.redis.pipeline(transaction=False)
+        for name, labels, amount in increments:
+            pipe.hincrbyfloat(f"{_KEY_PREFIX}:counter:{name}", _label_key(labels), amount)
+        self._execute(pipe)
+
+    def set_gauge(self, name: str, labels: Dict[str, str], value: float) -> None:
+        """ Sets a gauge. """
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.hset(f"{_KEY_PREFIX}:gauge:{name}", _label_key(labels), value)
+        self._execute(pipe)
+
+    def render(self) -> str:
+        """ Renders every metric in the Prometheus text exposition format. """
+        lines: List[str] = []
+        for name, (help_text, buckets) in HISTOGRAMS.items():
+            raw = self.redis.hgetall(f"{_KEY_PREFIX}:hist:{name}")
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+            series: Dict[str, Dict[str, float]] = {}
+            for field, value in raw.items():
+                label_key, suffix = field.decode().rsplit(_FIELD_SEP, 1)
+                series.setdefault(label_key, {})[suffix] = float(value)
+            for label_key, values in sorted(series.items()):
+                cumulative = 0.0
+                for bound in [*buckets, "+Inf"]:
+                    cumulative += values.get(str(bound), 0.0)
+                    lines.append(f"{name}_bucket{_format_labels(label_key, le=str(bound))} {cumulative:g}")
+                lines.append(f"{name}_sum{_format_labels(label_key)} {values.get('sum', 0.0):g}")
+                lines.append(f"{name}_count{_format_labels(label_key)} {values.get('count', 0.0):g}")
+        for name, help_text in COUNTERS.items():
+            raw = self.redis.hgetall(f"{_KEY_PREFIX}:counter:{name}")
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} counter"]
+            for label_key, value in sorted(raw.items()):
+                lines.append(f"{name}{_format_labels(label_key.decode())} {float(value):g}")
+        for name, help_text in GAUGES.items():
+            raw = self.redis.hgetall(f"{_KEY_PREFIX}:gauge:{name}")
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge"]
+            for label_key, value in sorted(raw.items()):
+                lines.append(f"{name}{_format_labels(label_key.decode())} {float(value):g}")
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def _execute(pipe: redis.client.Pipeline) -> None:
+        try:
+            pipe.execute()
+        except redis.RedisError as e:
+            print(f"Failed to record metrics in Redis. Error: \n{e}")
@@ -0,0 +1,123 @@
+import os
+import asyncio
+import threading
+import httpx
+from langchain_openai import ChatOpenAI
+from .llm_governor import LLMGovernor, GovernedChatModel
+from typing import *
+
+# the large model, used by every node which is not assigned a model of its own
+DEFAULT_MODEL = "gpt-4.1"
+# the small model, used by the nodes of `SMALL_MODEL_NODES`
+DEFAULT_SMALL_MODEL = "gpt-4.1-mini"
+# nodes with a short output (the routing decision, the search queries), which a small model writes just as well
+SMALL_MODEL_NODES: Tuple[str, ...] = ("task_classification", "content")
+
+def parse_node_models(spec: str) -> Dict[str, str]:
+    """ Parses a 'node=model,node=model' assignment, e.g. 'task_classification=gpt-4.1-nano,code=gpt-4.1'. """
+    node_models = {}
+    for item in spec.split(","):
+        if not item.strip():
+            continue
+        node, sep, model = item.partition("=")
+        if not sep or not node.strip() or not model.strip():
+            raise ValueError(f"Invalid node model assignment '{item}', expected 'node=model'.")
+        node_models[node.strip()] = model.strip()
+    return node_models
+
+class ModelRegistry:
+    """
+    Assigns a model to every node of the graph: the small model to the nodes of `SMALL_MODEL_NODES`, the large model to
+    the others, and any node can be overridden. One `ChatOpenAI` client is built per model, and every client sends its
+    requests through the same pooled, keep-alive HTTP clients (one for the synchronous calls, one for the asynchronous
+    calls), so the connections to the API are reused across nodes, models and tasks. With a governor, the clients are
+    wrapped so that their calls share the cluster's rate limit budget of their model and are retried by the governor.
+    """
+    def __init__(self, model: str = DEFAULT_MODEL, small_model: str = DEFAULT_SMALL_MODEL,
+                 node_models: Optional[Dict[str, str]] = None, max_connections: int = 100,
+                 keepalive_expiry: float = 30.0, timeout: float = 60.0, max_retries: int = 2,
+                 governor: Optional[LLMGovernor] = None):
+        """
+        :param model:               The large model.
+        :param small_model:         The small model.
+        :param node_models:         Model of a node by node name, overriding its tier.
+        :param max_connections:     Size of the connection pool, which the connections are kept alive in.
+        :param keepalive_expiry:    Seconds an idle connection is kept alive for.
+        :param timeout:             Seconds allowed per request.
+        :param max_retries:         Retries of a failed request, unless the governor retries them.
+        :param governor:            Rate limits, retries and hedges the calls of every client, if given.
+        """
+        self.model = model
+        self.small_model = small_model
+        self.node_models = {node: small_model for node in SMALL_MODEL_NODES}
+        self.node_models.update(node_models or {})
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.governor = governor
+        limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections,
+                              keepalive_expiry=keepalive_expiry)
+        self.http_client = httpx.Client(limits=limits, timeout=timeout)
+        self.http_async_client = httpx.AsyncClient(limits=limits, timeout=timeout)
+        self._clients: Dict[str, Union[ChatOpenAI, GovernedChatModel]] = {}
+        self._lock = threading.Lock()
+
+    def model_for(self, node: Optional[str] = None) -> str:
+        """ The model of a node, or the large model if no node is given. """
+        return self.node_models.get(node, self.model) if node is not None else self.model
+
+    def llm(self, node: Optional[str] = None) -> Union[ChatOpenAI, GovernedChatModel]:
+        """ The client of a node's model, or of the large model if no node is given. """
+        model = self.model_for(node)
+        with self._lock:
+            client = self._clients.get(model)
+            if client is None:
+                # `stream_usage` makes the streamed responses report their token usage as well
+                # the governor retries the calls itself, under the budget, rather than letting the client hammer a
+                # rate limited API
+                client = ChatOpenAI(model=model, stream_usage=True, timeout=self.timeout,
+                                    max_retries=0 if self.governor is not None else self.max_retries,
+                                    http_client=self.http_client, http_async_client=self.http_async_client)
+                if self.governor is not None:
+                    client = self.governor.govern(client)
+                self._clients[model] = client
+            return client
+
+    def close(self, loop: Optional[asyncio.AbstractEventLoop] = None) -> None:
+        """
+        Closes the HTTP clients and the governor.
+        :param loop:    The running event loop the asynchronous client was used on, if any. It must be closed there.
+        """
+        self.http_client.close()
+        try:
+            if loop is not None:
+                asyncio.run_coroutine_threadsafe(self.http_async_client.aclose(), loop).result(timeout=5)
+            else:
+                asyncio.run(self.http_async_client.aclose())
+        except Exception as e:
+            print(f"Failed to close the asynchronous HTTP client of the LLMs. Error: \n{e}")
+        if self.governor is not None:
+            self.governor.close()
+
+def load_model_registry(default_model: str = DEFAULT_MODEL,
+                        governor: Optional[LLMGovernor] = None) -> ModelRegistry:
+    """
+    Builds the model registry from the environment: $LLM_MODEL and $LLM_SMALL_MODEL set the two tiers,
+    $LLM_NODE_MODELS assigns models to individual nodes ('node=model,node=model'), and the HTTP clients are configured
+    by $LLM_HTTP_MAX_CONNECTIONS, $LLM_HTTP_KEEPALIVE_SECONDS, $LLM_TIMEOUT_SECONDS and $LLM_MAX_RETRIES.
+    :param default_model:   The large model when $LLM_MODEL is not set.
+    :param governor:        Governs the calls of every client, if given (see `core.llm_governor.load_llm_governor`).
+    :return:                The registry.
+    """
+    registry = ModelRegistry(
+        model=os.getenv("LLM_MODEL") or default_model,
+        small_model=os.getenv("LLM_SMALL_MODEL") or DEFAULT_SMALL_MODEL,
+        node_models=parse_node_models(os.getenv("LLM_NODE_MODELS", "")),
+        max_connections=int(os.getenv("LLM_HTTP_MAX_CONNECTIONS", "100")),
+        keepalive_expiry=float(os.getenv("LLM_HTTP_KEEPALIVE_SECONDS", "30")),
+        timeout=float(os.getenv("LLM_TIMEOUT_SECONDS", "60")),
+        max_retries=int(os.getenv("LLM_MAX_RETRIES", "2")),
+        governor=governor,
+    )
+    print(f"LLM models: {registry.model} by default, " +
+          ", ".join(f"{node}={model}" for node, model in sorted(registry.node_models.items())))
+    return registry
@@ -1,10 +1,41 @@
 import os
-from pymongo import MongoClient
+import atexit
+import threading
+from pymongo import MongoClient, UpdateOne, ASCENDING, DESCENDING
+from pymongo.errors import OperationFailure
 from core.log_schemas import TaskLogEntry, TaskStep, TaskLogEndUpdate, TaskLogStepPush
+from core.instrumentation import current_node_metrics
+from core.task_events import TaskEventPublisher, TERMINAL_STATUSES
+from core.status_cache import TaskStatusCache, status_etag, document_etag
 from typing import *
 
+# logging modes, selected through the MONGO_LOG_MODE environment variable
+WRITE_THROUGH = "write_through"
+BUFFERED = "buffered"
+
+# status of a task whose document was inserted when it was enqueued, before a worker picked it up
+QUEUED_STATUS = "Queued"
+
+# the only fields the status checks read, which leaves out the prompt and the trajectory
+STATUS_PROJECTION: Dict[str, int] = {"_id": 0, "status": 1, "final_response": 1, "search_results": 1}
+
 class MongoDBLogger:
-    def __init__(self):
+    def __init__(self, mode: Optional[str] = None, flush_size: Optional[int] = None,
+                 flush_interval: Optional[float] = None, publisher: Optional[TaskEventPublisher] = None,
+                 status_cache: Optional[TaskStatusCache] = None):
+        """
+        :param mode:            Either 'write_through' (every step is its own `update_one`) or 'buffered' (steps are
+                                kept in memory and written with `bulk_write`). Defaults to $MONGO_LOG_MODE, and to
+                                'write_through' if that is not set.
+        :param flush_size:      Buffered mode only. Number of pending steps that triggers a flush.
+                                Defaults to $MONGO_LOG_FLUSH_SIZE or 50.
+        :param flush_interval:  Buffered mode only. Seconds between flushes of the background flusher.
+                                Defaults to $MONGO_LOG_FLUSH_INTERVAL or 1.0.
+        :param publisher:       If given, every start, step and end of a task is also published as a task event so
+                                that the API can push status changes to waiting clients.
+        :param status_cache:    If given, the workers keep a compact status record of every task in Redis, which
+                                `get_task_status` reads before falling back to MongoDB.
+        """
         # retrieve connection details from environment variables
         self.mongo_uri = os.getenv("MONGO_URI")
         self.database_name = os.getenv("MONGO_DATABASE_NAME", "ToyAgenticFrameworkLogs")
@@ -13,24 +44,142 @@ class MongoDBLogger:
         if not self.mongo_uri:
             raise ValueError("MONGO_URI environment variable not set.")
 
+        self.mode = (mode or os.getenv("MONGO_LOG_MODE", WRITE_THROUGH)).lower()
+        if self.mode not in (WRITE_THROUGH, BUFFERED):
+            raise ValueError(f"Unknown MongoDB logging mode '{self.mode}'.")
+        self.flush_size = flush_size or int(os.getenv("MONGO_LOG_FLUSH_SIZE", "50"))
+        self.flush_interval = flush_interval or float(os.getenv("MONGO_LOG_FLUSH_INTERVAL", "1.0"))
+        # documents older than this are deleted by a TTL index, 0 keeps them forever
+        self.retention_seconds = int(os.getenv("MONGO_LOG_RETENTION_SECONDS", "0"))
+        self.publisher = publisher
+        self.status_cache = status_cache
+
         # establish connection
         self.client = MongoClient(self.mongo_uri)
         self.db = self.client[self.database_name]
         self.collection = self.db[self.collection_name]
 
-        print(f"MongoDB Logger initialized. Database: {self.database_name}, Collection: {self.collection_name}")
+        # pending trajectory steps per task ID, in the order they were logged
+        self._pending_steps: Dict[str, List[Dict[str, Any]]] = {}
+        self._pending_count = 0
+        self._buffer_lock = threading.Lock()
+        # serializes writes so that a background flush and a `log_task_end` never reorder a task's trajectory
+        self._write_lock = threading.Lock()
+        self._flush_requested = threading.Event()
+        self._stop_flusher = threading.Event()
+        self._flusher: Optional[threading.Thread] = None
+        # the indexes are ensured on the first write so that building the logger needs no round trip to the database
+        self._indexes_ready = False
+        self._indexes_lock = threading.Lock()
+        if self.mode == BUFFERED:
+            self._flusher = threading.Thread(target=self._flush_loop, name="mongodb-log-flusher", daemon=True)
+            self._flusher.start()
+            # do not lose steps that are still buffered when the interpreter exits
+            atexit.register(self.flush)
 
-    def log_task_start(self, task_id: str, prompt_content: str) -> None:
+        print(f"MongoDB Logger initialized. Database: {self.database_name}, Collection: {self.collection_name}, "
+              f"Mode: {self.mode}")
+
+    def ensure_indexes(self) -> None:
+        """
+        Creates the indexes of the collection if they do not exist yet:
+        * a unique index on `task_id`, which every lookup and update of a task goes through,
+        * a compound index on `status` and `created_at` for operational queries, e.g. the oldest queued tasks,
+        * a sparse index on `batch_id` for the batch status aggregation, and
+        * a TTL index on `created_at` if $MONGO_LOG_RETENTION_SECONDS is set.
+        """
+        if self._indexes_ready:
+            return
+        with self._indexes_lock:
+            if self._indexes_ready:
+                return
+            try:
+                self.collection.create_index("task_id", unique=True)
+            except OperationFailure as e:
+                # e.g. duplicates written before the index existed, lookups still work without it
+                print(f"Failed to create the unique index on task_id. Error: \n{e}")
+            self.collection.create_index([("status", ASCENDING), ("created_at", DESCENDING)])
+            # only batched tasks have the field, so the sparse index stays small
+            self.collection.create_index("batch_id", sparse=True)
+            if self.retention_seconds > 0:
+                try:
+                    self.collection.create_index("created_at", expireAfterSeconds=self.retention_seconds)
+                except OperationFailure:
+                    # the TTL index exists with another retention, update it in place
+                    self.db.command("collMod", self.collection_name,
+                                    index={"keyPattern": {"created_at": 1}, "expireAfterSeconds": self.retention_seconds})
+            self._indexes_ready = True
+
+    def log_task_start(self, task_id: str, prompt_content: str, thread_id: Optional[str] = None) -> None:
         """Logs the start of a new task/thread."""
         log_data = TaskLogEntry(
             task_id = task_id,
             prompt = prompt_content,
+            thread_id = thread_id,
             # Defaults handle the rest: current_event="START", status="In Progress", trajectory=[]
         )
+        self.ensure_indexes()
+        # NOTE: this is written through even in buffered mode so that the status endpoint sees the task right away.
         self.collection.insert_one(log_data.model_dump(by_alias=True, exclude_none=True))
+        etag = self.status_cache.start(task_id, log_data.status) if self.status_cache is not None else None
+        self._publish(task_id, "START", status=log_data.status, etag=etag)
+
+    def log_tasks_queued(self, tasks: Sequence[Tuple[str, str]], batch_id: Optional[str] = None) -> None:
+        """
+        Inserts the documents of tasks enqueued in bulk with a single `insert_many`, in place of a `log_task_start`
+        per task. The worker then only marks each task as started with `log_task_running`.
+        :param tasks:       (task ID, prompt) of every task.
+        :param batch_id:    ID of the batch the tasks belong to, which `get_batch_status` aggregates by.
+        :return:
+        """
+        self.ensure_indexes()
+        documents = [
+            TaskLogEntry(task_id=task_id, prompt=prompt_content, status=QUEUED_STATUS, current_event="QUEUED",
+                         batch_id=batch_id).model_dump(by_alias=True, exclude_none=True)
+            for task_id, prompt_content in tasks
+        ]
+        if documents:
+            # unordered so that the server may apply the inserts in parallel
+            self.collection.insert_many(documents, ordered=False)
+            if self.status_cache is not None:
+                self.status_cache.queued([task_id for task_id, _ in tasks], QUEUED_STATUS)
 
-    def log_task_end(self, task_id: str, final_state: Dict[str, Any], final_status: Optional[str] = "Completed") -> None:
-        """Logs the completion of a task, storing the final state."""
+    def log_task_queued(self, task_id: str, prompt_content: str, thread_id: Optional[str] = None) -> None:
+        """
+        Inserts the document of a single task before it is enqueued, which the worker then only marks as started with
+        `log_task_running`. The API does so when the task may receive the result of another one (see
+        `log_task_coalesced`), whose worker could otherwise end it before it has a document.
+        """
+        self.ensure_indexes()
+        self.collection.insert_one(
+            TaskLogEntry(task_id=task_id, prompt=prompt_content, status=QUEUED_STATUS, current_event="QUEUED",
+                         thread_id=thread_id).model_dump(by_alias=True, exclude_none=True)
+        )
+        if self.status_cache is not None:
+            self.status_cache.queued([task_id], QUEUED_STATUS)
+
+    def log_task_coalesced(self, task_id: str, leader_task_id: str) -> None:
+        """ Records that a queued task duplicated a task in flight, whose worker ends it with the same result. """
+        self.collection.update_one({"task_id": task_id}, {"$set": {"coalesced_with": leader_task_id}})
+
+    def log_task_running(self, task_id: str) -> None:
+        """ Marks a task whose document was inserted by `log_tasks_queued` as started. """
+        status = TaskLogEntry.model_fields["status"].default
+        self.collection.update_one({"task_id": task_id}, {"$set": {"status": status, "current_event": "START"}})
+        etag = self.status_cache.start(task_id, status) if self.status_cache is not None else None
+        self._publish(task_id, "START", status=status, etag=etag)
+
+    def log_task_end(self, task_id: str, final_state: Dict[str, Any], final_status: Optional[str] = "Completed",
+                     time_to_first_token: Optional[float] = None, cache_hit: Optional[bool] = None) -> None:
+        """
+        Logs the completion of a task, storing the final state.
+        :param task_id:
+        :param final_state:
+        :param final_status:
+        :param time_to_first_token: Seconds from the start of the task to its first streamed token, if it streamed.
+        :param cache_hit:           Whether the final state was served from the response cache.
+        :return:
+        """
 
         # Use the dedicated update schema
         update_data = TaskLogEndUpdate(
@@ -39,9 +188,11 @@ class MongoDBLogger:
             task=final_state['task_classification']['task'],
             task_choice_summary=final_state['task_classification']['choice_summary'],
             # Note: search_results must be a list of dicts or it will fail validation
-            search_results=final_state.get('search_results', []),
-            search_query=final_state.get('search_query', "n/a"),
-            status=final_status
+            search_results=final_state.get('search_results') or [],
+            search_query=final_state.get('search_query') or "n/a",
+            status=final_status,
+            time_to_first_token_ms=None if time_to_first_token is None else round(time_to_first_token * 1e3, 3),
+            cache_hit=cache_hit,
         )
 
         # Structure the payload for the $set operator
@@ -49,24 +200,68 @@ class MongoDBLogger:
             "$set": update_data.model_dump(exclude_none=True)
         }
 
-        self.collection.update_one({"task_id": task_id}, update_doc, upsert=True)
+        if self.mode == WRITE_THROUGH:
+            self.collection.update_one({"task_id": task_id}, update_doc, upsert=True)
+        else:
+            # In buffered mode, this task's remaining steps ride along with the final $set, and the steps of every
+            # other task that are pending are flushed in the same round trip.
+            with self._write_lock:
+                pending = self._drain()
+                steps = pending.get(task_id)
+                if steps:
+                    update_doc["$push"] = {"trajectory": {"$each": steps}}
+                operations = self._push_operations({k: v for k, v in pending.items() if k != task_id})
+                operations.append(UpdateOne({"task_id": task_id}, update_doc, upsert=True))
+                self._bulk_write(operations, pending)
+
+        # the END event carries everything the status endpoint returns, so waiting clients need no database read
+        # the status record is only updated once MongoDB holds the response it points to
+        etag = self.status_cache.end(task_id, update_data.status, update_data.task) \
+            if self.status_cache is not None else None
+        self._publish(task_id, "END", status=update_data.status, etag=etag, final_response=update_data.final_response,
+                      search_results=update_data.search_results)
 
     def log_step(self, task_id: str, node_name: str, updates: Dict[str, Any]) -> None:
         """Logs the transition through a specific node/step in the LangGraph."""
 
+        # when called from an instrumented node, store the node's timings and token usage alongside the step
+        metrics = current_node_metrics()
         # Use the dedicated push schema
         push_data = TaskLogStepPush(
             trajectory=TaskStep(
                 node=node_name,
+                **(metrics.step_fields() if metrics is not None else {}),
             )
         )
 
-        # Structure the payload for the $push operator
-        self.collection.update_one(
-            {"task_id": task_id},
-            {"$push": push_data.model_dump(exclude_none=True)},
-            upsert=True
-        )
+        if self.mode == BUFFERED:
+            with self._buffer_lock:
+                self._pending_steps.setdefault(task_id, []).append(push_data.trajectory.model_dump(exclude_none=True))
+                self._pending_count += 1
+                if self._pending_count >= self.flush_size:
+                    # let the background flusher do the write so the graph node does not block on it
+                    self._flush_requested.set()
+        else:
+            # Structure the payload for the $push operator
+            self.collection.update_one(
+                {"task_id": task_id},
+                {"$push": push_data.model_dump(exclude_none=True)},
+                upsert=True
+            )
+        if self.status_cache is not None:
+            self.status_cache.step(task_id, node_name)
+        self._publish(task_id, "STEP", node=node_name)
+
+    def flush(self) -> None:
+        """
+        Synchronously writes every buffered step to MongoDB. This is a no-op in write-through mode.
+        """
+        if self.mode != BUFFERED:
+            return
+        with self._write_lock:
+            pending = self._drain()
+            if pending:
+                self._bulk_write(self._push_operations(pending), pending)
 
     def get_task_by_id(self, task_id: str) -> Optional[Dict[str, Any]]:
         """
@@ -75,4 +270,97 @@ class MongoDBLogger:
         :return:
         """
         # returns None when no matching document is found
-        return self.collection.find_one({"task_id": task_id})
\ No newline at end of file
+        return self.collection.find_one({"task_id": task_id})
+
+    def get_task_status(self, task_id: str, etag: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        """
+        Retrieves only the fields of a task the status checks need (see STATUS_PROJECTION), along with the ETag of
+        its status. The Redis status record is read first: a running task is answered from it alone, and so is a
+        finished one if the caller already holds its latest version. Otherwise, and for tasks without a record, the
+        projected fields are read from MongoDB.
+        :param task_id:
+        :param etag:        The ETag the caller already holds, e.g. from an If-None-Match header.
+        :return:            The status fields and their 'etag', or None when the task does not exist.
+        """
+        record = self.status_cache.get(task_id) if self.status_cache is not None else None
+        if record is not None:
+            task_data = {"status": record["status"], "etag": status_etag(record.get("version", 0))}
+            if record["status"] in TERMINAL_STATUSES and task_data["etag"] != etag:
+                document = self.collection.find_one({"task_id": task_id}, STATUS_PROJECTION)
+                if document is not None:
+                    task_data.update(document)
+            return task_data
+        document = self.collection.find_one({"task_id": task_id}, STATUS_PROJECTION)
+        if document is not None:
+            document["etag"] = document_etag(document.get("status", "Unknown"))
+        return document
+
+    def get_batch_status(self, batch_id: str) -> Dict[str, int]:
+        """
+        Counts the tasks of a batch per status in a single aggregation.
+        :param batch_id:
+        :return:            The number of tasks per status, empty if the batch does not exist.
+        """
+        pipeline = [
+            {"$match": {"batch_id": batch_id}},
+            {"$group": {"_id": "$status", "count": {"$sum": 1}}},
+        ]
+        return {group["_id"]: group["count"] for group in self.collection.aggregate(pipeline)}
+
+    def close(self) -> None:
+        """ Flushes any buffered steps, stops the background flusher and closes the underlying MongoClient. """
+        if self._flusher is not None:
+            self._stop_flusher.set()
+            self._flush_requested.set()
+            self._flusher.join()
+            self._flusher = None
+            atexit.unregister(self.flush)
+        self.flush()
+        self.client.close()
+
+    def _publish(self, task_id: str, event: str, **payload: Any) -> None:
+        """ Publishes a task event if this logger was given a publisher. """
+        if self.publisher is not None:
+            self.publisher.publish(task_id, event, **payload)
+
+    def _flush_loop(self) -> None:
+        """ Background flusher which writes the buffer every `flush_interval` seconds or once it reaches `flush_size`. """
+        while not self._stop_flusher.is_set():
+            self._flush_requested.wait(self.flush_interval)
+            self._flush_requested.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                # the steps were put back in the buffer, so the next flush retries them
+                print(f"Failed to flush buffered task steps to MongoDB. Error: \n{e}")
+
+    def _drain(self) -> Dict[str, List[Dict[str, Any]]]:
+        """ Atomically takes every pending step out of the buffer. """
+        with self._buffer_lock:
+            pending = self._pending_steps
+            self._pending_steps = {}
+            self._pending_count = 0
+        return pending
+
+    def _requeue(self, pending: Dict[str, List[Dict[str, Any]]]) -> None:
+        """ Puts steps whose write failed back in front of any steps that were logged in the meantime. """
+        with self._buffer_lock:
+            for task_id, steps in pending.items():
+                self._pending_steps[task_id] = steps + self._pending_steps.get(task_id, [])
+                self._pending_count += len(steps)
+
+    @staticmethod
+    def _push_operations(pending: Dict[str, List[Dict[str, Any]]]) -> List[UpdateOne]:
+        """ Builds one upserting $push per task for the given pending steps. """
+        return [
+            UpdateOne({"task_id": task_id}, {"$push": {"trajectory": {"$each": steps}}}, upsert=True)
+            for task_id, steps in pending.items()
+        ]
+
+    def _bulk_write(self, operations: List[UpdateOne], pending: Dict[str, List[Dict[str, Any]]]) -> None:
+        """ Writes the operations in a single round trip, re-buffering the pending steps if the write fails. """
+        try:
+            self.collection.bulk_write(operations, ordered=False)
+        except Exception:
+            self._requeue(pending)
+            raise
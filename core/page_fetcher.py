@@ -0,0 +1,315 @@
+import os
+import json
+import time
+import asyncio
+import hashlib
+import threading
+from html.parser import HTMLParser
+from urllib.parse import urlsplit
+import httpx
+from typing import *
+
+# tags whose text is never part of the main content of a page
+_SKIPPED_TAGS = {"script", "style", "noscript", "template", "svg", "canvas", "iframe", "form", "button", "select",
+                 "nav", "header", "footer", "aside"}
+# tags that end a line of text
+_BLOCK_TAGS = {"p", "div", "section", "article", "main", "li", "ul", "ol", "tr", "table", "br", "hr", "blockquote",
+               "pre", "h1", "h2", "h3", "h4", "h5", "h6", "dd", "dt"}
+# void elements never get an end tag, so they must not be tracked as open
+_VOID_TAGS = {"br", "hr", "img", "input", "meta", "link", "area", "base", "col", "embed", "source", "track", "wbr"}
+# approximate number of characters per token, used when no tokenizer is available
+_CHARS_PER_TOKEN = 4
+
+class _TextExtractor(HTMLParser):
+    """
+    Collects the visible text of an HTML page, dropping scripts, styles and the navigation chrome. If the page has an
+    <article> or <main> element, only the text inside it is kept.
+    """
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self._skip_depth = 0
+        self._main_depth = 0
+        self._lines: List[str] = []
+        self._main_lines: List[str] = []
+        self._line: List[str] = []
+
+    def handle_starttag(self, tag: str, attrs) -> None:
+        if tag in _VOID_TAGS:
+            if tag in _BLOCK_TAGS:
+                self._end_line()
+            return
+        if tag in _SKIPPED_TAGS:
+            self._skip_depth += 1
+        elif tag in ("article", "main"):
+            self._end_line()
+            self._main_depth += 1
+        elif tag in _BLOCK_TAGS:
+            self._end_line()
+
+    def handle_endtag(self, tag: str) -> None:
+        if tag in _SKIPPED_TAGS:
+            self._skip_depth = max(0, self._skip_depth - 1)
+        elif tag in ("article", "main"):
+            self._end_line()
+            self._main_depth = max(0, self._main_depth - 1)
+        elif tag in _BLOCK_TAGS:
+            self._end_line()
+
+    def handle_data(self, data: str) -> None:
+        if not self._skip_depth:
+            self._line.append(data)
+
+    def _end_line(self) -> None:
+        line = " ".join("".join(self._line).split())
+        self._line = []
+        if line:
+            self._lines.append(line)
+            if self._main_depth:
+                self._main_lines.append(line)
+
+    def text(self) -> str:
+        self._end_line()
+        return "\n".join(self._main_lines or self._lines)
+
+def extract_text(html: str) -> str:
+    """ Returns the main text of an HTML page, one block element per line. """
+    extractor = _TextExtractor()
+    extractor.feed(html)
+    extractor.close()
+    return extractor.text()
+
+class _TokenBudget:
+    """ Truncates text to a number of tokens, with tiktoken if its encoding can be loaded, else by characters. """
+    def __init__(self, max_tokens: int, encoding: str = "o200k_base"):
+        self.max_tokens = max_tokens
+        try:
+            import tiktoken
+            self._encoding = tiktoken.get_encoding(encoding)
+        except Exception as e:
+            print(f"Could not load the tokenizer, page text will be truncated by characters instead. Error: \n{e}")
+            self._encoding = None
+
+    def truncate(self, text: str) -> str:
+        if self._encoding is None:
+            return text[:self.max_tokens * _CHARS_PER_TOKEN]
+        tokens = self._encoding.encode(text, disallowed_special=())
+        if len(tokens) <= self.max_tokens:
+            return text
+        return self._encoding.decode(tokens[:self.max_tokens])
+
+class PageCache:
+    """
+    On-disk cache of the extracted text of the fetched pages, one JSON file per URL. An entry younger than `fresh_for`
+    seconds is used as is; an older one is revalidated with its ETag (If-None-Match), so an unchanged page costs a
+    304 response instead of a download and a new extraction.
+    """
+    def __init__(self, directory: str, fresh_for: int = 3600):
+        self.directory = directory
+        self.fresh_for = fresh_for
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, url: str) -> str:
+        return os.path.join(self.directory, hashlib.sha256(url.encode()).hexdigest() + ".json")
+
+    def get(self, url: str) -> Optional[Dict[str, Any]]:
+        try:
+            with open(self._path(url), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def is_fresh(self, entry: Dict[str, Any]) -> bool:
+        return time.time() - entry.get("fetched_at", 0) < self.fresh_for
+
+    def set(self, url: str, text: str, etag: Optional[str]) -> None:
+        # write then rename so that concurrent workers never read a partially written entry
+        path = self._path(url)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"url": url, "etag": etag, "fetched_at": time.time(), "text": text}, f)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"Failed to cache the page {url}. Error: \n{e}")
+
+    def touch(self, url: str, entry: Dict[str, Any]) -> None:
+        """ Marks a revalidated entry as fresh again. """
+        self.set(url, entry["text"], entry.get("etag"))
+
+class PageFetcher:
+    """
+    Fetches the pages of the search results concurrently and extracts their main text. Requests go through one pooled
+    `httpx.AsyncClient` running on a dedicated event loop thread, so the connections are reused across tasks and the
+    synchronous graph nodes can wait on a batch of fetches without blocking each other. Every page is bounded by the
+    timeout, so a batch takes as long as its slowest page rather than the sum of all of them.
+    """
+    def __init__(self, max_connections: int = 20, max_per_host: int = 2, timeout: float = 5.0,
+                 max_tokens: int = 800, max_bytes: int = 2 * 1024 * 1024, cache: Optional[PageCache] = None,
+                 transport: Optional[httpx.AsyncBaseTransport] = None):
+        """
+        :param max_connections: Size of the connection pool.
+        :param max_per_host:    Maximum number of concurrent requests to the same host.
+        :param timeout:         Seconds allowed per page, connection included.
+        :param max_tokens:      Token budget of the text kept per page.
+        :param max_bytes:       Pages larger than this are truncated before the extraction.
+        :param cache:           On-disk cache of the extracted pages, or None to not cache them.
+        :param transport:       Transport of the HTTP client, e.g. `httpx.MockTransport` to fetch without a network.
+        """
+        self.max_per_host = max_per_host
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        self.cache = cache
+        self.budget = _TokenBudget(max_tokens)
+        self._limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+        self._transport = transport
+        # semaphores of the hosts with requests in flight or waiting, and how many; only used on the fetcher's loop
+        self._host_semaphores: Dict[str, asyncio.Semaphore] = {}
+        self._host_requests: Dict[str, int] = {}
+        # the event loop, and the client bound to it, are created on first use
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._client: Optional[httpx.AsyncClient] = None
+        self._lock = threading.Lock()
+
+    def _ensure_loop(self) -> asyncio.AbstractEventLoop:
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(target=self._loop.run_forever, name="page-fetcher", daemon=True).start()
+            return self._loop
+
+    def fetch_many(self, urls: Sequence[str]) -> Dict[str, str]:
+        """
+        Fetches the pages concurrently.
+        :param urls:    The URLs of the pages.
+        :return:        The extracted, truncated text of every page that could be fetched, by URL. Pages that failed,
+                        timed out or are not HTML or plain text are left out.
+        """
+        urls = list(dict.fromkeys(url for url in urls if url))
+        if not urls:
+            return {}
+        fetched: Dict[str, str] = {}
+        future = asyncio.run_coroutine_threadsafe(self._fetch_all(urls, fetched), self._ensure_loop())
+        try:
+            # every page is already bounded by the timeout, this only guards against a stalled loop
+            return future.result(timeout=self.timeout * 2 + 5)
+        except TimeoutError:
+            future.cancel()
+            print(f"Fetching {len(urls)} pages timed out, keeping the pages fetched so far ({len(fetched)}).")
+            return dict(fetched)
+
+    async def afetch_many(self, urls: Sequence[str]) -> Dict[str, str]:
+        """
+        Asynchronous counterpart of `fetch_many`, awaited from another event loop (e.g. a worker's). The fetches still
+        run on the fetcher's own loop, which owns the HTTP client and the per-host semaphores.
+        """
+        urls = list(dict.fromkeys(url for url in urls if url))
+        if not urls:
+            return {}
+        fetched: Dict[str, str] = {}
+        future = asyncio.run_coroutine_threadsafe(self._fetch_all(urls, fetched), self._ensure_loop())
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), timeout=self.timeout * 2 + 5)
+        except TimeoutError:
+            future.cancel()
+            print(f"Fetching {len(urls)} pages timed out, keeping the pages fetched so far ({len(fetched)}).")
+            return dict(fetched)
+
+    async def _fetch_all(self, urls: List[str], fetched: Dict[str, str]) -> Dict[str, str]:
+        """ Fetches the pages, adding each one to `fetched` as soon as it is, so a batch cut short keeps them. """
+        if self._client is None:
+            self._client = httpx.AsyncClient(limits=self._limits, transport=self._transport, follow_redirects=True,
+                                             headers={"User-Agent": "ToyAgenticFramework/1.0"})
+
+        async def fetch(url: str) -> None:
+            text = await self._fetch(url)
+            if text:
+                fetched[url] = text
+        await asyncio.gather(*(fetch(url) for url in urls))
+        return {url: fetched[url] for url in urls if url in fetched}
+
+    async def _fetch(self, url: str) -> Optional[str]:
+        # the cache is on disk, keep its reads off the event loop shared by every task
+        cached = await asyncio.to_thread(self.cache.get, url) if self.cache is not None else None
+        if cached is not None and self.cache.is_fresh(cached):
+            return cached["text"]
+        try:
+            # the wait for the host's semaphore, shared by every task of the process, counts against the timeout too
+            return await asyncio.wait_for(self._download_limited(url, cached), timeout=self.timeout)
+        except Exception as e:
+            print(f"Failed to fetch the page {url}. Error: {type(e).__name__} {e}")
+            # a stale page is still better than none
+            return cached["text"] if cached is not None else None
+
+    async def _download_limited(self, url: str, cached: Optional[Dict[str, Any]]) -> Optional[str]:
+        """ Downloads a page once fewer than `max_per_host` requests to its host are in flight. """
+        host = urlsplit(url).netloc
+        semaphore = self._host_semaphores.get(host)
+        if semaphore is None:
+            semaphore = self._host_semaphores[host] = asyncio.Semaphore(self.max_per_host)
+        self._host_requests[host] = self._host_requests.get(host, 0) + 1
+        try:
+            async with semaphore:
+                return await self._download(url, cached)
+        finally:
+            # an idle host is forgotten, so that the semaphores do not pile up with every host the worker ever fetched
+            self._host_requests[host] -= 1
+            if not self._host_requests[host]:
+                del self._host_requests[host], self._host_semaphores[host]
+
+    async def _download(self, url: str, cached: Optional[Dict[str, Any]]) -> Optional[str]:
+        headers = {"If-None-Match": cached["etag"]} if cached is not None and cached.get("etag") else {}
+        async with self._client.stream("GET", url, headers=headers, timeout=self.timeout) as response:
+            if response.status_code == 304 and cached is not None:
+                await asyncio.to_thread(self.cache.touch, url, cached)
+                return cached["text"]
+            response.raise_for_status()
+            content_type = response.headers.get("content-type", "text/html").split(";")[0].strip().lower()
+            if content_type not in ("text/html", "application/xhtml+xml", "text/plain"):
+                return None
+            body = bytearray()
+            async for chunk in response.aiter_bytes():
+                body.extend(chunk)
+                if len(body) >= self.max_bytes:
+                    break
+            raw = bytes(body[:self.max_bytes]).decode(response.encoding or "utf-8", errors="replace")
+            etag = response.headers.get("etag")
+        # the extraction is CPU bound, keep it off the event loop so the other downloads carry on
+        text = await asyncio.to_thread(self._extract, raw, content_type)
+        if self.cache is not None and text:
+            await asyncio.to_thread(self.cache.set, url, text, etag)
+        return text
+
+    def _extract(self, raw: str, content_type: str) -> str:
+        text = raw if content_type == "text/plain" else extract_text(raw)
+        return self.budget.truncate(text)
+
+    def close(self) -> None:
+        with self._lock:
+            loop, self._loop = self._loop, None
+        if loop is None:
+            return
+        if self._client is not None:
+            try:
+                asyncio.run_coroutine_threadsafe(self._client.aclose(), loop).result(timeout=5)
+            except Exception as e:
+                print(f"Failed to close the page fetcher's HTTP client. Error: \n{e}")
+            self._client = None
+        loop.call_soon_threadsafe(loop.stop)
+
+def load_page_fetcher() -> Optional[PageFetcher]:
+    """
+    Builds the page fetcher if $PAGE_FETCH is enabled, else returns None. It is configured by
+    $PAGE_FETCH_TIMEOUT_SECONDS, $PAGE_FETCH_MAX_CONNECTIONS, $PAGE_FETCH_MAX_PER_HOST, $PAGE_FETCH_MAX_TOKENS,
+    $PAGE_CACHE_DIR (empty disables the cache) and $PAGE_CACHE_FRESH_SECONDS.
+    """
+    if os.getenv("PAGE_FETCH", "").lower() not in ("1", "true"):
+        return None
+    cache_dir = os.getenv("PAGE_CACHE_DIR", ".cache/pages")
+    cache = PageCache(cache_dir, int(os.getenv("PAGE_CACHE_FRESH_SECONDS", "3600"))) if cache_dir else None
+    return PageFetcher(
+        max_connections=int(os.getenv("PAGE_FETCH_MAX_CONNECTIONS", "20")),
+        max_per_host=int(os.getenv("PAGE_FETCH_MAX_PER_HOST", "2")),
+        timeout=float(os.getenv("PAGE_FETCH_TIMEOUT_SECONDS", "5")),
+        max_tokens=int(os.getenv("PAGE_FETCH_MAX_TOKENS", "800")),
+        cache=cache,
+    )
@@ -0,0 +1,154 @@
+import os
+import json
+import hashlib
+import redis
+from .response_cache import normalize_prompt
+from typing import *
+
+_KEY_PREFIX = "coalesce"
+# 'attach' answers a duplicate with the task it duplicates, 'fanout' gives it a task of its own which receives the
+# result of the task it duplicates
+ATTACH = "attach"
+FANOUT = "fanout"
+
+# Registers a task under a prompt unless another task already is, in which case the duplicate is appended to the
+# followers of that task (in the 'fanout' mode) and the ID of that task is returned.
+# KEYS[1]: in-flight key of the prompt. ARGV: task ID, window, fan out ('1' or '0'), followers TTL, followers prefix.
+_JOIN_SCRIPT = """
+local leader = redis.call('GET', KEYS[1])
+if leader then
+    if ARGV[3] == '1' then
+        local followers = ARGV[5] .. leader
+        redis.call('RPUSH', followers, ARGV[1])
+        redis.call('EXPIRE', followers, ARGV[4])
+    end
+    return leader
+end
+redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+return false
+"""
+
+# Unregisters a finished task and returns its followers. Running as one script, a duplicate submitted concurrently
+# either joins before this (and is returned) or finds the prompt free and runs on its own.
+# KEYS[1]: in-flight key of the prompt, KEYS[2]: followers of the task. ARGV[1]: task ID.
+_FINISH_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    redis.call('DEL', KEYS[1])
+end
+local followers = redis.call('LRANGE', KEYS[2], 0, -1)
+redis.call('DEL', KEYS[2])
+return followers
+"""
+
+class IdempotencyConflict(Exception):
+    """ An idempotency key was reused with a different request. """
+
+def coalesce_key(prompt: str, documents: Optional[Sequence[str]] = None) -> str:
+    """ The in-flight key of a request, by the hash of its normalized prompt and of its documents. """
+    digest = hashlib.sha256(normalize_prompt(prompt).encode())
+    for document in documents or []:
+        digest.update(b"\0" + hashlib.sha256(document.encode()).digest())
+    return f"{_KEY_PREFIX}:inflight:{digest.hexdigest()}"
+
+def request_fingerprint(request: Dict[str, Any]) -> str:
+    """ Hash of a request's payload, which a retry with the same idempotency key must match. """
+    return hashlib.sha256(json.dumps(request, sort_keys=True).encode()).hexdigest()
+
+class RequestCoalescer:
+    """
+    Keeps identical requests from being executed more than once, in two ways:
+    * An idempotency key sent along with a request maps it to the task it was first submitted as, so a client retrying
+      the request gets the same task back.
+    * A new request whose prompt (and documents) is already being executed joins the task executing it. In the 'attach'
+      mode the duplicate is answered with that task's ID. In the 'fanout' mode it gets a task ID of its own, and the
+      worker copies the result of the task it joined to it. A prompt is in flight from the submission of its task
+      until the task finishes, or at most `window` seconds.
+    The registry lives in Redis, so the duplicates are found across every API process and the results are fanned out by
+    whichever worker ran the task.
+    """
+    def __init__(self, redis_url: Optional[str] = None, window: Optional[int] = None, mode: Optional[str] = None,
+                 idempotency_ttl: Optional[int] = None):
+        """
+        :param redis_url:       Defaults to $REDIS_URL.
+        :param window:          Seconds a prompt is considered in flight at most, 0 to not coalesce duplicate prompts.
+                                Defaults to $COALESCE_WINDOW_SECONDS or 0.
+        :param mode:            'fanout' or 'attach'. Defaults to $COALESCE_MODE or 'fanout'.
+        :param idempotency_ttl: Seconds an idempotency key is remembered. Defaults to $IDEMPOTENCY_TTL_SECONDS or 1 day.
+        """
+        redis_url = redis_url or os.getenv("REDIS_URL")
+        if not redis_url:
+            raise ValueError("REDIS_URL environment variable not set.")
+        self.redis = redis.Redis.from_url(redis_url, decode_responses=True)
+        self.window = int(os.getenv("COALESCE_WINDOW_SECONDS", "0")) if window is None else window
+        self.mode = (mode or os.getenv("COALESCE_MODE", FANOUT)).lower()
+        if self.mode not in (ATTACH, FANOUT):
+            raise ValueError(f"Unknown coalescing mode '{self.mode}', expected '{ATTACH}' or '{FANOUT}'.")
+        self.idempotency_ttl = idempotency_ttl or int(os.getenv("IDEMPOTENCY_TTL_SECONDS", str(24 * 3600)))
+        # the followers are kept for as long as the status of a task, in case the task outlives the window
+        self.followers_ttl = int(os.getenv("TASK_STATUS_TTL_SECONDS", str(24 * 3600)))
+        self._join = self.redis.register_script(_JOIN_SCRIPT)
+        self._finish = self.redis.register_script(_FINISH_SCRIPT)
+
+    @property
+    def enabled(self) -> bool:
+        """ Whether duplicate prompts are coalesced (idempotency keys always are). """
+        return self.window > 0
+
+    # ---------------------------------------------------------------------------------------------------------------
+    # Idempotency keys
+    # ---------------------------------------------------------------------------------------------------------------
+    def reserve(self, idempotency_key: str, fingerprint: str, task: Dict[str, str]) -> Optional[Dict[str, str]]:
+        """
+        Reserves an idempotency key for a task about to be enqueued.
+        :param idempotency_key: The key sent by the client.
+        :param fingerprint:     Fingerprint of the request, see `request_fingerprint`.
+        :param task:            The IDs of the task ({'task_id', 'thread_id'}) to answer the retries with.
+        :return:                None if the key is new, else the task the key was first reserved for.
+        :raises IdempotencyConflict: The key was first used with a different request.
+        """
+        key = f"{_KEY_PREFIX}:idempotency:{idempotency_key}"
+        record = json.dumps({**task, "fingerprint": fingerprint})
+        if self.redis.set(key, record, nx=True, ex=self.idempotency_ttl):
+            return None
+        existing = self.redis.get(key)
+        if existing is None:
+            # expired in between, this request takes the key
+            self.redis.set(key, record, ex=self.idempotency_ttl)
+            return None
+        existing = json.loads(existing)
+        if existing.pop("fingerprint") != fingerprint:
+            raise IdempotencyConflict(f"Idempotency key '{idempotency_key}' was already used with another request.")
+        return existing
+
+    def retarget(self, idempotency_key: str, fingerprint: str, task: Dict[str, str]) -> None:
+        """ Answers the retries of a reserved idempotency key with another task, e.g. the one its request joined. """
+        self.redis.set(f"{_KEY_PREFIX}:idempotency:{idempotency_key}", json.dumps({**task, "fingerprint": fingerprint}),
+                       ex=self.idempotency_ttl, xx=True)
+
+    def release(self, idempotency_key: str) -> None:
+        """ Forgets an idempotency key whose task could not be enqueued, so that a retry may enqueue it. """
+        self.redis.delete(f"{_KEY_PREFIX}:idempotency:{idempotency_key}")
+
+    # ---------------------------------------------------------------------------------------------------------------
+    # In-flight prompts
+    # ---------------------------------------------------------------------------------------------------------------
+    def join(self, key: str, task_id: str) -> Optional[str]:
+        """
+        Registers a task as executing the request of the given key, unless another task already is.
+        :param key:     The key of the request, see `coalesce_key`.
+        :param task_id: The ID of the new task.
+        :return:        None if the task must be executed, else the ID of the task executing the request. In the
+                        'fanout' mode, the new task is then one of that task's followers.
+        """
+        return self._join(keys=[key], args=[task_id, self.window, "1" if self.mode == FANOUT else "0",
+                                            self.followers_ttl, f"{_KEY_PREFIX}:followers:"]) or None
+
+    def finish(self, key: str, task_id: str) -> List[str]:
+        """
+        Unregisters a finished task, so that the next request of its key is executed again.
+        :return:    The IDs of the tasks which joined it, to give its result to.
+        """
+        return self._finish(keys=[key, f"{_KEY_PREFIX}:followers:{task_id}"], args=[task_id])
+
+    def close(self) -> None:
+        self.redis.close()
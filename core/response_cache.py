@@ -0,0 +1,155 @@
+import os
+import re
+import json
+import time
+import hashlib
+import atexit
+import threading
+from collections import Counter, OrderedDict
+import redis
+from .metrics import MetricsRecorder
+from typing import *
+
+_KEY_PREFIX = "response_cache"
+_WHITESPACE = re.compile(r"\s+")
+
+def normalize_prompt(prompt: str) -> str:
+    """ Normalizes a prompt so that prompts differing only in case or whitespace share a cache entry. """
+    return _WHITESPACE.sub(" ", prompt).strip().casefold()
+
+def cache_key(layer: str, prompt: str, scope: Optional[str], model: Optional[str], normalize: bool = True) -> str:
+    """
+    Builds the cache key of a response.
+    :param layer:       What is cached, i.e. 'task' for a whole graph run or 'llm' for a single LLM call.
+    :param prompt:      The prompt the response answers.
+    :param scope:       What else the response depends on, e.g. the node it was produced for, or None if nothing.
+    :param model:       The model that produced the response.
+    :param normalize:   Whether prompts differing only in case or whitespace share the key. Prompts whose case or
+                        spacing matters (code, identifiers, tables) must be keyed on their exact text.
+    :return:            The key, in which the prompt only appears as the hash of its (normalized) text.
+    """
+    digest = hashlib.sha256((normalize_prompt(prompt) if normalize else prompt).encode()).hexdigest()
+    scope = f"{scope}:" if scope is not None else ""
+    return f"{_KEY_PREFIX}:{layer}:{scope}{model or 'none'}:{digest}"
+
+class ResponseCache:
+    """
+    Two tier cache of responses: a bounded in-process LRU in front of Redis, which is shared by every worker. Entries
+    expire after `ttl` seconds in both tiers. Values must be JSON serializable. A Redis outage degrades the cache to
+    its in-process tier, it never fails a task. The hits and misses are counted in memory and flushed to the metrics by a
+    background thread, so that a lookup never waits on the metrics' Redis.
+    """
+    def __init__(self, redis_url: Optional[str] = None, ttl: Optional[int] = None, max_entries: Optional[int] = None,
+                 max_value_bytes: Optional[int] = None, metrics: Optional[MetricsRecorder] = None,
+                 metrics_flush_interval: Optional[float] = None):
+        """
+        :param redis_url:       Defaults to $REDIS_URL. Without it, only the in-process tier is used.
+        :param ttl:             Seconds an entry lives. Defaults to $RESPONSE_CACHE_TTL_SECONDS or 3600.
+        :param max_entries:     Size of the in-process LRU. Defaults to $RESPONSE_CACHE_MAX_ENTRIES or 1024.
+        :param max_value_bytes: Values larger than this are not cached. Defaults to $RESPONSE_CACHE_MAX_VALUE_BYTES
+                                or 256 KiB.
+        :param metrics:         Where to count the hits and misses.
+        :param metrics_flush_interval:  Seconds between flushes of the hit and miss counts to the metrics. Defaults to
+                                        $RESPONSE_CACHE_METRICS_FLUSH_INTERVAL or 5.
+        """
+        redis_url = redis_url or os.getenv("REDIS_URL")
+        self.redis = redis.Redis.from_url(redis_url) if redis_url else None
+        self.ttl = ttl or int(os.getenv("RESPONSE_CACHE_TTL_SECONDS", "3600"))
+        self.max_entries = max_entries or int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "1024"))
+        self.max_value_bytes = max_value_bytes or int(os.getenv("RESPONSE_CACHE_MAX_VALUE_BYTES", str(256 * 1024)))
+        self.metrics = metrics
+        # key -> (expiry time, value), least recently used first
+        self._local: OrderedDict[str, Tuple[float, Any]] = OrderedDict()
+        # (layer, result) -> lookups not flushed to the metrics yet, guarded by the same lock as the LRU
+        self._counts: Counter[Tuple[str, str]] = Counter()
+        self._lock = threading.Lock()
+        self.metrics_flush_interval = metrics_flush_interval or \
+            float(os.getenv("RESPONSE_CACHE_METRICS_FLUSH_INTERVAL", "5"))
+        self._stop_flusher = threading.Event()
+        self._flusher: Optional[threading.Thread] = None
+        if self.metrics is not None:
+            self._flusher = threading.Thread(target=self._flush_loop, name="response-cache-metrics", daemon=True)
+            self._flusher.start()
+            # do not lose the counts of the last interval when the interpreter exits
+            atexit.register(self.flush_metrics)
+
+    def get(self, key: str) -> Optional[Any]:
+        """ Returns the cached value, or None on a miss. """
+        layer = key.split(":")[1]
+        with self._lock:
+            entry = self._local.get(key)
+            if entry is not None:
+                if entry[0] > time.monotonic():
+                    self._local.move_to_end(key)
+                    self._counts[(layer, "hit_memory")] += 1
+                    return entry[1]
+                del self._local[key]
+        if self.redis is not None:
+            try:
+                raw = self.redis.get(key)
+            except redis.RedisError as e:
+                print(f"Failed to read the response cache. Error: \n{e}")
+                raw = None
+            if raw is not None:
+                value = json.loads(raw)
+                self._put_local(key, value)
+                self._count(layer, "hit_redis")
+                return value
+        self._count(layer, "miss")
+        return None
+
+    def set(self, key: str, value: Any) -> None:
+        """ Caches a value in both tiers. """
+        raw = json.dumps(value, default=str)
+        if len(raw) > self.max_value_bytes:
+            return
+        self._put_local(key, value)
+        if self.redis is not None:
+            try:
+                self.redis.set(key, raw, ex=self.ttl)
+            except redis.RedisError as e:
+                print(f"Failed to write the response cache. Error: \n{e}")
+
+    def _put_local(self, key: str, value: Any) -> None:
+        with self._lock:
+            self._local[key] = (time.monotonic() + self.ttl, value)
+            self._local.move_to_end(key)
+            while len(self._local) > self.max_entries:
+                self._local.popitem(last=False)
+
+    def _count(self, layer: str, result: str) -> None:
+        with self._lock:
+            self._counts[(layer, result)] += 1
+
+    def flush_metrics(self) -> None:
+        """ Adds the hits and misses counted since the last flush to the metrics. """
+        with self._lock:
+            counts, self._counts = self._counts, Counter()
+        if self.metrics is not None and counts:
+            self.metrics.inc_many(("agent_response_cache_requests_total", {"layer": layer, "result": result}, count)
+                                  for (layer, result), count in counts.items())
+
+    def _flush_loop(self) -> None:
+        """ Background flusher of the hit and miss counts, every `metrics_flush_interval` seconds. """
+        while not self._stop_flusher.wait(self.metrics_flush_interval):
+            try:
+                self.flush_metrics()
+            except Exception as e:
+                print(f"Failed to flush the response cache metrics. Error: \n{e}")
+
+    def close(self) -> None:
+        """ Flushes the pending hit and miss counts, stops the background flusher and closes the Redis client. """
+        if self._flusher is not None:
+            self._stop_flusher.set()
+            self._flusher.join()
+            self._flusher = None
+            atexit.unregister(self.flush_metrics)
+        self.flush_metrics()
+        if self.redis is not None:
+            self.redis.close()
+
+def load_response_cache(metrics: Optional[MetricsRecorder] = None) -> Optional[ResponseCache]:
+    """ Builds the response cache if $RESPONSE_CACHE is enabled, else returns None. """
+    if os.getenv("RESPONSE_CACHE", "").lower() not in ("1", "true"):
+        return None
+    return ResponseCache(metrics=metrics)
@@ -0,0 +1,137 @@
+import os
+import time
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from .metrics import MetricsRecorder
+from .response_cache import ResponseCache, cache_key
+from typing import *
+
+class SearchBackend(Protocol):
+    """ Anything that can run a web search, e.g. `GoogleSearchAPIWrapper`. """
+    def results(self, query: str, num_results: int) -> List[Dict[str, Any]]:
+        ...
+
+class GoogleSearchBackend:
+    """ Google Programmable Search through `GoogleSearchAPIWrapper`, which is built on first use and then reused. """
+    name = "google"
+
+    def __init__(self):
+        self._wrapper = None
+        self._lock = threading.Lock()
+
+    def results(self, query: str, num_results: int) -> List[Dict[str, Any]]:
+        if self._wrapper is None:
+            with self._lock:
+                if self._wrapper is None:
+                    # for access to the Google search engine
+                    from langchain_google_community import GoogleSearchAPIWrapper
+                    self._wrapper = GoogleSearchAPIWrapper(k=num_results)
+        return self._wrapper.results(query, num_results=num_results)
+
+class StubSearchBackend:
+    """
+    Deterministic, offline search backend for local development and tests: the same query always returns the same
+    results, and results of overlapping queries can share links (to exercise the deduplication).
+    """
+    name = "stub"
+
+    def __init__(self, latency: float = 0.0, corpus_size: int = 8):
+        """
+        :param latency:     Seconds each search sleeps for, to stand in for the round trip to the search API.
+        :param corpus_size: Number of distinct links the stub draws its results from.
+        """
+        self.latency = latency
+        self.corpus_size = corpus_size
+        self.calls = 0
+
+    def results(self, query: str, num_results: int) -> List[Dict[str, Any]]:
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        seed = int(hashlib.sha256(query.encode()).hexdigest(), 16)
+        results = []
+        for i in range(num_results):
+            page = (seed + i) % self.corpus_size
+            results.append({
+                "title": f"Stub result {page}",
+                "link": f"https://example.com/stub/{page}",
+                "snippet": f"Stub snippet {page} for the query '{query}'.",
+            })
+        return results
+
+class SearchService:
+    """
+    Web search shared by every task of a worker process: a single backend instance, a TTL cache keyed by the
+    normalized query, and a thread pool to run several candidate queries concurrently.
+    """
+    def __init__(self, backend: SearchBackend, num_results: int = 4, cache: Optional[ResponseCache] = None,
+                 max_workers: int = 4, max_queries: int = 3):
+        """
+        :param backend:     The search backend.
+        :param num_results: Number of results requested per query.
+        :param cache:       Cache of the results per normalized query, or None to not cache them.
+        :param max_workers: Maximum number of queries searched concurrently.
+        :param max_queries: Maximum number of candidate queries searched per task.
+        """
+        self.backend = backend
+        self.num_results = num_results
+        self.cache = cache
+        self.max_queries = max_queries
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="search")
+
+    def search(self, query: str) -> List[Dict[str, Any]]:
+        """ Returns the results of a single query, from the cache if it was searched within the TTL. """
+        key = cache_key("search", query, "content", getattr(self.backend, "name", type(self.backend).__name__))
+        if self.cache is not None:
+            cached = self.cache.get(key)
+            if cached is not None:
+                return cached
+        results = self.backend.results(query, num_results=self.num_results)
+        if self.cache is not None:
+            self.cache.set(key, results)
+        return results
+
+    def search_many(self, queries: Sequence[str]) -> Optional[List[Dict[str, Any]]]:
+        """
+        Searches every query concurrently and merges the results, keeping the first occurrence of each link. Results
+        are ordered by query (in the given order) and then by rank.
+        :param queries: The candidate queries.
+        :return:        The merged results, or None if every search failed.
+        """
+        futures = [self._pool.submit(self.search, query) for query in queries]
+        merged, seen, failures = [], set(), 0
+        for query, future in zip(queries, futures):
+            try:
+                results = future.result()
+            except Exception as e:
+                failures += 1
+                print(f"Error during the search for '{query}'. Check your API key and CSE ID. Error: \n{e}")
+                continue
+            for result in results:
+                link = result.get("link")
+                if link in seen:
+                    continue
+                seen.add(link)
+                merged.append(result)
+        return None if queries and failures == len(queries) else merged
+
+    def close(self) -> None:
+        self._pool.shutdown(wait=False)
+
+def load_search_service(metrics: Optional[MetricsRecorder] = None) -> SearchService:
+    """
+    Builds the search service from the environment: $SEARCH_BACKEND ('google' or 'stub'), $SEARCH_NUM_RESULTS,
+    $SEARCH_CACHE_TTL_SECONDS (0 disables the cache), $SEARCH_MAX_WORKERS and $SEARCH_MAX_QUERIES.
+    """
+    backend_name = os.getenv("SEARCH_BACKEND", "google").lower()
+    backend: SearchBackend = StubSearchBackend() if backend_name == "stub" else GoogleSearchBackend()
+    ttl = int(os.getenv("SEARCH_CACHE_TTL_SECONDS", "600"))
+    cache = ResponseCache(ttl=ttl, metrics=metrics) if ttl > 0 else None
+    return SearchService(
+        backend,
+        num_results=int(os.getenv("SEARCH_NUM_RESULTS", "4")),
+        cache=cache,
+        max_workers=int(os.getenv("SEARCH_MAX_WORKERS", "4")),
+        max_queries=int(os.getenv("SEARCH_MAX_QUERIES", "3")),
+    )
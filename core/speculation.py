@@ -0,0 +1,244 @@
+import os
+import time
+import asyncio
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from langchain_core.messages import BaseMessage
+from .instrumentation import NodeMetrics, current_node_metrics, use_node_metrics
+from .local_classifier import LocalTaskClassifier
+from .metrics import MetricsRecorder
+from .response_cache import ResponseCache
+from typing import *
+
+# routes whose answering node only needs the prompt (and the conversation), so it can start before the classification
+SPECULATIVE_ROUTES: Tuple[str, ...] = ("general", "code", "summarize")
+
+class Speculation:
+    """ The generation of a task's answer, started on a predicted route before the task was classified. """
+    def __init__(self, route: str, response_cache: Optional[ResponseCache]):
+        self.route = route
+        # the LLM call is recorded on metrics of its own, which the answering node adopts on a hit
+        self.metrics = NodeMetrics(route)
+        self.metrics.response_cache = response_cache
+        self.finished: Optional[float] = None
+        self.future: Optional[Union[Future, asyncio.Task]] = None
+
+    def duration(self) -> float:
+        """ Wall time of the generation, up to now if it is still running. """
+        return (self.finished or time.perf_counter()) - self.metrics.started
+
+class SpeculativeRouter:
+    """
+    Starts the answer of the `general`, `code` and `summarize` routes while the LLM router is still classifying the
+    prompt, so that a correctly predicted task waits for one LLM round trip instead of two. The route is predicted
+    without a network call, by the local classifier (at any confidence), else from the route of the thread's previous
+    turn, else it is the default route. The speculative generation is committed by the answering node of the predicted
+    route and cancelled if the router picks another one.
+    """
+    def __init__(self, classifier: Optional[LocalTaskClassifier], labels: Sequence[str],
+                 default_route: Optional[str] = "general", max_workers: int = 8,
+                 response_cache: Optional[ResponseCache] = None, recorder: Optional[MetricsRecorder] = None):
+        """
+        :param classifier:      Local classifier predicting the route. A rules-only one is used if None.
+        :param labels:          Every route of the graph.
+        :param default_route:   Route predicted when neither the classifier nor the thread has a prediction, or None
+                                to not speculate on such prompts.
+        :param max_workers:     Speculative generations run at once by the synchronous graph.
+        :param response_cache:  Cache of the LLM calls of the answering nodes, which the speculative calls share.
+        :param recorder:        Where to export the outcomes and the saved latency, or None to only store them in the
+                                task log.
+        """
+        self.classifier = classifier or LocalTaskClassifier(labels)
+        self.default_route = default_route
+        self.recorder = recorder
+        self.response_cache = response_cache
+        # pending speculations by task ID
+        self._pending: Dict[str, Speculation] = {}
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="speculation")
+
+    def predict(self, state: Dict[str, Any]) -> Optional[str]:
+        """
+        :param state:   The state of the graph at the classification.
+        :return:        The route to speculate on, or None if it is not one of `SPECULATIVE_ROUTES`.
+        """
+        if state.get('documents'):
+            # the documents are condensed before the summarizing agent answers, which the prediction cannot start
+            return None
+        route, _, _ = self.classifier.predict(state['prompt_content'])
+        if route is None:
+            # on a continued thread, the checkpointer restored the classification of the previous turn
+            route = (state.get('task_classification') or {}).get('task') or self.default_route
+        return route if route in SPECULATIVE_ROUTES else None
+
+    # ---------------------------------------------------------------------------------------------------------------
+    # Classification side
+    # ---------------------------------------------------------------------------------------------------------------
+    def start(self, task_id: str, route: str, generate: Callable[[], BaseMessage]) -> None:
+        """ Runs `generate` on the router's thread pool, i.e. concurrently with the caller's classification. """
+        speculation = Speculation(route, self.response_cache)
+
+        def run() -> BaseMessage:
+            try:
+                with use_node_metrics(speculation.metrics):
+                    return generate()
+            finally:
+                speculation.finished = time.perf_counter()
+
+        speculation.future = self._pool.submit(run)
+        self._register(task_id, speculation)
+
+    def astart(self, task_id: str, route: str, generate: Callable[[], Awaitable[BaseMessage]]) -> None:
+        """ Asynchronous counterpart of `start`, running `generate` as a task of the current event loop. """
+        speculation = Speculation(route, self.response_cache)
+
+        async def run() -> BaseMessage:
+            try:
+                with use_node_metrics(speculation.metrics):
+                    return await generate()
+            finally:
+                speculation.finished = time.perf_counter()
+
+        speculation.future = asyncio.get_running_loop().create_task(run())
+        self._register(task_id, speculation)
+
+    def resolve(self, task_id: str, route: str) -> None:
+        """
+        Compares the classification with the prediction, recording the outcome on the current (classification) node.
+        A speculation on another route is cancelled, one on this route is left for its answering node to commit.
+        """
+        with self._lock:
+            speculation = self._pending.get(task_id)
+            hit = speculation is not None and speculation.route == route
+            if speculation is not None and not hit:
+                del self._pending[task_id]
+        if speculation is None:
+            return
+        metrics = current_node_metrics()
+        if metrics is not None:
+            metrics.speculative_route = speculation.route
+            metrics.speculation_hit = hit
+        if self.recorder is not None:
+            self.recorder.inc("agent_speculation_total", {"route": speculation.route,
+                                                          "outcome": "hit" if hit else "miss"})
+        if not hit:
+            self._cancel(speculation, route)
+
+    def discard(self, task_id: str) -> None:
+        """ Cancels the speculation of a task which will not be committed, e.g. if its classification failed. """
+        with self._lock:
+            speculation = self._pending.pop(task_id, None)
+        if speculation is not None:
+            self._cancel(speculation, "unknown")
+
+    # ---------------------------------------------------------------------------------------------------------------
+    # Answering side
+    # ---------------------------------------------------------------------------------------------------------------
+    def commit(self, task_id: str, route: str) -> Optional[BaseMessage]:
+        """
+        Waits for the speculative generation of the task on this route.
+        :return:    The generated message, or None if there is no such speculation or if it failed, in which case the
+                    node generates its answer itself.
+        """
+        speculation = self._take(task_id, route)
+        if speculation is None:
+            return None
+        waited = time.perf_counter()
+        try:
+            message = speculation.future.result()
+        except Exception as e:
+            print(f"The speculative generation of the '{route}' route failed, generating the answer again: {e}")
+            return None
+        return self._adopt(speculation, message, time.perf_counter() - waited)
+
+    async def acommit(self, task_id: str, route: str) -> Optional[BaseMessage]:
+        """ Asynchronous counterpart of `commit`. """
+        speculation = self._take(task_id, route)
+        if speculation is None:
+            return None
+        waited = time.perf_counter()
+        try:
+            message = await speculation.future
+        except Exception as e:
+            print(f"The speculative generation of the '{route}' route failed, generating the answer again: {e}")
+            return None
+        return self._adopt(speculation, message, time.perf_counter() - waited)
+
+    def close(self) -> None:
+        with self._lock:
+            pending, self._pending = list(self._pending.values()), {}
+        for speculation in pending:
+            self._cancel(speculation, "unknown")
+        self._pool.shutdown(wait=False)
+
+    def _register(self, task_id: str, speculation: Speculation) -> None:
+        with self._lock:
+            previous = self._pending.pop(task_id, None)
+            self._pending[task_id] = speculation
+        if previous is not None:
+            self._cancel(previous, "unknown")
+
+    def _take(self, task_id: str, route: str) -> Optional[Speculation]:
+        with self._lock:
+            speculation = self._pending.get(task_id)
+            if speculation is None or speculation.route != route:
+                return None
+            return self._pending.pop(task_id)
+
+    def _adopt(self, speculation: Speculation, message: BaseMessage, waited: float) -> BaseMessage:
+        """
+        Records the speculative LLM call on the current (answering) node, along with the latency it saved, i.e. how
+        much of the generation had already run when the node started waiting for it. Since the speculation does not
+        stream, a node with a token sink relays the whole response at once.
+        """
+        saved = max(0.0, speculation.duration() - waited)
+        metrics = current_node_metrics()
+        if metrics is not None:
+            metrics.merge(speculation.metrics)
+            metrics.speculation_saved_s = saved
+            if metrics.token_sink is not None:
+                metrics.ttft_s = metrics.ttft_s or waited
+                metrics.token_sink.write(message.content)
+                metrics.token_sink.flush()
+        if self.recorder is not None:
+            self.recorder.observe("agent_speculation_saved_seconds", saved, {"route": speculation.route})
+        return message
+
+    def _cancel(self, speculation: Speculation, route: str) -> None:
+        """
+        Cancels a speculation. A synchronous LLM call which already started cannot be interrupted, it runs to
+        completion and its result is dropped, but its cost is still exported.
+        """
+        if isinstance(speculation.future, asyncio.Task):
+            # the task may belong to another thread's loop when the router is closed
+            speculation.future.get_loop().call_soon_threadsafe(speculation.future.cancel)
+            return
+        if speculation.future.cancel() or self.recorder is None:
+            return
+
+        def record_cost(_: Future) -> None:
+            metrics = speculation.metrics
+            if metrics.cost_usd:
+                self.recorder.inc("agent_llm_cost_usd_total", {"node": f"speculative_{metrics.node}", "route": route,
+                                                               "model": metrics.model}, metrics.cost_usd)
+
+        speculation.future.add_done_callback(record_cost)
+
+def load_speculative_router(classifier: Optional[LocalTaskClassifier], labels: Sequence[str],
+                            response_cache: Optional[ResponseCache] = None,
+                            recorder: Optional[MetricsRecorder] = None) -> Optional[SpeculativeRouter]:
+    """
+    Builds the speculative router if $SPECULATIVE_ROUTING is enabled, else returns None. $SPECULATIVE_DEFAULT_ROUTE
+    is the route predicted when nothing else predicts one (empty to not speculate then), and
+    $SPECULATIVE_MAX_WORKERS bounds the speculative generations run at once by the synchronous graph.
+    :param classifier:      The local classifier of the worker, if enabled, which predicts the route.
+    :param labels:          Every route of the graph.
+    :param response_cache:  Cache of the LLM calls of the nodes, if enabled.
+    :param recorder:        Where to export the outcomes and the saved latency.
+    """
+    if os.getenv("SPECULATIVE_ROUTING", "").lower() not in ("1", "true"):
+        return None
+    return SpeculativeRouter(classifier, labels,
+                             default_route=os.getenv("SPECULATIVE_DEFAULT_ROUTE", "general") or None,
+                             max_workers=int(os.getenv("SPECULATIVE_MAX_WORKERS", "8")),
+                             response_cache=response_cache, recorder=recorder)
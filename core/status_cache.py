@@ -0,0 +1,97 @@
+import os
+import zlib
+import redis
+from typing import *
+
+# the status record of every task is a Redis hash at 'task_status:<task_id>'
+STATUS_PREFIX = "task_status"
+
+def task_status_key(task_id: str) -> str:
+    """ Returns the key of the Redis hash holding the status record of a task. """
+    return f"{STATUS_PREFIX}:{task_id}"
+
+def status_etag(version: Union[int, str]) -> str:
+    """ ETag of a status record. The version is bumped on every status change, but not on every step. """
+    return f'"s{version}"'
+
+def document_etag(status: str) -> str:
+    """ ETag of a status read from MongoDB, for tasks whose record expired from (or never reached) Redis. """
+    return f'"m{zlib.crc32(status.encode())}"'
+
+class TaskStatusCache:
+    """
+    Hot tier of the task statuses in front of MongoDB. The workers keep a compact record per task in Redis (status,
+    last event and node, number of steps and route) whose `version` is bumped whenever the status changes. The final
+    response itself stays in MongoDB, the record only notes that it is there, so polling a running task never touches
+    MongoDB and polling a finished one only does when the client does not already hold its latest version.
+    """
+    def __init__(self, redis_url: Optional[str] = None, ttl: Optional[int] = None):
+        """
+        :param redis_url:   Defaults to $REDIS_URL.
+        :param ttl:         Seconds a record lives after its last update. Defaults to $TASK_STATUS_TTL_SECONDS or 1 day.
+        """
+        redis_url = redis_url or os.getenv("REDIS_URL")
+        if not redis_url:
+            raise ValueError("REDIS_URL environment variable not set.")
+        self.redis = redis.Redis.from_url(redis_url, decode_responses=True)
+        self.ttl = ttl or int(os.getenv("TASK_STATUS_TTL_SECONDS", str(24 * 3600)))
+
+    def _write(self, task_id: str, fields: Dict[str, Any], bump: bool) -> Optional[str]:
+        """ Updates a record, returning its new ETag if the version was bumped. Redis errors never fail a task. """
+        try:
+            pipe = self.redis.pipeline(transaction=False)
+            pipe.hset(task_status_key(task_id), mapping=fields)
+            if bump:
+                pipe.hincrby(task_status_key(task_id), "version", 1)
+            pipe.expire(task_status_key(task_id), self.ttl)
+            results = pipe.execute()
+        except redis.RedisError as e:
+            print(f"Failed to update the status record of task {task_id}. Error: \n{e}")
+            return None
+        return status_etag(results[1]) if bump else None
+
+    def queued(self, task_ids: Sequence[str], status: str) -> None:
+        """ Creates the records of tasks enqueued in bulk, in a single round trip. """
+        try:
+            pipe = self.redis.pipeline(transaction=False)
+            for task_id in task_ids:
+                pipe.hset(task_status_key(task_id), mapping={"status": status, "current_event": "QUEUED",
+                                                              "version": 1})
+                pipe.expire(task_status_key(task_id), self.ttl)
+            pipe.execute()
+        except redis.RedisError as e:
+            print(f"Failed to create the status records of {len(task_ids)} tasks. Error: \n{e}")
+
+    def start(self, task_id: str, status: str) -> Optional[str]:
+        return self._write(task_id, {"status": status, "current_event": "START"}, bump=True)
+
+    def step(self, task_id: str, node: str) -> None:
+        try:
+            pipe = self.redis.pipeline(transaction=False)
+            pipe.hset(task_status_key(task_id), mapping={"current_event": "STEP", "node": node})
+            pipe.hincrby(task_status_key(task_id), "steps", 1)
+            pipe.expire(task_status_key(task_id), self.ttl)
+            pipe.execute()
+        except redis.RedisError as e:
+            print(f"Failed to update the status record of task {task_id}. Error: \n{e}")
+
+    def end(self, task_id: str, status: str, route: Optional[str]) -> Optional[str]:
+        # 'final_response' is only a pointer, the response is read from MongoDB
+        return self._write(task_id, {"status": status, "current_event": "END", "route": route or "",
+                                     "final_response": "mongodb"}, bump=True)
+
+    def get(self, task_id: str) -> Optional[Dict[str, str]]:
+        """
+        :param task_id:
+        :return:        The record, or None if there is none (or Redis is unreachable).
+        """
+        try:
+            record = self.redis.hgetall(task_status_key(task_id))
+        except redis.RedisError as e:
+            print(f"Failed to read the status record of task {task_id}. Error: \n{e}")
+            return None
+        # a step logged after the record expired leaves a partial record behind, which is as good as none
+        return record if record.get("status") else None
+
+    def close(self) -> None:
+        self.redis.close()
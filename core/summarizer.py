@@ -0,0 +1,259 @@
+import os
+import re
+import asyncio
+import hashlib
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from .instrumentation import NodeMetrics, current_node_metrics, use_node_metrics, invoke_llm, ainvoke_llm
+from .metrics import MetricsRecorder
+from .response_cache import ResponseCache, cache_key
+from typing import *
+
+if TYPE_CHECKING:
+    from langchain_core.language_models import BaseChatModel
+
+# approximate number of characters per token, used when no tokenizer is available
+_CHARS_PER_TOKEN = 4
+_PARAGRAPH_BREAK = re.compile(r"\n\s*\n")
+
+class TokenCounter:
+    """ Counts and splits text by tokens, with tiktoken if its encoding can be loaded, else by characters. """
+    def __init__(self, encoding: str = "o200k_base"):
+        try:
+            import tiktoken
+            self._encoding = tiktoken.get_encoding(encoding)
+        except Exception as e:
+            print(f"Could not load the tokenizer, documents will be chunked by characters instead. Error: \n{e}")
+            self._encoding = None
+
+    def count(self, text: str) -> int:
+        if self._encoding is None:
+            return -(-len(text) // _CHARS_PER_TOKEN)
+        return len(self._encoding.encode(text, disallowed_special=()))
+
+    def split(self, text: str, max_tokens: int) -> List[str]:
+        """ Splits text into consecutive pieces of at most `max_tokens` tokens. """
+        if self._encoding is None:
+            step = max_tokens * _CHARS_PER_TOKEN
+            return [text[i:i + step] for i in range(0, len(text), step)]
+        tokens = self._encoding.encode(text, disallowed_special=())
+        return [self._encoding.decode(tokens[i:i + max_tokens]) for i in range(0, len(tokens), max_tokens)]
+
+def _is_boundary(paragraph: str, boundary_every: int) -> bool:
+    """ Whether a chunk may end after this paragraph, which only depends on the paragraph's own content. """
+    return int(hashlib.sha256(paragraph.encode()).hexdigest()[:8], 16) % boundary_every == 0
+
+def iter_chunks(text: str, counter: TokenCounter, max_tokens: int, boundary_every: int = 4) -> Iterator[str]:
+    """
+    Splits a document into chunks of at most `max_tokens` tokens, made of whole paragraphs (a paragraph longer than
+    that is split by tokens). The chunks are content defined: past half of the budget, a chunk ends after a paragraph
+    whose hash is a multiple of `boundary_every`. An edit therefore only moves the chunk boundaries up to the next such
+    paragraph, and the chunks after it are the same as before the edit, so their cached summaries are reused.
+    :param text:            The document.
+    :param counter:         Counts the tokens.
+    :param max_tokens:      Token budget of a chunk.
+    :param boundary_every:  One paragraph in this many (on average) may end a chunk.
+    :return:                The chunks, lazily.
+    """
+    current: List[str] = []
+    size = 0
+    for block in _PARAGRAPH_BREAK.split(text):
+        block = block.strip()
+        if not block:
+            continue
+        for paragraph in counter.split(block, max_tokens) if counter.count(block) > max_tokens else [block]:
+            tokens = counter.count(paragraph)
+            if current and size + tokens > max_tokens:
+                yield "\n\n".join(current)
+                current, size = [], 0
+            current.append(paragraph)
+            size += tokens
+            if size >= max_tokens // 2 and _is_boundary(paragraph, boundary_every):
+                yield "\n\n".join(current)
+                current, size = [], 0
+    if current:
+        yield "\n\n".join(current)
+
+def _map_prompt(chunk: str) -> str:
+    return f"""
+    You are summarizing one part of a longer document. Write a dense summary of the part below which keeps every
+    fact, name, number and conclusion that a reader of the whole document would need. Output the summary only.
+
+    {chunk}
+    """
+
+def _reduce_prompt(summaries: str) -> str:
+    return f"""
+    Below are the summaries of consecutive parts of a longer document. Merge them into a single dense summary which
+    keeps every fact, name, number and conclusion, in the order of the document. Output the summary only.
+
+    {summaries}
+    """
+
+class Summarizer:
+    """
+    Condenses content too long for a single LLM call with a map-reduce: the documents are split into token-bounded
+    chunks as they are read, the chunks are summarized concurrently on a bounded pool, and the summaries are merged
+    hierarchically, in groups that fit the budget, until they fit in the prompt of the summarizing agent. Every
+    summary (of a chunk or of a group) is cached by the hash of its content, so summarizing an edited document again
+    only summarizes its changed chunks.
+    """
+    def __init__(self, direct_max_tokens: int = 8000, chunk_tokens: int = 2000, max_workers: int = 4,
+                 cache: Optional[ResponseCache] = None):
+        """
+        :param direct_max_tokens:   Content up to this many tokens is given to the agent as is.
+        :param chunk_tokens:        Token budget of a chunk, and of a group of summaries merged by one call.
+        :param max_workers:         Summaries written concurrently by the synchronous graph, per worker process, and
+                                    per task by the asynchronous graph.
+        :param cache:               Cache of the summaries by content hash, or None to not cache them.
+        """
+        self.direct_max_tokens = direct_max_tokens
+        self.chunk_tokens = chunk_tokens
+        self.max_workers = max_workers
+        self.cache = cache
+        self.counter = TokenCounter()
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="summarizer")
+
+    def fits(self, documents: Sequence[str]) -> bool:
+        """ Whether the documents are short enough to be given to the agent as they are. """
+        total = 0
+        for document in documents:
+            total += self.counter.count(document)
+            if total > self.direct_max_tokens:
+                return False
+        return True
+
+    # ---------------------------------------------------------------------------------------------------------------
+    # Synchronous
+    # ---------------------------------------------------------------------------------------------------------------
+    def condense(self, llm: "BaseChatModel", documents: Iterable[str]) -> str:
+        """
+        Summarizes the documents with a map-reduce. The LLM calls are recorded on the current node.
+        :param llm:         LLM object instance.
+        :param documents:   The documents, read lazily.
+        :return:            The merged summary, which fits in `direct_max_tokens`.
+        """
+        summaries = self._run(llm, "map", (_map_prompt(chunk) for chunk in self._chunks(documents)))
+        while len(summaries) > 1 and self._too_long(summaries):
+            summaries = self._run(llm, "reduce", (_reduce_prompt(group) for group in self._groups(summaries)))
+        return "\n\n".join(summaries)
+
+    def _run(self, llm: "BaseChatModel", stage: str, prompts: Iterable[str]) -> List[str]:
+        """ Summarizes the prompts on the pool, never more than twice the pool size submitted at once. """
+        slots = threading.BoundedSemaphore(self.max_workers * 2)
+        futures: List[Future] = []
+        for prompt in prompts:
+            slots.acquire()
+            future = self._pool.submit(self._summarize, llm, stage, prompt)
+            future.add_done_callback(lambda _: slots.release())
+            futures.append(future)
+        return self._collect(stage, [future.result() for future in futures])
+
+    def _summarize(self, llm: "BaseChatModel", stage: str, prompt: str) -> Tuple[str, Optional[NodeMetrics]]:
+        key = self._key(llm, stage, prompt)
+        cached = self.cache.get(key) if self.cache is not None else None
+        if cached is not None:
+            return cached, None
+        # the calls run on pool threads, each one is recorded on metrics of its own which the node then adds up
+        metrics = NodeMetrics(stage)
+        with use_node_metrics(metrics):
+            summary = invoke_llm(llm, prompt).content
+        if self.cache is not None:
+            self.cache.set(key, summary)
+        return summary, metrics
+
+    # ---------------------------------------------------------------------------------------------------------------
+    # Asynchronous
+    # ---------------------------------------------------------------------------------------------------------------
+    async def acondense(self, llm: "BaseChatModel", documents: Iterable[str]) -> str:
+        """ Asynchronous counterpart of `condense`, running up to `max_workers` calls at once on the current loop. """
+        summaries = await self._arun(llm, "map", (_map_prompt(chunk) for chunk in self._chunks(documents)))
+        while len(summaries) > 1 and self._too_long(summaries):
+            summaries = await self._arun(llm, "reduce", (_reduce_prompt(group) for group in self._groups(summaries)))
+        return "\n\n".join(summaries)
+
+    async def _arun(self, llm: "BaseChatModel", stage: str, prompts: Iterable[str]) -> List[str]:
+        slots = asyncio.Semaphore(self.max_workers)
+
+        async def summarize(prompt: str) -> Tuple[str, Optional[NodeMetrics]]:
+            try:
+                return await self._asummarize(llm, stage, prompt)
+            finally:
+                slots.release()
+
+        tasks = []
+        for prompt in prompts:
+            await slots.acquire()
+            tasks.append(asyncio.create_task(summarize(prompt)))
+        return self._collect(stage, await asyncio.gather(*tasks))
+
+    async def _asummarize(self, llm: "BaseChatModel", stage: str, prompt: str) -> Tuple[str, Optional[NodeMetrics]]:
+        key = self._key(llm, stage, prompt)
+        cached = self.cache.get(key) if self.cache is not None else None
+        if cached is not None:
+            return cached, None
+        metrics = NodeMetrics(stage)
+        with use_node_metrics(metrics):
+            summary = (await ainvoke_llm(llm, prompt)).content
+        if self.cache is not None:
+            self.cache.set(key, summary)
+        return summary, metrics
+
+    # ---------------------------------------------------------------------------------------------------------------
+    # Shared
+    # ---------------------------------------------------------------------------------------------------------------
+    def _chunks(self, documents: Iterable[str]) -> Iterator[str]:
+        for document in documents:
+            yield from iter_chunks(document, self.counter, self.chunk_tokens)
+
+    def _too_long(self, summaries: Sequence[str]) -> bool:
+        return sum(self.counter.count(summary) for summary in summaries) > self.direct_max_tokens
+
+    def _groups(self, summaries: Sequence[str]) -> Iterator[str]:
+        """ Consecutive summaries grouped within the chunk budget, at least two per group so every level shrinks. """
+        group: List[str] = []
+        size = 0
+        for summary in summaries:
+            tokens = self.counter.count(summary)
+            if len(group) >= 2 and size + tokens > self.chunk_tokens:
+                yield "\n\n".join(group)
+                group, size = [], 0
+            group.append(summary)
+            size += tokens
+        if group:
+            yield "\n\n".join(group)
+
+    def _key(self, llm: "BaseChatModel", stage: str, prompt: str) -> str:
+        # a content hash of the exact chunk: chunks differing only in case or spacing (code, tables) differ in meaning
+        return cache_key("summary", prompt, stage, getattr(llm, "model_name", None), normalize=False)
+
+    @staticmethod
+    def _collect(stage: str, results: Sequence[Tuple[str, Optional[NodeMetrics]]]) -> List[str]:
+        """ Adds the calls of a stage to the current node's metrics, returning the summaries in order. """
+        metrics = current_node_metrics()
+        if metrics is not None:
+            for _, call_metrics in results:
+                if call_metrics is not None:
+                    metrics.merge(call_metrics)
+            if stage == "map":
+                metrics.chunks += len(results)
+                metrics.cached_chunks += sum(call_metrics is None for _, call_metrics in results)
+        return [summary for summary, _ in results]
+
+    def close(self) -> None:
+        self._pool.shutdown(wait=False)
+        if self.cache is not None:
+            self.cache.close()
+
+def load_summarizer(metrics: Optional[MetricsRecorder] = None) -> Summarizer:
+    """
+    Builds the summarizer from the environment: $SUMMARY_DIRECT_MAX_TOKENS, $SUMMARY_CHUNK_TOKENS,
+    $SUMMARY_MAX_WORKERS and $SUMMARY_CACHE_TTL_SECONDS (0 disables the cache).
+    """
+    ttl = int(os.getenv("SUMMARY_CACHE_TTL_SECONDS", "86400"))
+    return Summarizer(
+        direct_max_tokens=int(os.getenv("SUMMARY_DIRECT_MAX_TOKENS", "8000")),
+        chunk_tokens=int(os.getenv("SUMMARY_CHUNK_TOKENS", "2000")),
+        max_workers=int(os.getenv("SUMMARY_MAX_WORKERS", "4")),
+        cache=ResponseCache(ttl=ttl, metrics=metrics) if ttl > 0 else None,
+    )
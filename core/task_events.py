@@ -0,0 +1,120 @@
+import os
+import json
+import asyncio
+import redis
+import redis.asyncio as aioredis
+from typing import *
+
+# every task publishes its events on its own channel, 'task_events:<task_id>'
+CHANNEL_PREFIX = "task_events"
+# statuses after which a task publishes no further events
+TERMINAL_STATUSES: Tuple[str, ...] = ("Completed", "Failed", "Error")
+
+def task_channel(task_id: str) -> str:
+    """ Returns the Redis pub/sub channel on which the events of a task are published. """
+    return f"{CHANNEL_PREFIX}:{task_id}"
+
+class TaskEventPublisher:
+    """
+    Publishes the lifecycle events of a task (START, STEP, END) over Redis pub/sub. This is used by the workers,
+    through the `MongoDBLogger`, to wake up the API clients waiting on a task instead of having them poll MongoDB.
+    Publishing never raises, a Redis outage only means waiting clients fall back to their timeout.
+    """
+    def __init__(self, redis_url: Optional[str] = None):
+        redis_url = redis_url or os.getenv("REDIS_URL")
+        if not redis_url:
+            raise ValueError("REDIS_URL environment variable not set.")
+        self.redis = redis.Redis.from_url(redis_url)
+
+    def publish(self, task_id: str, event: str, **payload: Any) -> None:
+        """
+        Publishes an event of a task.
+        :param task_id: The ID of the task.
+        :param event:   The event type, i.e. 'START', 'STEP' or 'END'.
+        :param payload: JSON serializable fields of the event, e.g. the status of the task.
+        :return:
+        """
+        message = json.dumps({"task_id": task_id, "event": event, **payload}, default=str)
+        try:
+            self.redis.publish(task_channel(task_id), message)
+        except redis.RedisError as e:
+            print(f"Failed to publish the {event} event of task {task_id}. Error: \n{e}")
+
+    def close(self) -> None:
+        self.redis.close()
+
+class TaskEventSubscriber:
+    """
+    Fans the task events out to the clients of an API process that are waiting on them.
+
+    A single pattern subscription (i.e. one Redis connection) is shared by every waiting client of the process, so the
+    cost of a waiting client is an `asyncio.Queue` rather than a database poll or a Redis connection.
+    """
+    # seconds to wait before resubscribing after the connection to Redis was lost
+    RECONNECT_DELAY = 1.0
+
+    def __init__(self, redis_url: Optional[str] = None, max_queued_events: int = 100):
+        redis_url = redis_url or os.getenv("REDIS_URL")
+        if not redis_url:
+            raise ValueError("REDIS_URL environment variable not set.")
+        self.redis = aioredis.Redis.from_url(redis_url)
+        self.max_queued_events = max_queued_events
+        self._waiters: Dict[str, Set[asyncio.Queue]] = {}
+        self._listener: Optional[asyncio.Task] = None
+
+    async def start(self) -> None:
+        """ Starts listening for task events. Must be called from the API's event loop. """
+        if self._listener is None:
+            self._listener = asyncio.create_task(self._listen())
+
+    async def stop(self) -> None:
+        """ Stops listening for task events and closes the connection to Redis. """
+        if self._listener is not None:
+            self._listener.cancel()
+            try:
+                await self._listener
+            except asyncio.CancelledError:
+                pass
+            self._listener = None
+        await self.redis.aclose()
+
+    def subscribe(self, task_id: str) -> asyncio.Queue:
+        """
+        Registers interest in the events of a task. Subscribe BEFORE reading the task's current status so that no event
+        published in between is missed.
+        :param task_id: The ID of the task.
+        :return:        Queue which receives the decoded events of the task.
+        """
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.max_queued_events)
+        self._waiters.setdefault(task_id, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, task_id: str, queue: asyncio.Queue) -> None:
+        """ Removes a queue returned by `subscribe`. """
+        queues = self._waiters.get(task_id)
+        if queues is not None:
+            queues.discard(queue)
+            if not queues:
+                del self._waiters[task_id]
+
+    async def _listen(self) -> None:
+        while True:
+            try:
+                async with self.redis.pubsub() as pubsub:
+                    await pubsub.psubscribe(f"{CHANNEL_PREFIX}:*")
+                    async for message in pubsub.listen():
+                        if message["type"] == "pmessage":
+                            self._dispatch(message["data"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Lost the task event subscription, resubscribing. Error: \n{e}")
+                await asyncio.sleep(self.RECONNECT_DELAY)
+
+    def _dispatch(self, data: bytes) -> None:
+        event = json.loads(data)
+        for queue in self._waiters.get(event.get("task_id"), ()):
+            if queue.full():
+                # drop the oldest event of a slow consumer rather than the latest, which may be the END event
+                queue.get_nowait()
+            queue.put_nowait(event)
@@ -0,0 +1,147 @@
+import os
+import time
+import threading
+import redis
+import redis.asyncio as aioredis
+from typing import *
+
+# every task streams its tokens into its own Redis Stream, 'task_stream:<task_id>'
+STREAM_PREFIX = "task_stream"
+
+def token_stream_key(task_id: str) -> str:
+    """ Returns the key of the Redis Stream holding the tokens of a task. """
+    return f"{STREAM_PREFIX}:{task_id}"
+
+class TokenSink:
+    """
+    Relays the tokens of one LLM call into the task's Redis Stream. Tokens are coalesced into one XADD every
+    `flush_interval` seconds to keep the number of round trips independent of the token rate, except for the very first
+    token of the task which is written right away.
+    """
+    def __init__(self, publisher: "TokenStreamPublisher", task_id: str, node: str):
+        self.publisher = publisher
+        self.task_id = task_id
+        self.node = node
+        self._buffer: List[str] = []
+        self._last_flush = time.perf_counter()
+
+    def write(self, text: str) -> None:
+        if self.buffer(text):
+            self.flush()
+
+    def buffer(self, text: str) -> bool:
+        """ Buffers tokens without writing them, returning whether they are due to be flushed. """
+        if not text:
+            return False
+        self._buffer.append(text)
+        first = self.publisher.mark_first_token(self.task_id)
+        return first or time.perf_counter() - self._last_flush >= self.publisher.flush_interval
+
+    def flush(self) -> None:
+        if self._buffer:
+            self.publisher.append(self.task_id, {"type": "token", "node": self.node, "text": "".join(self._buffer)})
+            self._buffer = []
+        self._last_flush = time.perf_counter()
+
+class TokenStreamPublisher:
+    """
+    Used by the workers to stream the tokens of the LLM responses to the API through Redis Streams. Unlike pub/sub, a
+    stream keeps its entries, so a client connecting late (or reconnecting) still receives every token from the start.
+    The stream of a task ends with an entry of type 'end' and expires `ttl` seconds after that.
+    """
+    def __init__(self, redis_url: Optional[str] = None, ttl: Optional[int] = None, max_len: int = 10_000,
+                 flush_interval: float = 0.05):
+        redis_url = redis_url or os.getenv("REDIS_URL")
+        if not redis_url:
+            raise ValueError("REDIS_URL environment variable not set.")
+        self.redis = redis.Redis.from_url(redis_url)
+        self.ttl = ttl or int(os.getenv("TOKEN_STREAM_TTL_SECONDS", "3600"))
+        self.max_len = max_len
+        self.flush_interval = flush_interval
+        # task ID -> (start time, time to first token) of the tasks currently running in this process
+        self._tasks: Dict[str, List[Optional[float]]] = {}
+        self._lock = threading.Lock()
+
+    def begin(self, task_id: str, elapsed: float = 0.0) -> None:
+        """
+        Marks the start of a task, from which its time to first token is measured.
+        :param task_id: The ID of the task.
+        :param elapsed: Seconds the task already ran for before reaching this process, if it is run in stages.
+        """
+        with self._lock:
+            self._tasks[task_id] = [time.perf_counter() - elapsed, None]
+
+    def mark_first_token(self, task_id: str) -> bool:
+        """ Records the arrival of a token, returning whether it is the first token of the task. """
+        with self._lock:
+            timings = self._tasks.get(task_id)
+            if timings is None or timings[1] is not None:
+                return False
+            timings[1] = time.perf_counter() - timings[0]
+            return True
+
+    def time_to_first_token(self, task_id: str) -> Optional[float]:
+        """ Returns the time to first token of a running task in seconds, or None if it has not streamed a token. """
+        with self._lock:
+            timings = self._tasks.get(task_id)
+            return timings[1] if timings is not None else None
+
+    def sink(self, task_id: str, node: str) -> TokenSink:
+        """ Returns a sink relaying the tokens of an LLM call made by the given node of a task. """
+        return TokenSink(self, task_id, node)
+
+    def append(self, task_id: str, fields: Dict[str, str]) -> None:
+        try:
+            self.redis.xadd(token_stream_key(task_id), fields, maxlen=self.max_len, approximate=True)
+        except redis.RedisError as e:
+            print(f"Failed to stream the tokens of task {task_id}. Error: \n{e}")
+
+    def end(self, task_id: str, status: str) -> None:
+        """
+        Closes the stream of a task.
+        :param task_id: The ID of the task.
+        :param status:  The final status of the task.
+        :return:
+        """
+        self.release(task_id)
+        try:
+            pipe = self.redis.pipeline(transaction=False)
+            pipe.xadd(token_stream_key(task_id), {"type": "end", "status": status}, maxlen=self.max_len,
+                      approximate=True)
+            pipe.expire(token_stream_key(task_id), self.ttl)
+            pipe.execute()
+        except redis.RedisError as e:
+            print(f"Failed to close the token stream of task {task_id}. Error: \n{e}")
+
+    def release(self, task_id: str) -> None:
+        """ Forgets a task which carries on in another process, leaving its stream open for that process to end. """
+        with self._lock:
+            self._tasks.pop(task_id, None)
+
+    def close(self) -> None:
+        self.redis.close()
+
+class TokenStreamReader:
+    """ Used by the API to read the token stream of a task. """
+    def __init__(self, redis_url: Optional[str] = None):
+        redis_url = redis_url or os.getenv("REDIS_URL")
+        if not redis_url:
+            raise ValueError("REDIS_URL environment variable not set.")
+        self.redis = aioredis.Redis.from_url(redis_url, decode_responses=True)
+
+    async def read(self, task_id: str, last_id: str = "0", block_ms: int = 15_000) -> List[Tuple[str, Dict[str, str]]]:
+        """
+        Returns the entries of the task's stream after `last_id`, blocking up to `block_ms` if there are none yet.
+        :param task_id:     The ID of the task.
+        :param last_id:     ID of the last entry the client received, '0' to read from the start.
+        :param block_ms:    Milliseconds to block for when there are no new entries.
+        :return:            List of (entry ID, fields). Empty if nothing arrived within `block_ms`.
+        """
+        response = await self.redis.xread({token_stream_key(task_id): last_id}, block=block_ms)
+        return response[0][1] if response else []
+
+    async def exists(self, task_id: str) -> bool:
+        return bool(await self.redis.exists(token_stream_key(task_id)))
+
+    async def close(self) -> None:
+        await self.redis.aclose()
@@ -0,0 +1,63 @@
+"""
+Reports the LLM latency and spend of every graph node, per model, from the trajectories logged to MongoDB, to tune the
+model assigned to each node (see `core.model_registry` and $LLM_NODE_MODELS).
+
+For every (node, model) pair, the report gives the number of LLM steps, the p50 and p95 of their LLM latency, the mean
+prompt and completion tokens, and the total estimated cost. Only the steps logged within the last --days are read.
+
+Usage:
+    python -m scripts.node_usage_report --env-file secrets/dev.env --days 7
+"""
+import argparse
+from datetime import datetime, timedelta, timezone
+from dotenv import load_dotenv
+from core import MongoDBLogger
+from typing import *
+
+def node_usage(logger: MongoDBLogger, since: datetime) -> List[Dict[str, Any]]:
+    """ Aggregates the LLM steps logged since the given time by node and model, most expensive first. """
+    pipeline = [
+        {"$match": {"created_at": {"$gte": since}}},
+        {"$project": {"_id": 0, "trajectory": 1}},
+        {"$unwind": "$trajectory"},
+        {"$match": {"trajectory.llm_latency_ms": {"$exists": True}}},
+        {"$group": {
+            "_id": {"node": "$trajectory.node", "model": "$trajectory.model"},
+            "steps": {"$sum": 1},
+            "latency_ms": {"$percentile": {"input": "$trajectory.llm_latency_ms", "p": [0.5, 0.95],
+                                           "method": "approximate"}},
+            "prompt_tokens": {"$avg": "$trajectory.prompt_tokens"},
+            "completion_tokens": {"$avg": "$trajectory.completion_tokens"},
+            "cost_usd": {"$sum": "$trajectory.cost_usd"},
+        }},
+        {"$sort": {"cost_usd": -1}},
+    ]
+    return list(logger.collection.aggregate(pipeline))
+
+def report(rows: List[Dict[str, Any]]) -> None:
+    print(f"{'node':>24} {'model':>14} {'steps':>8} {'p50 ms':>9} {'p95 ms':>9} {'prompt':>8} {'compl.':>8} "
+          f"{'cost $':>10}")
+    for row in rows:
+        p50, p95 = row["latency_ms"]
+        print(f"{row['_id']['node']:>24} {row['_id'].get('model') or 'unknown':>14} {row['steps']:>8} {p50:>9.0f} "
+              f"{p95:>9.0f} {row['prompt_tokens'] or 0:>8.0f} {row['completion_tokens'] or 0:>8.0f} "
+              f"{row['cost_usd'] or 0:>10.4f}")
+    total = sum(row["cost_usd"] or 0 for row in rows)
+    print(f"Total estimated cost: ${total:.4f}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--env-file", default="secrets/dev.env", help="Environment file holding MONGO_URI.")
+    parser.add_argument("--days", type=float, default=7, help="Only read the tasks created within this many days.")
+    args = parser.parse_args()
+
+    load_dotenv(args.env_file)
+    logger = MongoDBLogger()
+    rows = node_usage(logger, datetime.now(timezone.utc) - timedelta(days=args.days))
+    logger.close()
+    if not rows:
+        raise SystemExit("No LLM steps were logged in that period.")
+    report(rows)
+
+if __name__ == '__main__':
+    main()
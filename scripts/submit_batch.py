@@ -0,0 +1,78 @@
+"""
+Submits every prompt of a JSONL file to the API's /v1/agent/execute_batch/ endpoint, streaming the file rather than
+reading it into memory, and optionally waits for the batch to finish.
+
+Each line of the file is a JSON object holding the prompt in the field given by --field. By default the first of
+'task', 'prompt' and 'body' that is present is used, so both the API's own `{"task": ...}` lines and the records of
+`requests.jsonl` are accepted.
+
+Usage:
+    python -m scripts.submit_batch requests.jsonl --api http://localhost:8000 --wait
+"""
+import argparse
+import json
+import sys
+import time
+import httpx
+from typing import *
+
+DEFAULT_FIELDS = ("task", "prompt", "body")
+
+def iter_prompts(path: str, field: Optional[str] = None) -> Iterator[str]:
+    """ Yields the prompt of every record of the file, skipping blank lines. """
+    with open(path, "r", encoding="utf-8") as f:
+        for line_number, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            fields = (field,) if field else DEFAULT_FIELDS
+            prompt = next((record[name] for name in fields if isinstance(record.get(name), str)), None)
+            if prompt is None:
+                raise SystemExit(f"Line {line_number} of {path} has none of the fields {', '.join(fields)}.")
+            yield prompt
+
+def read_prompts(path: str, field: Optional[str]) -> Iterator[bytes]:
+    """ Yields one `{"task": ...}` JSONL line per record of the file. """
+    for prompt in iter_prompts(path, field):
+        yield (json.dumps({"task": prompt}) + "\n").encode()
+
+def wait_for_batch(client: httpx.Client, batch_id: str, interval: float) -> Dict[str, Any]:
+    """ Polls the batch status until every task has finished, printing the counts whenever they change. """
+    last_counts = None
+    while True:
+        batch = client.get(f"/v1/agent/batch/{batch_id}").raise_for_status().json()
+        if batch["counts"] != last_counts:
+            last_counts = batch["counts"]
+            counts = ", ".join(f"{name}: {count}" for name, count in sorted(last_counts.items()))
+            print(f"{batch['finished']}/{batch['total']} finished ({counts})")
+        if batch["done"]:
+            return batch
+        time.sleep(interval)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("path", help="JSONL file of prompts.")
+    parser.add_argument("--api", default="http://localhost:8000", help="Base URL of the API.")
+    parser.add_argument("--field", default=None, help="Field of each record holding the prompt.")
+    parser.add_argument("--wait", action="store_true", help="Wait for every task of the batch to finish.")
+    parser.add_argument("--interval", type=float, default=2.0, help="Seconds between two batch status checks.")
+    parser.add_argument("--ids-output", default=None, help="File to write the task IDs to, one per line.")
+    args = parser.parse_args()
+
+    with httpx.Client(base_url=args.api, timeout=httpx.Timeout(60.0, connect=5.0)) as client:
+        response = client.post("/v1/agent/execute_batch/", content=read_prompts(args.path, args.field),
+                               headers={"Content-Type": "application/x-ndjson"})
+        if response.is_error:
+            raise SystemExit(f"The batch was rejected ({response.status_code}): {response.text}")
+        batch = response.json()
+        print(f"Batch {batch['batch_id']}: {len(batch['task_ids'])} tasks queued.")
+        if args.ids_output:
+            with open(args.ids_output, "w", encoding="utf-8") as f:
+                f.writelines(f"{task_id}\n" for task_id in batch["task_ids"])
+        if args.wait:
+            result = wait_for_batch(client, batch["batch_id"], args.interval)
+            failed = result["finished"] - result["counts"].get("Completed", 0)
+            sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
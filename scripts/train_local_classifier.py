@@ -0,0 +1,130 @@
+"""
+Retrains the local task classifier on the routing decisions the LLM logged to MongoDB, and reports how often the local
+classifier agrees with the LLM on a held-out split.
+
+Only the decisions made by the LLM are used as labels: tasks routed by the local classifier itself or to the default
+route (no LLM, or an unparsable output), tasks which failed, and tasks whose route was not decided for them (served
+from the response cache, or coalesced with a duplicate) are skipped, and a prompt asked several times is used once.
+The agreement of the keyword rules with the LLM is saved with the model as the confidence of their decisions.
+The report covers the keyword rules, the model, and the combined classifier at the configured confidence threshold,
+where 'coverage' is the share of prompts that would be answered locally (skipping the LLM call) and 'agreement' is how
+often those local answers match the LLM's.
+
+Usage:
+    python -m scripts.train_local_classifier --output models/task_classifier.npz --threshold 0.8
+"""
+import argparse
+import random
+from dotenv import load_dotenv
+from core import MongoDBLogger
+from core.agent_graph import AGENTS, NO_LLM_CHOICE_SUMMARY, UNPARSED_CHOICE_SUMMARY
+from core.local_classifier import LocalTaskClassifier, LOCAL_CHOICE_PREFIX, DEFAULT_THRESHOLD
+from typing import *
+
+def load_decisions(logger: MongoDBLogger, limit: int) -> List[Tuple[str, str]]:
+    """ Returns the (prompt, route) pairs decided by the LLM, one per distinct prompt, most recent first. """
+    cursor = logger.collection.find(
+        {
+            "task": {"$in": AGENTS},
+            "prompt": {"$type": "string"},
+            "status": "Completed",
+            "task_choice_summary": {
+                "$not": {"$regex": f"^{LOCAL_CHOICE_PREFIX}"},
+                "$nin": [NO_LLM_CHOICE_SUMMARY, UNPARSED_CHOICE_SUMMARY],
+            },
+            "cache_hit": {"$ne": True},
+            "coalesced_with": None,
+        },
+        {"prompt": 1, "task": 1, "_id": 0},
+    ).sort("_id", -1)
+    decisions: Dict[str, str] = {}
+    for doc in cursor:
+        decisions.setdefault(doc["prompt"].strip(), doc["task"])
+        if len(decisions) >= limit:
+            break
+    return list(decisions.items())
+
+def rule_agreement(classifier: LocalTaskClassifier, decisions: List[Tuple[str, str]]) -> Tuple[int, int]:
+    """ Returns how many of the decisions the keyword rules made, and how many of those match the LLM's. """
+    hits = agree = 0
+    for prompt, target in decisions:
+        label = classifier.match_rules(prompt)
+        if label is not None:
+            hits += 1
+            agree += label == target
+    return hits, agree
+
+def set_rule_confidence(classifier: LocalTaskClassifier, decisions: List[Tuple[str, str]], min_hits: int) -> None:
+    """ Sets the confidence of the keyword rules to their agreement with the LLM, if they decided often enough. """
+    hits, agree = rule_agreement(classifier, decisions)
+    if hits >= min_hits:
+        classifier.rule_confidence = agree / hits
+    print(f"Keyword rules confidence: {classifier.rule_confidence:.3f} "
+          f"({'measured on' if hits >= min_hits else 'default, too few rule decisions among'} {hits} decisions).")
+
+def report(classifier: LocalTaskClassifier, holdout: List[Tuple[str, str]]) -> None:
+    """ Prints the agreement of the rules, the model and the thresholded classifier with the LLM's decisions. """
+    rules_hits, rules_agree = rule_agreement(classifier, holdout)
+    model_agree = 0
+    local_hits = local_agree = 0
+    confusion = {llm: {local: 0 for local in AGENTS} for llm in AGENTS}
+    for prompt, target in holdout:
+        if classifier.has_model:
+            model_agree += classifier.labels[int(classifier.predict_proba([prompt])[0].argmax())] == target
+        decision = classifier.classify(prompt)
+        if decision is not None:
+            local_hits += 1
+            local_agree += decision["task"] == target
+            confusion[target][decision["task"]] += 1
+
+    n = len(holdout)
+    def ratio(a: int, b: int) -> str:
+        return f"{a / b:6.1%} ({a}/{b})" if b else "   n/a"
+    print(f"Held-out decisions: {n}")
+    print(f"  keyword rules   coverage {ratio(rules_hits, n)}   agreement {ratio(rules_agree, rules_hits)}")
+    if classifier.has_model:
+        print(f"  model (argmax)  coverage {ratio(n, n)}   agreement {ratio(model_agree, n)}")
+    print(f"  local @ {classifier.threshold:.2f}   coverage {ratio(local_hits, n)}   agreement {ratio(local_agree, local_hits)}")
+    print("Confusion of the local decisions (rows: LLM, columns: local):")
+    print(" " * 12 + "".join(f"{label:>11}" for label in AGENTS))
+    for llm_label, row in confusion.items():
+        print(f"{llm_label:>12}" + "".join(f"{row[label]:>11}" for label in AGENTS))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--env-file", default="secrets/dev.env", help="Environment file holding MONGO_URI.")
+    parser.add_argument("--output", default="models/task_classifier.npz", help="Where to save the model.")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help="Confidence threshold to report the local coverage and agreement at.")
+    parser.add_argument("--limit", type=int, default=50_000, help="Maximum number of logged decisions to use.")
+    parser.add_argument("--holdout", type=float, default=0.2, help="Share of the decisions held out for the report.")
+    parser.add_argument("--min-samples", type=int, default=50, help="Refuse to train on fewer decisions than this.")
+    parser.add_argument("--min-rule-samples", type=int, default=20,
+                        help="Rule decisions needed to measure the confidence of the keyword rules.")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    load_dotenv(args.env_file)
+    logger = MongoDBLogger()
+    decisions = load_decisions(logger, args.limit)
+    logger.close()
+    if len(decisions) < args.min_samples:
+        raise SystemExit(f"Only {len(decisions)} LLM decisions are logged, need at least {args.min_samples}.")
+
+    random.Random(args.seed).shuffle(decisions)
+    split = int(len(decisions) * (1 - args.holdout))
+    train, holdout = decisions[:split], decisions[split:]
+    print(f"Training on {len(train)} decisions.")
+    classifier = LocalTaskClassifier.train([p for p, _ in train], [t for _, t in train], AGENTS)
+    classifier.threshold = args.threshold
+    set_rule_confidence(classifier, train, args.min_rule_samples)
+    report(classifier, holdout)
+
+    # the shipped model is retrained on every decision, the held-out split only served the report
+    classifier = LocalTaskClassifier.train([p for p, _ in decisions], [t for _, t in decisions], AGENTS)
+    set_rule_confidence(classifier, decisions, args.min_rule_samples)
+    classifier.save(args.output)
+    print(f"Saved the model trained on all {len(decisions)} decisions to {args.output}.")
+
+if __name__ == '__main__':
+    main()
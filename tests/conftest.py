@@ -0,0 +1,17 @@
+import pytest
+import redis
+
+@pytest.fixture(autouse=True)
+def no_redis(monkeypatch):
+    """ Components read $REDIS_URL when they are not given one, the tests never use the developer's Redis. """
+    monkeypatch.delenv("REDIS_URL", raising=False)
+
+@pytest.fixture
+def redis_url(monkeypatch) -> str:
+    """ A Redis URL whose clients all share one in-process fakeredis server (with Lua, for the scripts). """
+    fakeredis = pytest.importorskip("fakeredis")
+    pytest.importorskip("lupa")
+    server = fakeredis.FakeServer()
+    monkeypatch.setattr(redis.Redis, "from_url",
+                        classmethod(lambda cls, url, **kwargs: fakeredis.FakeRedis(server=server, **kwargs)))
+    return "redis://fake:6379/0"
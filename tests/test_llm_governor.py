@@ -0,0 +1,153 @@
+import argparse
+import json
+import threading
+import time
+import urllib.request
+import pytest
+from core.llm_governor import LLMBudgetExhausted, LLMGovernor
+from core.metrics import MetricsRecorder
+from benchmarks import fake_openai_server
+
+openai = pytest.importorskip("openai")
+
+MODEL = "gpt-test"
+
+class RecordingMetrics(MetricsRecorder):
+    """ Keeps the samples and increments in memory. """
+    def __init__(self):
+        self.samples, self.increments = [], []
+        self._lock = threading.Lock()
+
+    def observe_many(self, samples):
+        with self._lock:
+            self.samples.extend(samples)
+
+    def inc_many(self, increments):
+        with self._lock:
+            self.increments.extend(increments)
+
+    def observed(self, name):
+        return [value for sample, value, _ in self.samples if sample == name]
+
+    def counted(self, name):
+        return [labels for counter, labels, _ in self.increments if counter == name]
+
+@pytest.fixture
+def server():
+    """ The fake OpenAI API with instant answers and no limits, which the tests configure through `server.fake.args`. """
+    parser = argparse.ArgumentParser()
+    fake_openai_server.add_arguments(parser)
+    server = fake_openai_server.serve(parser.parse_args(
+        ["--port", "0", "--latency", "0.01", "--tokens-per-second", "0", "--completion-tokens", "5"]))
+    yield server
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture
+def client(server):
+    # the governor retries, not the client
+    client = openai.OpenAI(base_url=f"http://127.0.0.1:{server.server_port}/v1", api_key="sk-test", max_retries=0)
+    yield client
+    client.close()
+
+@pytest.fixture
+def metrics():
+    return RecordingMetrics()
+
+def stats(server):
+    with urllib.request.urlopen(f"http://127.0.0.1:{server.server_port}/stats") as response:
+        return json.load(response)
+
+def complete(client, prompt="Hello"):
+    return client.chat.completions.create(model=MODEL, messages=[{"role": "user", "content": prompt}])
+
+def test_rate_limited_call_is_retried_after_retry_after(server, client, metrics):
+    server.fake.args.rpm, server.fake.args.window = 1, 1.0
+    governor = LLMGovernor(max_retries=2, metrics=metrics)
+    governor.call(MODEL, "Hello", lambda: complete(client))
+
+    start = time.perf_counter()
+    answer = governor.call(MODEL, "Hello", lambda: complete(client))
+
+    assert answer.choices[0].message.content
+    # the provider's Retry-After, rather than the much shorter backoff, was waited for
+    assert time.perf_counter() - start >= 0.5
+    assert stats(server) == {"200": 2, "429": 1}
+    assert metrics.counted("agent_llm_retries_total") == [{"model": MODEL, "reason": "rate_limited"}]
+    governor.close()
+
+def test_rate_limit_pauses_the_other_calls(server, client, metrics, redis_url):
+    server.fake.args.rpm, server.fake.args.window = 1, 1.0
+    # a budget far above the provider's limit, which only the cooldown after a 429 can hold calls back with
+    governor = LLMGovernor(redis_url, limits={MODEL: (1000, 0)}, max_retries=3, metrics=metrics)
+    governor.call(MODEL, "Hello", lambda: complete(client))
+    limited = threading.Thread(target=governor.call, args=(MODEL, "Hello", lambda: complete(client)))
+    limited.start()
+    deadline = time.monotonic() + 2
+    while not governor.redis.exists(f"llm_budget:{MODEL}:cooldown") and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    governor.call(MODEL, "Hello", lambda: complete(client))
+    limited.join()
+
+    # the last call waited for the cooldown rather than drawing a 429 of its own right away
+    assert max(metrics.observed("agent_llm_budget_wait_seconds")) >= 0.5
+    assert stats(server)["200"] == 3
+    governor.close()
+
+def test_call_waits_for_the_budget(server, client, metrics, redis_url):
+    # every call reserves about half of the tokens per minute: the second one waits for the 250 tokens it misses
+    prompt = "x" * 1000
+    governor = LLMGovernor(redis_url, limits={MODEL: (0, 60000)}, completion_tokens=30000, metrics=metrics)
+    governor.call(MODEL, prompt, lambda: complete(client, prompt))
+
+    start = time.perf_counter()
+    governor.call(MODEL, prompt, lambda: complete(client, prompt))
+
+    waits = metrics.observed("agent_llm_budget_wait_seconds")
+    assert waits[0] < 0.1 and waits[1] >= 0.4
+    assert time.perf_counter() - start >= 0.4
+    assert stats(server) == {"200": 2}
+    governor.close()
+
+def test_call_fails_when_the_budget_cannot_cover_it_in_time(server, client, metrics, redis_url):
+    governor = LLMGovernor(redis_url, limits={MODEL: (1, 0)}, max_wait=0.5, metrics=metrics)
+    governor.call(MODEL, "Hello", lambda: complete(client))
+
+    with pytest.raises(LLMBudgetExhausted):
+        governor.call(MODEL, "Hello", lambda: complete(client))
+    # the provider never saw the call
+    assert stats(server) == {"200": 1}
+    governor.close()
+
+def test_slow_call_is_hedged(server, client, metrics):
+    server.fake.args.slow_latency = 5.0
+    governor = LLMGovernor(hedge_percentile=90, hedge_min_delay=0.1, metrics=metrics)
+    for _ in range(20):
+        governor.call(MODEL, "Hello", lambda: complete(client))
+    assert governor.hedge_delay(MODEL) is not None
+
+    attempts = []
+    def invoke():
+        # the first attempt is answered after the slow latency, the duplicate right away
+        server.fake.args.slow_fraction = 0.0 if attempts else 1.0
+        attempts.append(time.perf_counter())
+        return complete(client)
+
+    start = time.perf_counter()
+    answer = governor.call(MODEL, "Hello", invoke)
+
+    assert answer.choices[0].message.content
+    assert time.perf_counter() - start < 2
+    assert len(attempts) == 2 and attempts[1] - attempts[0] >= 0.1
+    assert metrics.counted("agent_llm_hedges_total") == [{"model": MODEL, "winner": "hedge"}]
+    governor.close()
+
+def test_fast_call_is_not_hedged(server, client, metrics):
+    governor = LLMGovernor(hedge_percentile=90, hedge_min_delay=0.5, metrics=metrics)
+    for _ in range(25):
+        governor.call(MODEL, "Hello", lambda: complete(client))
+
+    assert stats(server) == {"200": 25}
+    assert metrics.counted("agent_llm_hedges_total") == []
+    governor.close()
@@ -0,0 +1,157 @@
+import asyncio
+import hashlib
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+from core.page_fetcher import PageCache, PageFetcher
+
+class StandIn(ThreadingHTTPServer):
+    """ A local HTTP stand-in recording the requests it answered and how many were in flight at once. """
+    daemon_threads = True
+    request_queue_size = 64
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), Handler)
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.requests = 0
+        self.not_modified = 0
+        self.delay = 0.0
+        self.body = "unchanged"
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_port}"
+
+class Handler(BaseHTTPRequestHandler):
+    server: StandIn
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests += 1
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+        try:
+            time.sleep(10 if self.path.startswith("/hang") else server.delay)
+            body = (f"<html><body><nav>Menu</nav><article><p>{self.path} is {server.body}.</p></article>"
+                    f"<script>track()</script></body></html>").encode()
+            etag = '"' + hashlib.sha256(body).hexdigest()[:16] + '"'
+            if self.headers.get("If-None-Match") == etag:
+                with server.lock:
+                    server.not_modified += 1
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.send_header("ETag", etag)
+            self.end_headers()
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            # the fetcher gave up on the page
+            pass
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+
+@pytest.fixture
+def stand_in():
+    server = StandIn()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture
+def make_fetcher(tmp_path):
+    fetchers = []
+
+    def make(**kwargs) -> PageFetcher:
+        kwargs.setdefault("cache", None)
+        fetcher = PageFetcher(**kwargs)
+        fetchers.append(fetcher)
+        return fetcher
+    yield make
+    for fetcher in fetchers:
+        fetcher.close()
+
+def test_extracts_the_main_text(stand_in, make_fetcher):
+    fetcher = make_fetcher()
+    assert fetcher.fetch_many([f"{stand_in.url}/a"]) == {f"{stand_in.url}/a": "/a is unchanged."}
+
+def test_requests_to_a_host_are_limited(stand_in, make_fetcher):
+    stand_in.delay = 0.2
+    fetcher = make_fetcher(max_per_host=2)
+    urls = [f"{stand_in.url}/page/{i}" for i in range(6)]
+
+    start = time.perf_counter()
+    pages = fetcher.fetch_many(urls)
+    elapsed = time.perf_counter() - start
+
+    assert list(pages) == urls
+    assert stand_in.max_in_flight == 2
+    # three rounds of two pages
+    assert 0.55 < elapsed < 2.0
+    # the semaphores of the host are dropped once it is idle
+    assert fetcher._host_semaphores == {} and fetcher._host_requests == {}
+
+def test_a_page_over_the_timeout_is_left_out(stand_in, make_fetcher):
+    fetcher = make_fetcher(timeout=0.5)
+    urls = [f"{stand_in.url}/a", f"{stand_in.url}/hang", f"{stand_in.url}/b"]
+
+    start = time.perf_counter()
+    pages = fetcher.fetch_many(urls)
+
+    assert time.perf_counter() - start < 2.0
+    assert list(pages) == [f"{stand_in.url}/a", f"{stand_in.url}/b"]
+
+def test_the_wait_for_a_busy_host_counts_against_the_timeout(stand_in, make_fetcher):
+    # the only slot of the host is held by a page which never answers in time
+    fetcher = make_fetcher(timeout=0.5, max_per_host=1)
+
+    start = time.perf_counter()
+    pages = fetcher.fetch_many([f"{stand_in.url}/hang", f"{stand_in.url}/a"])
+
+    assert time.perf_counter() - start < 2.0
+    assert pages == {}
+
+def test_a_stale_page_is_revalidated_with_its_etag(stand_in, make_fetcher, tmp_path):
+    cache = PageCache(str(tmp_path), fresh_for=3600)
+    fetcher = make_fetcher(cache=cache)
+    url = f"{stand_in.url}/a"
+    assert fetcher.fetch_many([url]) == {url: "/a is unchanged."}
+    assert stand_in.requests == 1
+
+    # a fresh entry is used without a request
+    assert fetcher.fetch_many([url]) == {url: "/a is unchanged."}
+    assert stand_in.requests == 1
+
+    # a stale one costs a 304
+    cache.fresh_for = 0
+    assert fetcher.fetch_many([url]) == {url: "/a is unchanged."}
+    assert (stand_in.requests, stand_in.not_modified) == (2, 1)
+
+    # and a changed page is downloaded again
+    stand_in.body = "changed"
+    assert fetcher.fetch_many([url]) == {url: "/a is changed."}
+    assert (stand_in.requests, stand_in.not_modified) == (3, 1)
+
+def test_a_stale_page_is_kept_when_its_host_fails(stand_in, make_fetcher, tmp_path):
+    cache = PageCache(str(tmp_path), fresh_for=0)
+    url = f"{stand_in.url}/hang"
+    cache.set(url, "the previous text", '"etag"')
+    fetcher = make_fetcher(cache=cache, timeout=0.5)
+    assert fetcher.fetch_many([url]) == {url: "the previous text"}
+
+def test_afetch_many_from_another_loop(stand_in, make_fetcher):
+    fetcher = make_fetcher()
+    urls = [f"{stand_in.url}/a", f"{stand_in.url}/b"]
+    assert asyncio.run(fetcher.afetch_many(urls)) == {url: f"{url[len(stand_in.url):]} is unchanged." for url in urls}
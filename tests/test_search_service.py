@@ -0,0 +1,68 @@
+import pytest
+from core.response_cache import ResponseCache
+from core.search_service import SearchService, StubSearchBackend, load_search_service
+
+class FailingBackend:
+    name = "failing"
+
+    def results(self, query, num_results):
+        raise RuntimeError("the search API is down")
+
+@pytest.fixture
+def backend():
+    return StubSearchBackend(corpus_size=6)
+
+@pytest.fixture
+def service(backend):
+    service = SearchService(backend, num_results=4, cache=ResponseCache(ttl=60))
+    yield service
+    service.close()
+
+def test_stub_backend_is_deterministic(backend):
+    assert backend.results("python asyncio", 4) == backend.results("python asyncio", 4)
+    assert len(backend.results("python asyncio", 4)) == 4
+
+def test_search_many_keeps_the_first_occurrence_of_each_link(backend, service):
+    queries = ["python asyncio", "asyncio tutorial", "event loops in python"]
+    merged = service.search_many(queries)
+
+    links = [result["link"] for result in merged]
+    assert len(links) == len(set(links))
+    # by query, then by rank, as the first query to return a link found it
+    expected = []
+    for query in queries:
+        expected += [r["link"] for r in backend.results(query, 4) if r["link"] not in expected]
+    assert links == expected
+    # a corpus of 6 links cannot fill three queries of 4 results without duplicates
+    assert len(links) < 12
+
+def test_repeated_query_is_served_from_the_cache(backend, service):
+    first = service.search("python asyncio")
+    assert service.search("python asyncio") == first
+    # the cache key is the normalized query
+    assert service.search("  Python   ASYNCIO ") == first
+    assert backend.calls == 1
+
+    service.search_many(["python asyncio", "asyncio tutorial"])
+    assert backend.calls == 2
+
+def test_without_cache_every_search_reaches_the_backend(backend):
+    service = SearchService(backend, cache=None)
+    service.search("python asyncio")
+    service.search("python asyncio")
+    service.close()
+    assert backend.calls == 2
+
+def test_search_many_returns_none_only_when_every_search_failed():
+    service = SearchService(FailingBackend(), cache=None)
+    assert service.search_many(["a", "b"]) is None
+    assert service.search_many([]) == []
+    service.close()
+
+def test_load_search_service_with_the_stub_backend(monkeypatch):
+    monkeypatch.setenv("SEARCH_BACKEND", "stub")
+    monkeypatch.setenv("SEARCH_CACHE_TTL_SECONDS", "0")
+    service = load_search_service()
+    assert isinstance(service.backend, StubSearchBackend)
+    assert service.cache is None
+    service.close()
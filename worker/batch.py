@@ -0,0 +1,37 @@
+import os
+import uuid
+from itertools import islice
+from celery import group
+from core import MongoDBLogger
+from worker.client import execute_signature
+from typing import *
+
+# number of tasks inserted with one `insert_many` and enqueued with one Celery group
+BATCH_CHUNK_SIZE: int = int(os.getenv("BATCH_CHUNK_SIZE", "500"))
+
+def submit_batch(logger: MongoDBLogger, prompts: Iterable[str],
+                 chunk_size: Optional[int] = None) -> Tuple[str, List[str]]:
+    """
+    Enqueues many prompts at once. Each chunk of prompts costs one `insert_many` of the task documents and one Celery
+    group, which publishes all of its messages over a single broker connection, instead of an insert and a round trip
+    to the broker per prompt.
+    :param logger:      Logger whose collection the task documents are inserted into.
+    :param prompts:     The prompts, consumed lazily so that a large batch never needs to be held in memory twice.
+    :param chunk_size:  Number of tasks per chunk. Defaults to BATCH_CHUNK_SIZE.
+    :return:            The batch ID and the task IDs, in the order of the prompts.
+    """
+    chunk_size = chunk_size or BATCH_CHUNK_SIZE
+    batch_id = str(uuid.uuid4())
+    task_ids: List[str] = []
+    prompts = iter(prompts)
+    while chunk := list(islice(prompts, chunk_size)):
+        tasks = [(str(uuid.uuid4()), prompt_content) for prompt_content in chunk]
+        # insert the documents before enqueueing, so that a worker never starts a task which has no document yet
+        logger.log_tasks_queued(tasks, batch_id)
+        group(
+            # let the Celery task IDs match the task IDs we pass to the LangGraph app, as in `/v1/agent/execute/`
+            execute_signature(task_id, prompt_content, pre_logged=True)
+            for task_id, prompt_content in tasks
+        ).apply_async()
+        task_ids.extend(task_id for task_id, _ in tasks)
+    return batch_id, task_ids
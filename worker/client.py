@@ -0,0 +1,91 @@
+"""
+The Celery application as seen by the producers of tasks (the API, the batch submission). Tasks are enqueued by name,
+so importing this module only costs Celery itself: the worker's runtime, the graph and its LLM and search clients are
+never imported by a process which only enqueues.
+"""
+import os
+from celery import Celery
+from celery.canvas import Signature
+from dotenv import load_dotenv
+from typing import *
+
+# name of `worker.tasks.execute_agent_framework`
+EXECUTE_AGENT_FRAMEWORK = "execute_agent_framework"
+# name of `worker.tasks.execute_route`
+EXECUTE_ROUTE = "execute_route"
+
+# NOTE: Toggle to True to split every task by route: `execute_agent_framework` then only classifies the prompt, on the
+# CLASSIFY_QUEUE, and hands the task on to the queue of its route (see `route_signature`), so that each route is served
+# by workers of its own concurrency and a slow content generation never holds up the quick answers.
+WORKER_ROUTE_QUEUES: bool = os.getenv("WORKER_ROUTE_QUEUES", "").lower() in ("1", "true")
+CLASSIFY_QUEUE = "classify"
+# the stages run after the classification, each on the queue of the same name: one per route of
+# `core.agent_graph.AGENTS`, except for the content route whose search ('content') and generation ('content_generation')
+# are separate stages, the search only waiting on the search backend and the pages
+ROUTE_STAGES: Tuple[str, ...] = ("general", "code", "summarize", "content", "content_generation")
+# priority of the tasks of every queue, 0 being the highest (the Redis transport's order). A worker consuming several
+# queues takes the tasks of the highest priority first. The classification is short and holds up everything else.
+DEFAULT_QUEUE_PRIORITIES: Dict[str, int] = {CLASSIFY_QUEUE: 0, "general": 0, "code": 3, "summarize": 3, "content": 6,
+                                            "content_generation": 3}
+
+def parse_queue_priorities(spec: str) -> Dict[str, int]:
+    """ Parses a 'queue=priority,...' override of `DEFAULT_QUEUE_PRIORITIES`, e.g. 'content=9,summarize=6'. """
+    priorities = dict(DEFAULT_QUEUE_PRIORITIES)
+    for item in spec.split(","):
+        if not item.strip():
+            continue
+        queue, sep, priority = item.partition("=")
+        if not sep or queue.strip() not in priorities or not priority.strip().isdigit() or int(priority) > 9:
+            raise ValueError(f"Invalid queue priority '{item}', expected 'queue=priority' with a queue among "
+                             f"{', '.join(priorities)} and a priority from 0 to 9.")
+        priorities[queue.strip()] = int(priority)
+    return priorities
+
+QUEUE_PRIORITIES: Dict[str, int] = parse_queue_priorities(os.getenv("WORKER_QUEUE_PRIORITIES", ""))
+
+# load in the environment variables
+load_dotenv("secrets/dev.env")
+
+# check that the Redis URL has been specified
+redis_url = os.getenv("REDIS_URL")
+if not redis_url:
+    raise ValueError("REDIS_URL not set in the environment.")
+
+# configure the Celery App, shared by the workers (see `worker.tasks`)
+celery_app = Celery(
+    'agent_tasks',
+    broker=redis_url,
+    backend=redis_url,
+)
+if WORKER_ROUTE_QUEUES:
+    celery_app.conf.task_routes = {EXECUTE_AGENT_FRAMEWORK: {"queue": CLASSIFY_QUEUE}}
+    # the Redis transport keeps one list per priority step of every queue, and a worker prefetching a single task at a
+    # time takes the next one by priority rather than by arrival in its prefetch buffer
+    celery_app.conf.broker_transport_options = {"priority_steps": [0, 3, 6, 9]}
+    celery_app.conf.worker_prefetch_multiplier = 1
+
+def execute_signature(task_id: str, prompt_content: str, **kwargs: Any) -> Signature:
+    """
+    The signature of an `execute_agent_framework` task, whose Celery task ID is the task ID passed to the LangGraph app.
+    :param task_id:         The ID of the task.
+    :param prompt_content:  The user's prompt.
+    :param kwargs:          The other arguments of `worker.tasks.execute_agent_framework`.
+    :return:                The signature, to `apply_async` or to group with others.
+    """
+    if WORKER_ROUTE_QUEUES:
+        return celery_app.signature(EXECUTE_AGENT_FRAMEWORK, args=(task_id, prompt_content), kwargs=kwargs,
+                                    task_id=task_id, queue=CLASSIFY_QUEUE, priority=QUEUE_PRIORITIES[CLASSIFY_QUEUE])
+    return celery_app.signature(EXECUTE_AGENT_FRAMEWORK, args=(task_id, prompt_content), kwargs=kwargs,
+                                task_id=task_id)
+
+def route_signature(task_id: str, stage: str, **kwargs: Any) -> Signature:
+    """
+    The signature of an `execute_route` task, which resumes the graph of a classified task on the queue of a stage.
+    Its Celery task ID is derived from the task ID, which remains the ID of the task as a whole.
+    :param task_id:     The ID of the task.
+    :param stage:       The stage to run, one of `ROUTE_STAGES`.
+    :param kwargs:      The other arguments of `worker.tasks.execute_route`.
+    :return:            The signature, to `apply_async`.
+    """
+    return celery_app.signature(EXECUTE_ROUTE, args=(task_id, stage), kwargs=kwargs, task_id=f"{task_id}:{stage}",
+                                queue=stage, priority=QUEUE_PRIORITIES[stage])
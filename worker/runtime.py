@@ -0,0 +1,308 @@
+import asyncio
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from langgraph.checkpoint.base import BaseCheckpointSaver
+from langgraph.graph.state import CompiledStateGraph
+from core import build_graph, MongoDBLogger
+from core.metrics import MetricsRecorder
+from core.task_events import TaskEventPublisher
+from core.status_cache import TaskStatusCache
+from core.token_stream import TokenStreamPublisher
+from core.local_classifier import load_local_classifier
+from core.agent_graph import AGENTS
+from core.checkpointer import MongoCheckpointSaver
+from core.response_cache import load_response_cache, cache_key
+from core.search_service import load_search_service
+from core.page_fetcher import load_page_fetcher
+from core.speculation import load_speculative_router
+from core.model_registry import ModelRegistry, load_model_registry
+from core.llm_governor import load_llm_governor
+from core.summarizer import load_summarizer
+from core.document_index import load_document_index
+from core.request_coalescer import RequestCoalescer
+from core.admission import AdmissionController
+from typing import *
+
+# model of the nodes which are not assigned a smaller one, unless $LLM_MODEL overrides it (see `core.model_registry`)
+GPT_MODEL = "gpt-4.1"
+# 'sync' runs every graph with `invoke` on the thread of its Celery task, 'async' runs them with `ainvoke` on an event
+# loop shared by every task of the worker process (see `WorkerRuntime.run_graph`)
+WORKER_EXECUTION: str = os.getenv("WORKER_EXECUTION", "sync").lower()
+# maximum number of graphs in flight on the event loop of a worker process in the 'async' execution mode
+WORKER_ASYNC_CONCURRENCY: int = int(os.getenv("WORKER_ASYNC_CONCURRENCY", "32"))
+# whether the tasks are classified and answered by different workers (see `worker.client.WORKER_ROUTE_QUEUES`, which
+# this module does not import since the producers' Celery app needs the broker's URL)
+WORKER_ROUTE_QUEUES: bool = os.getenv("WORKER_ROUTE_QUEUES", "").lower() in ("1", "true")
+# node which ends the graph on each route whose answering node is not named after it
+_FINAL_NODES: Dict[str, str] = {"content": "content_post_web_search"}
+
+class WorkerRuntime:
+    """
+    Holds the objects that are expensive to construct (the MongoDB client and its connection pool, the LLM client and
+    the compiled graph) so that a worker process builds them once and reuses them across every task it executes.
+    """
+    def __init__(self, use_llm: bool, stream_tokens: bool = False, execution: Optional[str] = None,
+                 concurrency: Optional[int] = None):
+        """
+        :param use_llm:         Whether to construct an LLM client.
+        :param stream_tokens:   Whether to stream the tokens of the responses through Redis Streams.
+        :param execution:       'sync' or 'async'. Defaults to $WORKER_EXECUTION.
+        :param concurrency:     Graphs in flight at once in the 'async' mode. Defaults to $WORKER_ASYNC_CONCURRENCY.
+        """
+        self.pid = os.getpid()
+        self.execution = execution or WORKER_EXECUTION
+        if self.execution not in ("sync", "async"):
+            raise ValueError(f"Unknown worker execution mode '{self.execution}', expected 'sync' or 'async'.")
+        self.concurrency = concurrency or WORKER_ASYNC_CONCURRENCY
+        # the task events wake up the API clients waiting on a task (see the /v1/agent/events/ endpoint)
+        self.publisher = TaskEventPublisher() if os.getenv("REDIS_URL") else None
+        # the status records in Redis answer the API's status checks without a round trip to MongoDB
+        self.status_cache = TaskStatusCache() if os.getenv("REDIS_URL") else None
+        self.logger = MongoDBLogger(publisher=self.publisher, status_cache=self.status_cache)
+        # hands the result of a task on to the duplicates of its prompt which the API coalesced with it
+        self.coalescer = RequestCoalescer() if os.getenv("REDIS_URL") else None
+        # frees the in-flight slot the API's admission control gave a task once it finished
+        self.admission = AdmissionController() if os.getenv("REDIS_URL") else None
+
+        # per-node and per-task histograms are aggregated in Redis and exported by the API's /metrics endpoint
+        self.metrics = MetricsRecorder() if os.getenv("REDIS_URL") else None
+
+        if use_llm:
+            # one client per model, all of them sharing the same pooled HTTP connections and, if enabled, the cluster's
+            # rate limit budget of their model
+            self.models: Optional[ModelRegistry] = load_model_registry(GPT_MODEL, load_llm_governor(self.metrics))
+            self.llm = self.models.llm()
+            print(f"We are using the ChatGPT model {self.models.model}.")
+        else:
+            self.models = None
+            self.llm = None
+            print("We are running the worker without actually invoking any LLM's (preferred option when debugging the "
+                  "LangGraph script without wasting token use).")
+
+        # relays the tokens of the user-facing responses to the API's /v1/agent/stream/ endpoint as they are generated
+        self.token_stream = TokenStreamPublisher() if stream_tokens else None
+
+        # caches whole task results as well as the individual LLM calls of the nodes, if enabled
+        self.response_cache = load_response_cache(self.metrics)
+
+        # routes confidently classifiable prompts without a round trip to the LLM, if enabled
+        self.classifier = load_local_classifier(AGENTS)
+        # starts the answer of the predicted route while the LLM router classifies the prompt, if enabled. With the
+        # route queues, the answer is generated by another worker than the classification, which could never commit it.
+        self.speculation = load_speculative_router(self.classifier, AGENTS, self.response_cache, self.metrics) \
+            if not WORKER_ROUTE_QUEUES else None
+
+        # one search client, result cache and fan-out pool shared by every task of the content route
+        self.search = load_search_service(self.metrics)
+        # fetches the pages of the search results for the content generation agent, if enabled
+        self.page_fetcher = load_page_fetcher()
+        # condenses the long inputs of the summarizing agent, with a pool and a chunk cache shared by every task
+        self.summarizer = load_summarizer(self.metrics)
+        # the index of the documents ingested by the API, whose passages relevant to the prompt every agent is given,
+        # if enabled
+        self.document_index = load_document_index()
+
+        # The compiled graph is stateless between invocations; the only per-task state lives in the checkpointer and
+        # is keyed by the thread ID, so concurrent tasks with distinct thread IDs can safely share the same graph.
+        # The checkpoints are persisted to MongoDB (through the logger's connection pool) so that a follow-up prompt
+        # on the same thread resumes from the previous state, whichever worker process runs it.
+        self.checkpointer: BaseCheckpointSaver = MongoCheckpointSaver(self.logger.db)
+        # 'exit' persists a single checkpoint per task instead of one per graph step
+        self.durability = os.getenv("CHECKPOINT_DURABILITY", "exit")
+        self.app: CompiledStateGraph = build_graph(self.logger, self.llm, checkpointer=self.checkpointer,
+                                                   metrics=self.metrics, token_stream=self.token_stream,
+                                                   classifier=self.classifier, response_cache=self.response_cache,
+                                                   search=self.search, page_fetcher=self.page_fetcher,
+                                                   speculation=self.speculation, models=self.models,
+                                                   summarizer=self.summarizer, retriever=self.document_index,
+                                                   use_async=self.execution == "async")
+
+        # In the 'async' mode, the graphs of every task of this process run on one event loop, which keeps many of
+        # them waiting on the LLM at once. The loop's default executor runs the blocking calls of the nodes (MongoDB,
+        # the search backends), so it is sized to the concurrency rather than to the number of cores.
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+        if self.execution == "async":
+            self.loop = asyncio.new_event_loop()
+            self.loop.set_default_executor(ThreadPoolExecutor(max_workers=self.concurrency,
+                                                              thread_name_prefix="graph-io"))
+            self._slots = asyncio.Semaphore(self.concurrency)
+            threading.Thread(target=self.loop.run_forever, name="graph-loop", daemon=True).start()
+
+    @property
+    def model_name(self) -> Optional[str]:
+        return getattr(self.llm, "model_name", None)
+
+    def _task_key(self, prompt_content: str) -> str:
+        # the route is not known before the task runs, so the key has no route; with a document index, a result is only
+        # reused until the indexed documents change
+        scope = None if self.document_index is None else f"documents-{self.document_index.revision}"
+        return cache_key("task", prompt_content, scope, self.model_name)
+
+    def cached_result(self, prompt_content: str) -> Optional[Dict[str, Any]]:
+        """
+        Looks up the final state of a previous task with the same (normalized) prompt, run with the same model (and
+        the same revision of the document index, if there is one).
+        :param prompt_content:  The user's prompt.
+        :return:                The cached final state, or None on a miss or if caching is disabled.
+        """
+        if self.response_cache is None:
+            return None
+        return self.response_cache.get(self._task_key(prompt_content))
+
+    def cache_result(self, prompt_content: str, result: Dict[str, Any]) -> None:
+        """ Caches the final state of a successful task for `cached_result`. """
+        if self.response_cache is None:
+            return
+        self.response_cache.set(self._task_key(prompt_content), {
+            "response": getattr(result['response'], 'content', result['response']),
+            "task_classification": result['task_classification'],
+            "search_query": result.get('search_query'),
+            "search_results": result.get('search_results') or [],
+        })
+
+    def record_turn(self, thread_id: str, task_id: str, prompt_content: str, result: Dict[str, Any]) -> None:
+        """
+        Writes the answer of a task whose graph did not run on its thread (it was served from the response cache, or
+        by the task it was coalesced with) into the thread's checkpoint, as if the route's last node had answered it,
+        so that a follow-up prompt on the thread is given the turn. A failure only loses the turn, not the task.
+        :param thread_id:       The new thread of the task.
+        :param task_id:         The ID of the task.
+        :param prompt_content:  The user's prompt.
+        :param result:          The final state the task was answered with.
+        """
+        response = getattr(result['response'], 'content', result['response'])
+        route = result['task_classification']['task']
+        try:
+            self.app.update_state({"configurable": {"thread_id": thread_id}}, {
+                "prompt_content": prompt_content,
+                "task_id": task_id,
+                "documents": [],
+                "task_classification": result['task_classification'],
+                "search_query": result.get('search_query'),
+                "search_results": result.get('search_results'),
+                "response": response,
+                "conversation": [{"prompt": prompt_content, "response": response}],
+            }, as_node=_FINAL_NODES.get(route, route))
+        except Exception as e:
+            print(f"Failed to record the answer of task {task_id} on its thread {thread_id}. Error: \n{e}")
+
+    def run_graph(self, state: Optional[Dict[str, Any]], config: Dict[str, Any], **kwargs: Any) -> Dict[str, Any]:
+        """
+        Runs the graph to completion from the calling thread. In the 'async' mode, the graph runs on the runtime's
+        event loop and the calling thread (a Celery pool thread) only waits for it, so a worker started with
+        `--pool threads --concurrency N` keeps up to N graphs in flight on a single loop.
+        :param state:   The initial state, or None to resume the thread's graph from where it was interrupted.
+        :param config:  The run config, holding the thread ID.
+        :param kwargs:  Where to interrupt the graph (`interrupt_before`, `interrupt_after`), if it is run in stages.
+        :return:        The final state, or the state at the interrupt.
+        """
+        if self.loop is None:
+            return self.app.invoke(state, config, durability=self.durability, **kwargs)
+        return asyncio.run_coroutine_threadsafe(self.arun_graph(state, config, **kwargs), self.loop).result()
+
+    async def arun_graph(self, state: Optional[Dict[str, Any]], config: Dict[str, Any],
+                         **kwargs: Any) -> Dict[str, Any]:
+        """ Runs the asynchronous graph once one of the runtime's concurrency slots frees up. """
+        async with self._slots:
+            return await self.app.ainvoke(state, config, durability=self.durability, **kwargs)
+
+    def release_thread(self, thread_id: str) -> None:
+        """
+        Bounds the checkpoints a thread keeps once a task on it finished. The persistent checkpointer keeps the
+        thread's most recent checkpoints for its next prompt, any other checkpointer drops the thread altogether
+        so that the worker's memory does not grow with every task it runs.
+        :param thread_id:   The thread ID the graph was invoked with.
+        :return:
+        """
+        if isinstance(self.checkpointer, MongoCheckpointSaver):
+            self.checkpointer.compact(thread_id)
+        else:
+            self.checkpointer.delete_thread(thread_id)
+
+    def close(self) -> None:
+        """ Releases the connections held by this runtime. """
+        self.logger.close()
+        if self.publisher is not None:
+            self.publisher.close()
+        if self.status_cache is not None:
+            self.status_cache.close()
+        if self.coalescer is not None:
+            self.coalescer.close()
+        if self.admission is not None:
+            self.admission.close()
+        if self.token_stream is not None:
+            self.token_stream.close()
+        if self.response_cache is not None:
+            self.response_cache.close()
+        self.search.close()
+        if self.search.cache is not None:
+            self.search.cache.close()
+        if self.page_fetcher is not None:
+            self.page_fetcher.close()
+        if self.speculation is not None:
+            self.speculation.close()
+        self.summarizer.close()
+        if self.models is not None:
+            # the asynchronous HTTP client's connections belong to the loop the graphs ran on
+            self.models.close(self.loop)
+        if self.loop is not None:
+            loop, self.loop = self.loop, None
+            loop.call_soon_threadsafe(loop.stop)
+
+_runtime: Optional[WorkerRuntime] = None
+_runtime_lock = threading.Lock()
+
+def _reset_lock_after_fork() -> None:
+    """ A forked child may inherit the lock in a held state from whichever parent thread owned it at fork time. """
+    global _runtime_lock
+    _runtime_lock = threading.Lock()
+
+os.register_at_fork(after_in_child=_reset_lock_after_fork)
+
+def _build_runtime(use_llm: bool, stream_tokens: bool) -> WorkerRuntime:
+    """ Builds a new runtime for the current process. Must be called while holding `_runtime_lock`. """
+    global _runtime
+    if _runtime is not None and _runtime.pid == os.getpid():
+        _runtime.close()
+    # NOTE: a MongoClient is not fork-safe. We deliberately do not close a runtime inherited from the parent process
+    #   (that would tear down the parent's sockets), we simply drop our reference to it and reconnect.
+    _runtime = WorkerRuntime(use_llm, stream_tokens)
+    return _runtime
+
+def init_runtime(use_llm: bool, stream_tokens: bool = False) -> WorkerRuntime:
+    """
+    Builds the runtime for the current process, replacing any runtime that was inherited from a parent process.
+    This is meant to be called from Celery's `worker_process_init` signal, i.e. right after the pool forks a child.
+    :param use_llm:         Whether the runtime should construct an LLM client.
+    :param stream_tokens:   Whether the runtime should stream the tokens of the responses through Redis Streams.
+    :return:                The runtime of the current process.
+    """
+    with _runtime_lock:
+        return _build_runtime(use_llm, stream_tokens)
+
+def get_runtime(use_llm: bool, stream_tokens: bool = False) -> WorkerRuntime:
+    """
+    Returns the runtime of the current process, lazily building it if `init_runtime` has not been called (e.g. when
+    running with the 'solo' or 'threads' pools which never fire `worker_process_init`) or if the runtime was built
+    before this process was forked.
+    :param use_llm:         Whether the runtime should construct an LLM client.
+    :param stream_tokens:   Whether the runtime should stream the tokens of the responses through Redis Streams.
+    :return:                The runtime of the current process.
+    """
+    runtime = _runtime
+    if runtime is not None and runtime.pid == os.getpid():
+        return runtime
+    with _runtime_lock:
+        if _runtime is not None and _runtime.pid == os.getpid():
+            return _runtime
+        return _build_runtime(use_llm, stream_tokens)
+
+def shutdown_runtime() -> None:
+    """ Closes the runtime of the current process, if one was built. """
+    global _runtime
+    with _runtime_lock:
+        if _runtime is not None and _runtime.pid == os.getpid():
+            _runtime.close()
+        _runtime = None
@@ -1,68 +1,232 @@
 import os
-from celery import Celery
-from dotenv import load_dotenv
-from core import build_graph, MongoDBLogger
-from langchain_openai import ChatOpenAI
+import time
+from celery.signals import worker_process_init, worker_process_shutdown
+from worker.client import celery_app, route_signature, EXECUTE_AGENT_FRAMEWORK, EXECUTE_ROUTE, WORKER_ROUTE_QUEUES
+from worker.runtime import WorkerRuntime, get_runtime, init_runtime, shutdown_runtime
+from typing import *
 
 # NOTE: Toggle to True when willing to use the OpenAI API. Preferably set to False when debugging the system to prevent
 # execution from wasting tokens. This can be toggled in the `[dev/prod].env` file so that we do not need to manually
 # change this file.
 USE_LLM = os.getenv("USE_LLM")
+# NOTE: Toggle to True to stream the tokens of the responses to the API's /v1/agent/stream/ endpoint as they are
+# generated, rather than only returning the whole response once the task finishes.
+STREAM_TOKENS = os.getenv("STREAM_TOKENS", "").lower() in ("1", "true")
 
-# load in the environment variables
-load_dotenv("secrets/dev.env")
-
-# check that the Redis URL has been specified
-redis_url = os.getenv("REDIS_URL")
-if not redis_url:
-    raise ValueError("REDIS_URL not set in the environment.")
+@worker_process_init.connect
+def _init_worker_process(**kwargs) -> None:
+    """
+    Builds the logger, LLM client and compiled graph once per worker process. This fires in the child after the
+    prefork pool forks it, so every child opens its own MongoDB connection pool rather than sharing the parent's.
+    """
+    init_runtime(bool(USE_LLM), STREAM_TOKENS)
 
-# configure the Celery App
-celery_app = Celery(
-    'agent_tasks',
-    broker=redis_url,
-    backend=redis_url,
-)
+@worker_process_shutdown.connect
+def _shutdown_worker_process(**kwargs) -> None:
+    """ Closes the connections held by the worker process's runtime. """
+    shutdown_runtime()
 
-@celery_app.task(name='execute_agent_framework')
-def execute_agent_framework(task_id: str, prompt_content: str) -> str:
+@celery_app.task(name=EXECUTE_AGENT_FRAMEWORK)
+def execute_agent_framework(task_id: str, prompt_content: str, pre_logged: bool = False,
+                            thread_id: Optional[str] = None, documents: Optional[List[str]] = None,
+                            coalesce_key: Optional[str] = None) -> str:
     """
-    This is a background task which executes the agentic framework to cater to the user's prompt.
+    This is a background task which executes the agentic framework to cater to the user's prompt. With
+    $WORKER_ROUTE_QUEUES, it only classifies the prompt and hands the task on to the queue of its route, where
+    `execute_route` answers it.
     :param task_id:         The ID of this task.
     :param prompt_content:  The user's prompt.
+    :param pre_logged:      Whether the task's document was already inserted when it was enqueued (see
+                            `worker.batch.submit_batch`), in which case it is only marked as started.
+    :param thread_id:       The conversation thread to continue, or None to start a new thread whose ID is the task ID.
+    :param documents:       Documents given along with the prompt, for the summarizing agent.
+    :param coalesce_key:    The key the task was registered in flight under by the API, if it was (see
+                            `core.request_coalescer.RequestCoalescer`). The tasks which joined it get its result.
     :return:                The response from the agentic framework.
     """
-    # We want to initialize the Logger and LangGraph inside the worker process.
-    # This method runs every time a worker processes a task.
-    logger = MongoDBLogger()
+    # The Logger, LLM and LangGraph app are built once per worker process (see `_init_worker_process`) and reused by
+    # every task that process executes.
+    runtime = get_runtime(bool(USE_LLM), STREAM_TOKENS)
+    logger = runtime.logger
 
-    # Set up the initial state for the LangGraph App.
+    # Set up the initial state for the LangGraph App. On a continued thread, the checkpointer restores the previous
+    # state (including its conversation), so the results of the previous turn's search are cleared explicitly.
     initial_state = {
         "prompt_content": prompt_content,
-        "task_id": task_id
+        "task_id": task_id,
+        "documents": documents or [],
+        "retrieved_passages": None,
+        "search_results": None,
+        "search_query": None,
+        "search_queries": None,
+        "page_contents": None,
     }
-    config = {"configurable": {"thread_id": task_id}}
+    new_thread = thread_id is None
+    thread_id = thread_id or task_id
+    config = {"configurable": {"thread_id": thread_id}}
 
-    if USE_LLM:
-        gpt_model = "gpt-4.1"
-        llm = ChatOpenAI(model=gpt_model)
-        print(f"We are using the ChatGPT model {gpt_model}.")
+    # start the logger
+    if pre_logged:
+        logger.log_task_running(task_id)
     else:
-        llm = None
-        print("We are running the script without actually invoking any LLM's (preferred option when debugging the "
-              "LangGraph script without wasting token use).")
+        logger.log_task_start(task_id, prompt_content, thread_id=thread_id)
 
-    app = build_graph(logger, llm)
+    start, started_at = time.perf_counter(), time.time()
+    route, final_status, ttft, final_state, handed_on = "error", "Failed", None, None, False
+    if runtime.token_stream is not None:
+        runtime.token_stream.begin(task_id)
+    try:
+        # a repeated prompt is answered from the response cache without running the graph, unless it continues a
+        # conversation, whose previous turns the cached response knows nothing about, or comes with documents, which
+        # are not part of the cache key. For the same reasons, only the answers of such tasks are cached.
+        cacheable = new_thread and not documents
+        cached = runtime.cached_result(prompt_content) if cacheable else None
+        if cached is not None:
+            logger.log_step(task_id, 'response_cache', cached)
+            # the graph did not checkpoint the turn, which the client may continue the thread from
+            runtime.record_turn(thread_id, task_id, prompt_content, cached)
+            if runtime.token_stream is not None:
+                sink = runtime.token_stream.sink(task_id, 'response_cache')
+                sink.write(cached['response'])
+                sink.flush()
+            result = {**cached, "prompt_content": prompt_content}
+        elif WORKER_ROUTE_QUEUES:
+            # the classification leaves the graph's checkpoint, from which the stage of its route resumes it
+            classified = runtime.run_graph(initial_state, config, interrupt_after=["task_classification"])
+            route_signature(task_id, classified['task_classification']['task'], thread_id=thread_id,
+                            coalesce_key=coalesce_key, started_at=started_at, cache=cacheable).apply_async()
+            handed_on, result = True, None
+        else:
+            # get the response from the framework and store it in MongoDB
+            result = runtime.run_graph(initial_state, config)
+        if result is not None:
+            route, final_status = result['task_classification']['task'], "Completed"
+            ttft = _complete(runtime, task_id, result, cache_hit=cached is not None,
+                             cache=cacheable and cached is None)
+            final_state = result
+    except Exception as e:
+        final_state = _fail(runtime, task_id, e)
+        raise e
+    finally:
+        if handed_on:
+            # the rest of the task, and of its token stream, is up to the stage of its route
+            if runtime.token_stream is not None:
+                runtime.token_stream.release(task_id)
+        else:
+            _finish(runtime, task_id, thread_id, coalesce_key, final_state, route, final_status,
+                    time.perf_counter() - start, ttft)
 
-    # start the logger
-    logger.log_task_start(task_id, prompt_content)
+@celery_app.task(name=EXECUTE_ROUTE)
+def execute_route(task_id: str, stage: str, thread_id: Optional[str] = None, coalesce_key: Optional[str] = None,
+                  started_at: Optional[float] = None, cache: bool = False) -> None:
+    """
+    Runs a stage of a task classified by `execute_agent_framework` with $WORKER_ROUTE_QUEUES, resuming its graph from
+    the checkpoint the previous stage left. The search stage of the content route ('content') hands the task on to its
+    generation stage, every other stage runs the graph to its end and completes the task.
+    :param task_id:         The ID of the task.
+    :param stage:           The stage to run, one of `worker.client.ROUTE_STAGES`.
+    :param thread_id:       The conversation thread of the task. Defaults to the task ID.
+    :param coalesce_key:    The key the task was registered in flight under by the API, if it was.
+    :param started_at:      The time (since the epoch) the task started at, which its duration and time to first token
+                            are measured from.
+    :param cache:           Whether to cache the result of the task (see `WorkerRuntime.cache_result`).
+    """
+    runtime = get_runtime(bool(USE_LLM), STREAM_TOKENS)
+    thread_id = thread_id or task_id
+    config = {"configurable": {"thread_id": thread_id}}
+    route = "content" if stage == "content_generation" else stage
+    # the time spent in the previous stages and in the queues between them, on the clocks of other machines
+    elapsed = max(0.0, time.time() - started_at) if started_at is not None else 0.0
+    start = time.perf_counter() - elapsed
+
+    final_status, ttft, final_state = "Failed", None, None
+    if stage == "content":
+        try:
+            runtime.run_graph(None, config, interrupt_before=["content_post_web_search"])
+            route_signature(task_id, "content_generation", thread_id=thread_id, coalesce_key=coalesce_key,
+                            started_at=started_at, cache=cache).apply_async()
+            return
+        except Exception as e:
+            final_state = _fail(runtime, task_id, e)
+            _finish(runtime, task_id, thread_id, coalesce_key, final_state, route, final_status,
+                    time.perf_counter() - start, ttft)
+            raise e
 
+    if runtime.token_stream is not None:
+        runtime.token_stream.begin(task_id, elapsed)
     try:
-        # get the response from the framework and store it in MongoDB
-        result = app.invoke(initial_state, config)
-        logger.log_task_end(task_id, result, final_status="Completed")
+        result = runtime.run_graph(None, config)
+        final_status = "Completed"
+        ttft = _complete(runtime, task_id, result, cache_hit=False, cache=cache)
+        final_state = result
     except Exception as e:
-        error_state = {"response": f"ERROR: {str(e)}",
-                       "task_classification": {"task": "error", "choice_summary": "execution failed"}}
-        logger.log_task_end(task_id, error_state, final_status="Failed")
+        final_state = _fail(runtime, task_id, e)
         raise e
+    finally:
+        _finish(runtime, task_id, thread_id, coalesce_key, final_state, route, final_status,
+                time.perf_counter() - start, ttft)
+
+def _complete(runtime: WorkerRuntime, task_id: str, result: Dict[str, Any], cache_hit: bool,
+              cache: bool) -> Optional[float]:
+    """ Persists the result of a successful task and caches it if asked to, returning its time to first token. """
+    ttft = runtime.token_stream.time_to_first_token(task_id) if runtime.token_stream is not None else None
+    # the full response is persisted whether or not it was streamed
+    runtime.logger.log_task_end(task_id, result, final_status="Completed", time_to_first_token=ttft,
+                                cache_hit=None if runtime.response_cache is None else cache_hit)
+    if cache:
+        runtime.cache_result(result['prompt_content'], result)
+    return ttft
+
+def _fail(runtime: WorkerRuntime, task_id: str, error: Exception) -> Dict[str, Any]:
+    """ Persists the failure of a task, returning the state it ended with. """
+    error_state = {"response": f"ERROR: {str(error)}",
+                   "task_classification": {"task": "error", "choice_summary": "execution failed"}}
+    runtime.logger.log_task_end(task_id, error_state, final_status="Failed")
+    return error_state
+
+def _finish(runtime: WorkerRuntime, task_id: str, thread_id: str, coalesce_key: Optional[str],
+            final_state: Optional[Dict[str, Any]], route: str, final_status: str, duration: float,
+            ttft: Optional[float]) -> None:
+    """ Releases what a task held once it ended, successfully or not, and records its duration. """
+    if coalesce_key is not None:
+        _fan_out(runtime, task_id, coalesce_key, final_state, final_status)
+    if runtime.admission is not None:
+        runtime.admission.release(task_id)
+    # close the token stream only once the response is persisted, so that a client reading the end of the stream
+    # finds the task completed
+    if runtime.token_stream is not None:
+        runtime.token_stream.end(task_id, final_status)
+    # a failed graph may leave the speculative generation of its answer uncommitted
+    if runtime.speculation is not None:
+        runtime.speculation.discard(task_id)
+    runtime.release_thread(thread_id)
+    if runtime.metrics is not None:
+        runtime.metrics.observe("agent_task_duration_seconds", duration, {"route": route, "status": final_status})
+        if ttft is not None:
+            runtime.metrics.observe("agent_time_to_first_token_seconds", ttft, {"route": route})
+
+def _fan_out(runtime: WorkerRuntime, task_id: str, key: str, final_state: Optional[Dict[str, Any]],
+             final_status: str) -> None:
+    """
+    Frees the prompt of a coalesced task for the next request, and ends the tasks which joined it with its result. In
+    the 'fanout' mode, the API gave every follower a new thread of its own, on which its answer is checkpointed so
+    that the follower can continue it.
+    """
+    if runtime.coalescer is None:
+        return
+    try:
+        followers = runtime.coalescer.finish(key, task_id)
+    except Exception as e:
+        # the prompt is freed when its window expires, the followers are left queued
+        print(f"Failed to unregister the coalesced task {task_id}. Error: \n{e}")
+        return
+    if final_state is None:
+        final_state = {"response": f"ERROR: task {task_id}, which this task joined, failed",
+                       "task_classification": {"task": "error", "choice_summary": "execution failed"}}
+    for follower in followers:
+        if final_status == "Completed":
+            runtime.record_turn(follower, follower, final_state['prompt_content'], final_state)
+        try:
+            runtime.logger.log_task_end(follower, final_state, final_status=final_status)
+        except Exception as e:
+            print(f"Failed to end the task {follower} coalesced with task {task_id}. Error: \n{e}")